@@ -1,9 +1,12 @@
 import os
 import json
 import logging
+from typing import Any
 
 import matplotlib.pyplot as plt
 
+from runs import RunArchive, compare_runs, log_comparison, plot_trends, DEFAULT_TREND_METRICS
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(module)s - %(levelname)s - %(message)s",
@@ -26,8 +29,10 @@ def check_files_exist(results_path: str) -> None:
     
     """
     required_files = [
-        "metrics.json",
-        "metrics.proto.bin",
+        "segments/json",  # Segment log directories (with a manifest directly inside, or one per shard-NN/ subdirectory).
+        "segments/proto",
+        "segments/flatbuf",
+        "segments/flatcol",
         "serialize_times.json",
         "deserialize_times.json"
     ]
@@ -39,6 +44,20 @@ def check_files_exist(results_path: str) -> None:
     return
 
 
+def segments_size(segments_path: str) -> int:
+    """Return the total size of the segment files of one storage format, including the shards of every server worker.
+
+    Args:
+        segments_path: The segment log directory of the format (e.g. RESULTS_PATH/segments/json).
+
+    Returns:
+        The size in bytes.
+
+    """
+    return sum(os.path.getsize(os.path.join(directory, f)) for directory, _, files in os.walk(segments_path)
+               for f in files if f.endswith(".seg"))
+
+
 def plot_results(
         sizes: list[int],
         serialize_times: list[int],
@@ -47,7 +66,7 @@ def plot_results(
     """Generate and save plots comparing file sizes and performance metrics.
 
     Args:
-        sizes: List of file sizes in bytes for JSON, Protobuf, and FlatBuffers.
+        sizes: List of file sizes in bytes for JSON, Protobuf, FlatBuffers, and columnar FlatBuffers.
         serialize_times: List of serialization times for each format.
         deserialize_times: List of deserialization times for each format.
 
@@ -55,7 +74,7 @@ def plot_results(
         Exception: If an error occurs during plot generation.
 
     """
-    formats = ["JSON", "Protobuf", "FlatBuffers"]
+    formats = ["JSON", "Protobuf", "FlatBuffers", "FlatBuffers (columnar)"]
     try:
         plt.bar(formats, sizes)  # Build a bar chart to compare file sizes.
         plt.title("File Size Comparison")  # Set the chart title to "File Size Comparison".
@@ -78,6 +97,124 @@ def plot_results(
         raise
 
 
+def plot_scaling(benchmark_path: str, output_path: str) -> None:
+    """Plot scaling curves (time versus payload size) from the results of benchmark/bench.py.
+
+    One subplot is drawn per operation (encode, decode, access) with one line per format: the median time, and a band
+    from the minimum to the 95th percentile.
+
+    Args:
+        benchmark_path: Path to the benchmark JSON file.
+        output_path: Path of the PNG file to write.
+
+    Raises:
+        Exception: If the file cannot be read or the plot cannot be generated.
+
+    """
+    with open(benchmark_path, "r") as f_benchmark:
+        results = json.load(f_benchmark)["results"]
+
+    operations = ["encode", "decode", "access"]
+    fig, axes = plt.subplots(1, len(operations), figsize=(18, 6), sharey=True)
+    for ax, operation in zip(axes, operations):
+        for fmt in sorted({r["format"] for r in results}):
+            points = sorted((r for r in results if r["format"] == fmt and r["operation"] == operation),
+                            key=lambda r: r["rows"])
+            if not points:
+                continue
+            rows = [r["rows"] for r in points]
+            ax.plot(rows, [r["median_ns"] / 1e6 for r in points], marker="o", label=fmt)
+            ax.fill_between(rows, [r["min_ns"] / 1e6 for r in points], [r["p95_ns"] / 1e6 for r in points],
+                            alpha=0.2)  # Spread of the repeated runs: from the fastest run to the 95th percentile.
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_title(operation.capitalize())
+        ax.set_xlabel("Payload size (rows)")
+        ax.grid(True, which="both", alpha=0.3)
+    axes[0].set_ylabel("Time (ms)")
+    axes[0].legend()
+    fig.suptitle("Scaling of serialization formats (median, min-p95 band)")
+    fig.savefig(output_path)
+    plt.close(fig)
+    logger.info("Scaling graph saved to %s", output_path)
+
+
+def plot_read_modes(read_modes: dict[str, dict[str, float]], output_path: str) -> None:
+    """Plot the read-mode comparison measured by the server (copying read vs mmap, full scan, single-column mean).
+
+    Args:
+        read_modes: The "read_modes" entry of read_modes.json (format -> mode -> seconds).
+        output_path: Path of the PNG file to write.
+
+    """
+    modes = ["read", "mmap", "scan", "mean_cpu"]
+    formats = list(read_modes)
+    width = 0.8 / len(modes)
+    fig, ax = plt.subplots(figsize=(12, 6))
+    for i, mode in enumerate(modes):
+        ax.bar([x + i * width for x in range(len(formats))], [read_modes[fmt][mode] for fmt in formats], width,
+               label=mode)
+    ax.set_xticks([x + width * (len(modes) - 1) / 2 for x in range(len(formats))])
+    ax.set_xticklabels(formats)
+    ax.set_yscale("log")  # Lazy decoding and full scans differ by orders of magnitude.
+    ax.set_ylabel("Time (seconds)")
+    ax.set_title("Read Modes Comparison")
+    ax.legend()
+    fig.savefig(output_path)
+    plt.close(fig)
+    logger.info("Read modes graph saved to %s", output_path)
+
+
+def plot_codecs(codecs: dict[str, dict[str, dict[str, float]]], output_path: str) -> None:
+    """Plot the format x codec comparison of benchmark/bench.py: stored size, compression and decompression times.
+
+    Args:
+        codecs: The "codecs" entry of benchmark.json (format -> codec -> measurements).
+        output_path: Path of the PNG file to write.
+
+    """
+    formats = list(codecs)
+    specs = list(codecs[formats[0]])
+    width = 0.8 / len(specs)
+    panels = [("bytes", "Stored size (bytes)"), ("compress_time", "Compression time (seconds)"),
+              ("decompress_time", "Decompression time (seconds)")]
+    fig, axes = plt.subplots(1, len(panels), figsize=(20, 6))
+    for ax, (key, label) in zip(axes, panels):
+        for i, spec in enumerate(specs):
+            ax.bar([x + i * width for x in range(len(formats))], [codecs[fmt][spec][key] for fmt in formats], width,
+                   label=spec)
+        ax.set_xticks([x + width * (len(specs) - 1) / 2 for x in range(len(formats))])
+        ax.set_xticklabels(formats)
+        ax.set_title(label)
+    axes[0].legend()
+    fig.suptitle("At-rest codecs by format (same sample of records for every codec)")
+    fig.savefig(output_path)
+    plt.close(fig)
+    logger.info("Codec comparison graph saved to %s", output_path)
+
+
+def plot_json_layouts(layouts: dict[str, Any], output_path: str) -> None:
+    """Plot the JSON layout comparison of the standalone benchmark: read time and peak memory of every mode.
+
+    Args:
+        layouts: The "json_layouts" entry of benchmark.json (see `measure_json_layouts` in benchmark/bench.py).
+        output_path: Path of the PNG file to write.
+
+    """
+    modes = [mode for mode in ("json_load", "ndjson_stream", "ndjson_parallel") if mode in layouts]
+    fig, (ax_time, ax_memory) = plt.subplots(1, 2, figsize=(14, 6))
+    ax_time.bar(modes, [layouts[mode]["time"] for mode in modes])
+    ax_time.set_ylabel("Time (seconds)")
+    ax_time.set_title("Read time")
+    ax_memory.bar(modes, [layouts[mode]["peak_bytes"] / 2 ** 20 for mode in modes])
+    ax_memory.set_ylabel("Peak memory (MiB)")
+    ax_memory.set_title("Peak memory of the reading process")
+    fig.suptitle(f"JSON array ({layouts['array_bytes']} bytes) vs NDJSON ({layouts['ndjson_bytes']} bytes)")
+    fig.savefig(output_path)
+    plt.close(fig)
+    logger.info("JSON layouts graph saved to %s", output_path)
+
+
 def run() -> None:
     """Run the analysis process to generate comparison plots.
 
@@ -92,9 +229,10 @@ def run() -> None:
         check_files_exist(results_path)
 
         sizes = [
-            os.path.getsize(f"{results_path}/metrics.json"),
-            os.path.getsize(f"{results_path}/metrics.proto.bin"),
-            os.path.getsize(f"{results_path}/metrics.flatbuf")
+            segments_size(f"{results_path}/segments/json"),
+            segments_size(f"{results_path}/segments/proto"),
+            segments_size(f"{results_path}/segments/flatbuf"),
+            segments_size(f"{results_path}/segments/flatcol")
         ]
 
         with open(f"{results_path}/serialize_times.json", "r") as f_serialize_times:
@@ -102,7 +240,8 @@ def run() -> None:
         serialize_times = [
             serialize_data["json_ser_time"],
             serialize_data["proto_ser_time"],
-            serialize_data["flat_ser_time"]
+            serialize_data["flat_ser_time"],
+            serialize_data["flatcol_ser_time"]
         ]
 
         with open(f"{results_path}/deserialize_times.json", "r") as f_deserialize_times:
@@ -110,13 +249,49 @@ def run() -> None:
         deserialize_times = [
             deserialize_data["json_deser_time"],
             deserialize_data["proto_deser_time"],
-            deserialize_data["flat_deser_time"]
+            deserialize_data["flat_deser_time"],
+            deserialize_data["flatcol_deser_time"]
         ]
 
         plot_results(sizes, serialize_times, deserialize_times)
+        # The read modes are only compared on demand (`python deserialize_perfomance.py --read-modes` on the server).
+        if os.path.exists(f"{results_path}/read_modes.json"):
+            with open(f"{results_path}/read_modes.json", "r") as f_read_modes:
+                plot_read_modes(json.load(f_read_modes)["read_modes"], f"{results_path}/read_modes_comparison.png")
     except Exception as e:
         logger.error("Analysis failed: %s", e)
 
+    # Scaling curves, the codec and the JSON layout comparisons are drawn only if the standalone benchmark
+    # (benchmark/bench.py) has been run.
+    if os.path.exists(f"{results_path}/benchmark.json"):
+        try:
+            plot_scaling(f"{results_path}/benchmark.json", f"{results_path}/benchmark_scaling.png")
+            with open(f"{results_path}/benchmark.json", "r") as f_benchmark:
+                benchmark = json.load(f_benchmark)
+            if benchmark.get("codecs"):
+                plot_codecs(benchmark["codecs"], f"{results_path}/codec_comparison.png")
+            if benchmark.get("json_layouts"):
+                plot_json_layouts(benchmark["json_layouts"], f"{results_path}/json_layouts_comparison.png")
+        except Exception as e:
+            logger.error("Benchmark analysis failed: %s", e)
+
+    # Every run is archived, compared with the previous values of its metrics and added to the trends (see runs.py,
+    # which also compares any two runs and fails on regressions). Set RUN_ARCHIVE=0 to skip it.
+    if os.getenv("RUN_ARCHIVE", "1") not in ("0", "false", "no"):
+        try:
+            archive = RunArchive(f"{results_path}/runs")
+            run_id = archive.archive(results_path, os.getenv("RUN_LABEL"))
+            if run_id is not None and len(archive.index()) > 1:
+                try:
+                    baseline, baseline_id = archive.baseline("previous", run_id)
+                except LookupError as e:  # No earlier run has these metrics (e.g. the first benchmark run).
+                    logger.info("%s", e)
+                else:
+                    log_comparison(compare_runs(baseline, archive.load(run_id)), baseline_id, run_id)
+            plot_trends(archive.index(), DEFAULT_TREND_METRICS.split(","), f"{results_path}/runs_trends.png")
+        except Exception as e:
+            logger.error("Run archive failed: %s", e)
+
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,519 @@
+import os
+import sys
+import json
+import math
+import time
+import fnmatch
+import functools
+import hashlib
+import logging
+import argparse
+import platform
+from importlib import metadata
+from typing import Any, Iterator, Optional
+
+import matplotlib.pyplot as plt
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.jsonl"
+# Result files of a run, each archived only if it changed since the last run that included it (the standalone benchmark
+# is not run with every pipeline run, for example).
+SOURCES = ("serialize_times.json", "deserialize_times.json", "read_modes.json", "benchmark.json", "load_report.json",
+           "transport_bench.json")
+PACKAGES = ("grpcio", "protobuf", "flatbuffers", "numpy", "matplotlib")
+DEFAULT_TREND_METRICS = "serialize/*,deserialize/*,bench/encode/*,bench/decode/*"
+EXACT_TEST_MAX_SAMPLES = 50  # Beyond this (per side), the normal approximation of the rank-sum test is used.
+
+
+def environment() -> dict[str, Any]:
+    """Describe the host and the package versions the results were archived with."""
+    cpu_model = platform.processor()
+    try:
+        with open("/proc/cpuinfo", "r") as f_cpuinfo:
+            cpu_model = next((line.split(":", 1)[1].strip() for line in f_cpuinfo if line.startswith("model name")),
+                             cpu_model)
+    except OSError:  # Not Linux.
+        pass
+    packages = {}
+    for package in PACKAGES:
+        try:
+            packages[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            packages[package] = None
+    return {"python": sys.version.split()[0], "implementation": platform.python_implementation(),
+            "platform": platform.platform(), "cpu": cpu_model, "cpu_count": os.cpu_count(), "packages": packages}
+
+
+def metric(samples: list[float], unit: str, higher_is_better: bool = False) -> dict[str, Any]:
+    return {"samples": samples, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def extract_metrics(name: str, data: dict[str, Any]) -> dict[str, dict[str, Any]]:
+    """Flatten one result file into named metrics ("serialize/proto", "bench/decode/flatcol/10000", ...).
+
+    Args:
+        name: The file name (one of SOURCES).
+        data: Its content.
+
+    Returns:
+        The metrics by name: their samples (one per repeated run, or a single one), unit and direction.
+
+    """
+    metrics = {}
+    if name == "serialize_times.json":
+        for key, value in data.items():
+            if key.endswith("_ser_time"):
+                metrics[f"serialize/{key[:-len('_ser_time')]}"] = metric([value], "s")
+    elif name == "deserialize_times.json":
+        for key, value in data.items():
+            if key.endswith("_deser_time"):
+                metrics[f"deserialize/{key[:-len('_deser_time')]}"] = metric([value], "s")
+        for fmt, size in data.get("sizes", {}).items():
+            metrics[f"size/{fmt}"] = metric([size], "bytes")
+    elif name == "read_modes.json":
+        for fmt, modes in data["read_modes"].items():
+            for mode, seconds in modes.items():
+                if mode != "mean_cpu_usage":  # The computed value, not a duration.
+                    metrics[f"read/{fmt}/{mode}"] = metric([seconds], "s")
+    elif name == "benchmark.json":
+        for result in data.get("results", []):
+            key = f"{result['operation']}/{result['format']}/{result['rows']}"
+            if "workers" in result:
+                key += f"/w{result['workers']}"
+            metrics[f"bench/{key}"] = metric(result["samples_ns"], "ns")
+            if "peak_bytes_per_sample" in result:
+                metrics[f"bench_memory/{key}"] = metric([result["peak_bytes_per_sample"]], "bytes/sample")
+        for mode, result in data.get("json_layouts", {}).items():
+            if isinstance(result, dict):  # Not the sample count or the file sizes.
+                metrics[f"json_layout/{mode}/time"] = metric([result["time"]], "s")
+                metrics[f"json_layout/{mode}/peak_bytes"] = metric([result["peak_bytes"]], "bytes")
+    elif name == "load_report.json":
+        metrics["load/rows_per_s"] = metric([data["rows_per_s"]], "rows/s", higher_is_better=True)
+        for quantile in ("p50", "p99"):
+            metrics[f"load/latency_{quantile}"] = metric([data["latency"][f"{quantile}_us"]], "us")
+    elif name == "transport_bench.json":
+        for transport, result in data.get("transports", {}).items():
+            metrics[f"transport/{transport}/latency_p50"] = metric([result["latency"]["p50_us"]], "us")
+            if "overhead_mean_us" in result:
+                metrics[f"transport/{transport}/overhead_mean"] = metric([result["overhead_mean_us"]], "us")
+    return metrics
+
+
+def median(values: list[float]) -> float:
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def summarize_run(record: dict[str, Any]) -> dict[str, Any]:
+    """Return the index entry of a run: everything but the raw samples, which are replaced by their median."""
+    return {
+        "run_id": record["run_id"],
+        "created": record["created"],
+        "label": record["label"],
+        "sources": record["sources"],
+        "metrics": {name: {"median": median(m["samples"]), "n": len(m["samples"]), "unit": m["unit"],
+                           "higher_is_better": m["higher_is_better"]} for name, m in record["metrics"].items()}
+    }
+
+
+class RunArchive:
+    """Immutable records of the benchmark runs, under RESULTS_PATH/runs.
+
+    Every run is one read-only JSON file, `<run_id>.json`, with the environment, the payload sizes, the digests of the
+    archived result files and every metric with its raw samples. Run IDs start with the UTC time of the run, so they
+    sort chronologically.
+
+    The summaries of the runs (medians, without the samples) are appended to `index.jsonl` as runs are archived, so
+    trends are drawn from the index alone, and a comparison reads only the two runs it compares. Runs missing from the
+    index (copied from another machine, or archived by an interrupted process) are summarized and appended the next
+    time the index is loaded.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.index_path = os.path.join(path, INDEX_FILE)
+        self._index = None  # Summaries in run order, loaded on first use.
+
+    def run_path(self, run_id: str) -> str:
+        return os.path.join(self.path, f"{run_id}.json")
+
+    def load(self, run_id: str) -> dict[str, Any]:
+        with open(self.run_path(run_id), "r") as f_run:
+            return json.load(f_run)
+
+    def index(self) -> list[dict[str, Any]]:
+        """Return the summaries of every run, oldest first, indexing the runs that are not yet."""
+        if self._index is None:
+            entries = {}
+            if os.path.exists(self.index_path):
+                with open(self.index_path, "r") as f_index:
+                    for line in f_index:
+                        if line.strip():
+                            entry = json.loads(line)
+                            entries[entry["run_id"]] = entry
+            run_ids = sorted(name[:-len(".json")] for name in os.listdir(self.path) if name.endswith(".json")) \
+                if os.path.isdir(self.path) else []
+            missing = [run_id for run_id in run_ids if run_id not in entries]
+            if missing:
+                logger.info("Indexing %d archived runs.", len(missing))
+                with open(self.index_path, "a") as f_index:
+                    for run_id in missing:
+                        entries[run_id] = summarize_run(self.load(run_id))
+                        f_index.write(json.dumps(entries[run_id]) + "\n")
+            self._index = [entries[run_id] for run_id in run_ids]
+        return self._index
+
+    def resolve(self, reference: str) -> str:
+        """Find a run by ID, ID prefix or label (the latest run with that label); "latest" is the latest run.
+
+        Raises:
+            LookupError: If no run matches.
+
+        """
+        run_ids = [entry["run_id"] for entry in self.index()]
+        if reference == "latest":
+            if not run_ids:
+                raise LookupError(f"No latest run in {self.path}.")
+            return run_ids[-1]
+        matches = [run_id for run_id in run_ids if run_id.startswith(reference)]
+        matches = matches or [entry["run_id"] for entry in self.index() if entry["label"] == reference]
+        if not matches:
+            raise LookupError(f"No run {reference!r} in {self.path}.")
+        return matches[-1]
+
+    def previous(self, run_id: str) -> tuple[dict[str, Any], list[str]]:
+        """Build the baseline of a run from the runs before it: every metric of the run, as last archived before it.
+
+        A run only holds the result files that changed (see `archive`), so the run right before it may have no metric
+        in common with it: every metric is taken from the latest earlier run that has it instead.
+
+        Returns:
+            A run record with the baseline metrics only, and the IDs of the runs they come from, oldest first.
+
+        Raises:
+            LookupError: If no earlier run has any metric of the run.
+
+        """
+        index = self.index()
+        position = [entry["run_id"] for entry in index].index(run_id)
+        missing = set(index[position]["metrics"])
+        metrics = {}
+        run_ids = []
+        for entry in reversed(index[:position]):
+            if not missing:
+                break
+            names = missing & set(entry["metrics"])
+            if names:
+                run_metrics = self.load(entry["run_id"])["metrics"]
+                metrics.update((name, run_metrics[name]) for name in names)
+                missing -= names
+                run_ids.append(entry["run_id"])
+        if not metrics:
+            raise LookupError(f"No run before {run_id} in {self.path} has any of its metrics.")
+        return {"run_id": "+".join(reversed(run_ids)), "metrics": metrics}, run_ids[::-1]
+
+    def baseline(self, reference: str, run_id: str) -> tuple[dict[str, Any], str]:
+        """Return the baseline a run is compared with, and its description (the ID of the run(s) it comes from).
+
+        "previous" is the per-metric baseline of `previous`; any other reference is a run (see `resolve`).
+
+        Raises:
+            LookupError: If no run matches.
+
+        """
+        if reference == "previous":
+            record, run_ids = self.previous(run_id)
+            return record, ", ".join(run_ids)
+        baseline_id = self.resolve(reference)
+        return self.load(baseline_id), baseline_id
+
+    def archive(self, results_path: str, label: Optional[str] = None) -> Optional[str]:
+        """Archive the result files of a run that changed since they were last archived.
+
+        Args:
+            results_path: The directory of the result files (RESULTS_PATH).
+            label: Name of the run (a branch or a change, for example), usable instead of its ID.
+
+        Returns:
+            The ID of the new run, or None if no result file changed.
+
+        """
+        last_digests = {}
+        for entry in self.index():
+            last_digests.update(entry["sources"])
+        sources = {}
+        metrics = {}
+        contents = {}
+        for name in SOURCES:
+            path = os.path.join(results_path, name)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f_source:
+                content = f_source.read()
+            digest = hashlib.sha256(content).hexdigest()
+            if last_digests.get(name) == digest:
+                continue  # Already archived with an earlier run.
+            try:
+                contents[name] = json.loads(content)
+                metrics.update(extract_metrics(name, contents[name]))
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning("Skipping %s, which cannot be read: %r", name, e)
+                continue
+            sources[name] = digest
+        if not sources:
+            logger.info("No new results to archive.")
+            return None
+
+        created = time.time()
+        run_id = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(created)) + "-" + hashlib.sha256(
+            "".join(sorted(sources.values())).encode()).hexdigest()[:8]
+        benchmark = contents.get("benchmark.json", {})
+        record = {
+            "run_id": run_id,
+            "created": created,
+            "label": label,
+            # The benchmark records the environment it ran in; the pipeline runs on the same host as the analysis.
+            "environment": benchmark.get("environment") or environment(),
+            "payload": {
+                "metrics_count": contents.get("serialize_times.json", {}).get("metrics_count"),
+                "schema_version": contents.get("serialize_times.json", {}).get("schema_version"),
+                "stored_bytes": contents.get("deserialize_times.json", {}).get("sizes"),
+                "benchmark_rows": sorted({result["rows"] for result in benchmark.get("results", [])}),
+                "benchmark_settings": benchmark.get("settings")
+            },
+            "sources": sources,
+            "metrics": metrics
+        }
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.run_path(run_id), "x") as f_run:  # Never overwrites a run.
+            json.dump(record, f_run)
+        os.chmod(self.run_path(run_id), 0o444)
+        entry = summarize_run(record)
+        with open(self.index_path, "a") as f_index:
+            f_index.write(json.dumps(entry) + "\n")
+        self.index().append(entry)
+        logger.info("Run %s archived (%s, %d metrics).", run_id, ", ".join(sources), len(metrics))
+        return run_id
+
+
+@functools.lru_cache(maxsize=None)
+def u_distribution(m: int, n: int) -> tuple[int, ...]:
+    """Return the number of orderings of m baseline and n candidate samples (without ties) for every value of U.
+
+    Recurrence on the largest sample: either a candidate, larger than all the baseline samples (U grows by their
+    number), or a baseline sample, smaller than no candidate.
+
+    """
+    previous = [[1] for _ in range(n + 1)]  # No baseline sample: U is 0.
+    for i in range(1, m + 1):
+        row = [[1]]
+        for j in range(1, n + 1):
+            counts = [0] * (i * j + 1)
+            for value, count in enumerate(row[j - 1]):
+                counts[value + i] += count
+            for value, count in enumerate(previous[j]):
+                counts[value] += count
+            row.append(counts)
+        previous = row
+    return tuple(previous[n])
+
+
+def rank_sum_p_value(baseline: list[float], candidate: list[float]) -> float:
+    """Return the one-sided p-value of the Mann-Whitney U test that the candidate samples tend to be larger.
+
+    The exact distribution of U is used for small samples without ties, and the normal approximation (with tie and
+    continuity corrections) otherwise.
+
+    """
+    m, n = len(baseline), len(candidate)
+    pooled = sorted([(value, 0) for value in baseline] + [(value, 1) for value in candidate])
+    ranks = [0.0] * len(pooled)
+    ties = []
+    i = 0
+    while i < len(pooled):
+        j = i
+        while j + 1 < len(pooled) and pooled[j + 1][0] == pooled[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        ties.append(j - i + 1)
+        i = j + 1
+    # U counts the (baseline, candidate) pairs in which the candidate is larger.
+    u = sum(rank for rank, (_, side) in zip(ranks, pooled) if side == 1) - n * (n + 1) / 2
+    if max(ties) == 1 and max(m, n) <= EXACT_TEST_MAX_SAMPLES:
+        distribution = u_distribution(m, n)
+        return sum(distribution[int(u):]) / sum(distribution)
+    mean = m * n / 2
+    variance = m * n / 12 * ((m + n + 1) - sum(t ** 3 - t for t in ties) / ((m + n) * (m + n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - mean - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def compare_runs(
+        baseline: dict[str, Any],
+        candidate: dict[str, Any],
+        threshold: float = 0.05,
+        alpha: float = 0.01,
+        min_samples: int = 3
+) -> list[dict[str, Any]]:
+    """Compare every metric of two runs.
+
+    A metric regresses when its median got worse by more than `threshold` (relative) and the rank-sum test finds the
+    candidate samples worse than the baseline ones with a p-value below `alpha`. Metrics with fewer than `min_samples`
+    samples on either side cannot be tested: their change is reported, but never counted as a regression.
+
+    Returns:
+        One comparison per metric of both runs, with its status: "regression", "improvement", "unchanged" or
+        "untested".
+
+    """
+    comparisons = []
+    for name in sorted(set(baseline["metrics"]) & set(candidate["metrics"])):
+        before, after = baseline["metrics"][name], candidate["metrics"][name]
+        before_median, after_median = median(before["samples"]), median(after["samples"])
+        change = (after_median - before_median) / before_median if before_median else 0.0
+        worse = -change if after["higher_is_better"] else change  # Positive when the metric got worse.
+        comparison = {"metric": name, "unit": after["unit"], "baseline": before_median, "candidate": after_median,
+                      "change": change, "samples": [len(before["samples"]), len(after["samples"])]}
+        if min(comparison["samples"]) < min_samples:
+            comparison["status"] = "untested"
+        else:
+            # Test in the "worse" direction: larger values, or smaller ones for higher-is-better metrics.
+            sign = -1 if after["higher_is_better"] else 1
+            p_worse = rank_sum_p_value([sign * v for v in before["samples"]], [sign * v for v in after["samples"]])
+            p_better = rank_sum_p_value([sign * v for v in after["samples"]], [sign * v for v in before["samples"]])
+            if worse > threshold and p_worse < alpha:
+                comparison["status"] = "regression"
+            elif worse < -threshold and p_better < alpha:
+                comparison["status"] = "improvement"
+            else:
+                comparison["status"] = "unchanged"
+            comparison["p_value"] = p_better if worse < 0 else p_worse  # Of the direction the median moved in.
+        comparisons.append(comparison)
+    return comparisons
+
+
+def iter_trends(index: list[dict[str, Any]], patterns: list[str]) -> Iterator[tuple[str, list[int], list[float]]]:
+    """Yield every metric matching one of the patterns, with the positions of the runs that have it and its medians."""
+    names = sorted({name for entry in index for name in entry["metrics"]
+                    if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)})
+    for name in names:
+        points = [(position, entry["metrics"][name]["median"]) for position, entry in enumerate(index)
+                  if name in entry["metrics"]]
+        yield name, [position for position, _ in points], [value for _, value in points]
+
+
+def plot_trends(index: list[dict[str, Any]], patterns: list[str], output_path: str) -> None:
+    """Plot the medians of the matching metrics across runs: one panel per metric group, one line per metric.
+
+    Args:
+        index: Run summaries, oldest first (see `RunArchive.index`).
+        patterns: Shell-style patterns of the metric names.
+        output_path: Path of the PNG file to write.
+
+    """
+    groups = {}
+    for name, positions, values in iter_trends(index, patterns):
+        groups.setdefault(name.split("/", 1)[0], []).append((name, positions, values))
+    if not groups:
+        logger.warning("No archived metric matches %s.", ", ".join(patterns))
+        return
+    fig, axes = plt.subplots(len(groups), 1, figsize=(14, 5 * len(groups)), squeeze=False)
+    labels = [entry["label"] or entry["run_id"][:15] for entry in index]
+    for ax, (group, lines) in zip(axes[:, 0], sorted(groups.items())):
+        for name, positions, values in lines:
+            ax.plot(positions, values, marker="o", label=name.split("/", 1)[1])
+        ax.set_yscale("log")  # Metrics of one group span several payload sizes.
+        ax.set_title(group)
+        ax.set_ylabel(index[lines[0][1][-1]]["metrics"][lines[0][0]]["unit"])
+        ax.set_xticks(range(len(labels)))
+        ax.set_xticklabels(labels, rotation=30, ha="right", fontsize=8)
+        ax.grid(True, alpha=0.3)
+        ax.legend(fontsize=7, ncol=2)
+    fig.suptitle("Trends across archived runs (median)")
+    fig.tight_layout()
+    fig.savefig(output_path)
+    plt.close(fig)
+    logger.info("Trend graph saved to %s", output_path)
+
+
+def log_comparison(comparisons: list[dict[str, Any]], baseline_id: str, candidate_id: str,
+                   show_all: bool = False) -> None:
+    counts = {}
+    for comparison in comparisons:
+        counts[comparison["status"]] = counts.get(comparison["status"], 0) + 1
+        if show_all or comparison["status"] in ("regression", "improvement"):
+            logger.info("%-11s %-45s %12.6g -> %12.6g %s (%+.1f%%, p=%s)", comparison["status"], comparison["metric"],
+                        comparison["baseline"], comparison["candidate"], comparison["unit"],
+                        comparison["change"] * 100, f"{comparison['p_value']:.2g}" if "p_value" in comparison else "-")
+    logger.info("Run %s against baseline %s: %s.", candidate_id, baseline_id,
+                ", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "no common metric")
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Archive benchmark runs, compare them and plot their trends.")
+    parser.add_argument("--runs", default=None, help="Run archive directory (default: RESULTS_PATH/runs).")
+    commands = parser.add_subparsers(dest="command", required=True)
+    archive = commands.add_parser("archive", help="Archive the current result files as a new run.")
+    archive.add_argument("--label", default=os.getenv("RUN_LABEL"), help="Name of the run.")
+    commands.add_parser("list", help="List the archived runs.")
+    compare = commands.add_parser("compare", help="Compare a run with a baseline; exit with 1 on regressions.")
+    compare.add_argument("--baseline", default="previous",
+                         help="Baseline run: ID, ID prefix, label, or 'previous' (every metric as last archived before "
+                              "the candidate).")
+    compare.add_argument("--candidate", default="latest", help="Compared run (default: the latest).")
+    compare.add_argument("--threshold", type=float, default=0.05,
+                         help="Relative slowdown of the median counted as a regression (default: 5%%).")
+    compare.add_argument("--alpha", type=float, default=0.01, help="Significance level of the rank-sum test.")
+    compare.add_argument("--min-samples", type=int, default=3,
+                         help="Metrics with fewer samples in either run are reported but not tested.")
+    compare.add_argument("--all", action="store_true", help="Show every metric, not only the changed ones.")
+    compare.add_argument("--output", default=None, help="Also write the comparison as JSON.")
+    trend = commands.add_parser("trend", help="Plot the medians of metrics across runs.")
+    trend.add_argument("--metrics", default=DEFAULT_TREND_METRICS,
+                       help="Comma-separated shell-style patterns of metric names.")
+    trend.add_argument("--output", default=None, help="PNG file (default: RESULTS_PATH/runs_trends.png).")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    """Run a command and return the exit status: 1 if the comparison found regressions, 2 if a run is missing."""
+    args = parse_args(argv)
+    results_path = os.getenv("RESULTS_PATH", ".")
+    archive = RunArchive(args.runs or os.path.join(results_path, "runs"))
+    if args.command == "archive":
+        archive.archive(results_path, args.label)
+    elif args.command == "list":
+        for entry in archive.index():
+            print(f"{entry['run_id']}  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['created']))}  "
+                  f"{entry['label'] or '-':20}  {len(entry['metrics']):5d} metrics  {', '.join(entry['sources'])}")
+    elif args.command == "compare":
+        try:
+            candidate_id = archive.resolve(args.candidate)
+            baseline, baseline_id = archive.baseline(args.baseline, candidate_id)
+        except LookupError as e:
+            logger.error("%s", e)
+            return 2
+        comparisons = compare_runs(baseline, archive.load(candidate_id), args.threshold, args.alpha, args.min_samples)
+        log_comparison(comparisons, baseline_id, candidate_id, args.all)
+        if args.output:
+            with open(args.output, "w") as f_output:
+                json.dump({"baseline": baseline_id, "candidate": candidate_id, "comparisons": comparisons}, f_output,
+                          indent=2)
+        if not comparisons:
+            return 2
+        return 1 if any(comparison["status"] == "regression" for comparison in comparisons) else 0
+    elif args.command == "trend":
+        plot_trends(archive.index(), args.metrics.split(","),
+                    args.output or os.path.join(results_path, "runs_trends.png"))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(module)s - %(levelname)s - %(message)s")
+    sys.exit(main())
@@ -0,0 +1,73 @@
+import os
+import json
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+import runs
+
+# Run with `python -m unittest test_runs` from the analysis directory.
+
+
+def benchmark_results(scale: float) -> dict:
+    return {"results": [{"operation": "decode", "format": "flatcol", "rows": 1000,
+                         "samples_ns": [int(scale * sample) for sample in range(1000, 1010)]}]}
+
+
+class InterleavedRunsTest(unittest.TestCase):
+    """Runs that archive different result files, as when the standalone benchmark is not run with every pipeline run."""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.results_path = self.directory.name
+        self.runs_path = os.path.join(self.results_path, "runs")
+        self.clock = 1_700_000_000
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+        for name in os.listdir(self.runs_path):
+            os.chmod(os.path.join(self.runs_path, name), 0o644)
+        self.directory.cleanup()
+
+    def archive(self, name: str, data: dict) -> str:
+        """Write one result file and archive it as a new run, one minute after the previous one."""
+        with open(os.path.join(self.results_path, name), "w") as f_result:
+            json.dump(data, f_result)
+        self.clock += 60
+        with mock.patch.object(runs.time, "time", return_value=self.clock):
+            return runs.RunArchive(self.runs_path).archive(self.results_path)
+
+    def test_previous_takes_every_metric_from_the_latest_run_that_has_it(self) -> None:
+        first_benchmark = self.archive("benchmark.json", benchmark_results(1.0))
+        pipeline = self.archive("serialize_times.json", {"json_ser_time": 0.5, "proto_ser_time": 0.1})
+        self.archive("benchmark.json", benchmark_results(2.0))
+        candidate = self.archive("serialize_times.json", {"json_ser_time": 0.6, "proto_ser_time": 0.1})
+
+        baseline, run_ids = runs.RunArchive(self.runs_path).previous(candidate)
+        self.assertEqual(run_ids, [pipeline])
+        self.assertEqual(set(baseline["metrics"]), {"serialize/json", "serialize/proto"})
+
+        # The benchmark run right before the candidate: its only earlier source is the first benchmark run.
+        second_benchmark = runs.RunArchive(self.runs_path).index()[2]["run_id"]
+        self.assertEqual(runs.RunArchive(self.runs_path).previous(second_benchmark)[1], [first_benchmark])
+
+    def test_compare_flags_a_regression_after_an_unrelated_run(self) -> None:
+        self.archive("benchmark.json", benchmark_results(1.0))
+        self.archive("serialize_times.json", {"json_ser_time": 0.5})
+        self.archive("benchmark.json", benchmark_results(2.0))
+
+        with mock.patch.dict(os.environ, {"RESULTS_PATH": self.results_path}):
+            self.assertEqual(runs.main(["compare"]), 1)
+
+    def test_compare_without_earlier_metrics_fails(self) -> None:
+        self.archive("serialize_times.json", {"json_ser_time": 0.5})
+        self.archive("benchmark.json", benchmark_results(1.0))
+
+        with mock.patch.dict(os.environ, {"RESULTS_PATH": self.results_path}):
+            self.assertEqual(runs.main(["compare"]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,646 @@
+import io
+import os
+import gc
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Any, Optional
+
+from metrics_pb2 import MetricsRequest
+from flatbuffers_schema.MetricsRequest import MetricsRequest as FlatMetricsRequest
+from data_generator import generate_metric_batches, MetricColumns
+from codec import iter_ndjson, iter_ndjson_parallel, concat_columns
+from compression import parse_codec, compress, decompress
+from serializers import serialize_json, serialize_ndjson, serialize_protobuf, serialize_flatbuffers, \
+    serialize_flatbuffers_columnar, deserialize_flatbuffers_columnar, serialize_chunked, DEFAULT_CHUNK_SIZE
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(module)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+REPRESENTATION_ROWS = 1_000_000  # Largest batch of the representation comparison (about 1 GiB as dicts).
+# At-rest codecs (with levels) of the codec comparison, and the number of samples per compressed record.
+COMPARED_CODECS = ("none", "zlib:1", "zlib:6", "zlib:9", "bz2:9", "lzma:0", "lzma:6")
+CODEC_BATCH_ROWS = 10_000
+JSON_LAYOUT_ROWS = 200_000  # Samples of the JSON layout comparison.
+
+
+def to_dicts(metrics: MetricColumns) -> list[dict[str, Any]]:
+    """Expand a columnar batch into the list of dicts produced by `generate_metrics`."""
+    return [
+        {"server_id": metrics.server_ids[i], "cpu_usage": cpu, "memory_usage": memory, "disk_usage": disk,
+         "timestamp": timestamp}
+        for i, cpu, memory, disk, timestamp in zip(metrics.server_index.tolist(), metrics.cpu_usage.tolist(),
+                                                   metrics.memory_usage.tolist(), metrics.disk_usage.tolist(),
+                                                   metrics.iso_timestamps().tolist())
+    ]
+
+
+class MetricRecord:
+    """One sample as an object with `__slots__`: the row representation without the per-sample dict."""
+
+    __slots__ = ("server_id", "cpu_usage", "memory_usage", "disk_usage", "timestamp")
+
+    def __init__(self, server_id: str, cpu_usage: float, memory_usage: float, disk_usage: float,
+                 timestamp: str) -> None:
+        self.server_id = server_id
+        self.cpu_usage = cpu_usage
+        self.memory_usage = memory_usage
+        self.disk_usage = disk_usage
+        self.timestamp = timestamp
+
+
+def to_records(metrics: MetricColumns) -> list[MetricRecord]:
+    """Expand a columnar batch into a list of MetricRecord."""
+    return [
+        MetricRecord(metrics.server_ids[i], cpu, memory, disk, timestamp)
+        for i, cpu, memory, disk, timestamp in zip(metrics.server_index.tolist(), metrics.cpu_usage.tolist(),
+                                                   metrics.memory_usage.tolist(), metrics.disk_usage.tolist(),
+                                                   metrics.iso_timestamps().tolist())
+    ]
+
+
+# In-memory representations of a batch compared by `measure_representations`: how each one is built from the
+# generated columns. The columns are built by the generator itself, so that they own their arrays.
+REPRESENTATIONS = {
+    "dicts": to_dicts,
+    "records": to_records,
+    "columns": None
+}
+
+
+# Every format defines how to encode a batch to bytes, how to decode the bytes, and how to read every field of every
+# sample from the decoded object. The "access" measurement is decode + full field access, so that lazy formats pay for
+# the data they actually read. The row formats are encoded in the schema version selected with --schema-version; the
+# access functions read the timestamp field of both versions (the field that is not set costs a default value only).
+def encode_json(metrics, schema_version: int = 1) -> bytes:
+    return serialize_json(metrics, schema_version).encode("utf-8")
+
+
+def decode_json(buf: bytes) -> list:
+    return json.loads(buf)
+
+
+def access_json(data: list) -> int:
+    for m in data:
+        m["server_id"], m["cpu_usage"], m["memory_usage"], m["disk_usage"], m.get("timestamp", m.get("timestamp_ns"))
+    return len(data)
+
+
+def encode_ndjson(metrics, schema_version: int = 1) -> bytes:
+    return serialize_ndjson(metrics, schema_version)
+
+
+def decode_ndjson(buf: bytes) -> dict:
+    # Read incrementally, a block of lines at a time, into columns: the text of a block is dropped once parsed.
+    return concat_columns(list(iter_ndjson(io.BytesIO(buf), columns=True)))
+
+
+def encode_protobuf(metrics, schema_version: int = 1) -> bytes:
+    return serialize_protobuf(metrics, schema_version).SerializeToString()
+
+
+def encode_flatbuffers(metrics, schema_version: int = 1) -> bytes:
+    return serialize_flatbuffers(metrics, schema_version)
+
+
+def encode_flatbuffers_columnar(metrics, schema_version: int = 1) -> bytes:
+    return serialize_flatbuffers_columnar(metrics)  # Always epoch nanoseconds, whatever the schema version.
+
+
+def decode_protobuf(buf: bytes) -> MetricsRequest:
+    return MetricsRequest.FromString(buf)
+
+
+def access_protobuf(data: MetricsRequest) -> int:
+    for m in data.metrics:
+        m.server_id, m.cpu_usage, m.memory_usage, m.disk_usage, m.timestamp, m.timestamp_ns
+    return len(data.metrics)
+
+
+def decode_flatbuffers(buf: bytes) -> FlatMetricsRequest:
+    return FlatMetricsRequest.GetRootAsMetricsRequest(buf, 0)
+
+
+def access_flatbuffers(data: FlatMetricsRequest) -> int:
+    count = data.MetricsLength()
+    for i in range(count):
+        m = data.Metrics(i)
+        m.ServerId(), m.CpuUsage(), m.MemoryUsage(), m.DiskUsage(), m.Timestamp(), m.TimestampNs()
+    return count
+
+
+def access_flatbuffers_columnar(data: dict) -> int:
+    server_ids = data["server_ids"]
+    for i, *values in zip(data["server_index"].tolist(), data["cpu_usage"].tolist(), data["memory_usage"].tolist(),
+                          data["disk_usage"].tolist(), data["timestamp_ns"].tolist()):
+        server_ids[i]
+    return len(data["server_index"])
+
+
+FORMATS = {
+    "json": (encode_json, decode_json, access_json),
+    "ndjson": (encode_ndjson, decode_ndjson, access_flatbuffers_columnar),  # Decoded into the same columns.
+    "proto": (encode_protobuf, decode_protobuf, access_protobuf),
+    "flatbuf": (encode_flatbuffers, decode_flatbuffers, access_flatbuffers),
+    "flatcol": (encode_flatbuffers_columnar, deserialize_flatbuffers_columnar, access_flatbuffers_columnar)
+}
+
+
+def percentile(sorted_samples: list[int], q: float) -> float:
+    """Return the q-th percentile (0-100) of sorted samples, interpolating linearly between the closest ranks."""
+    position = (len(sorted_samples) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_samples) - 1)
+    return sorted_samples[lower] + (sorted_samples[upper] - sorted_samples[lower]) * (position - lower)
+
+
+def summarize(samples_ns: list[int]) -> dict[str, float]:
+    """Compute the summary statistics of a list of timings in nanoseconds."""
+    ordered = sorted(samples_ns)
+    return {
+        "min_ns": ordered[0],
+        "median_ns": percentile(ordered, 50),
+        "p95_ns": percentile(ordered, 95),
+        "p99_ns": percentile(ordered, 99),
+        "max_ns": ordered[-1],
+        "mean_ns": sum(ordered) / len(ordered)
+    }
+
+
+def measure(func: Callable[[], Any], warmup: int, repeat: int, max_seconds: float) -> list[int]:
+    """Time a function with `perf_counter_ns`.
+
+    The garbage collector is disabled while timing (as `timeit` does), so that a collection triggered by an earlier
+    run does not land in a later one.
+
+    Args:
+        func: The function to time.
+        warmup: Number of untimed runs before measuring.
+        repeat: Number of timed runs.
+        max_seconds: Stop repeating once the timed runs took this long in total (at least one run is always timed).
+
+    Returns:
+        The duration of every timed run in nanoseconds.
+
+    """
+    for _ in range(warmup):
+        func()
+    samples = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        deadline = time.perf_counter_ns() + int(max_seconds * 1e9)
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            func()
+            samples.append(time.perf_counter_ns() - start)
+            if time.perf_counter_ns() > deadline:
+                break
+    finally:
+        if gc_enabled:
+            gc.enable()
+        gc.collect()
+    return samples
+
+
+def rss_bytes() -> int:
+    """Return the resident set size of the process (0 where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as f_statm:
+            return int(f_statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return 0
+
+
+def max_rss_bytes() -> int:
+    """Return the peak resident set size of the process so far."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024  # Bytes on macOS, KiB elsewhere.
+
+
+def measure_memory(func: Callable[[], Any]) -> dict[str, int]:
+    """Measure the memory allocated by one run of a function.
+
+    The function runs twice: once with tracemalloc, which counts the Python (and NumPy) allocations exactly, and once
+    without it, for the resident set size, which also includes what tracemalloc does not see (allocator overhead and
+    C libraries, such as the arena of the decoded protobuf messages) but is only as precise as the pages the allocator
+    maps and returns: memory freed by an earlier run is reused without growing it.
+
+    Args:
+        func: The function to measure.
+
+    Returns:
+        "peak_bytes": the largest amount of memory allocated during the run (tracemalloc),
+        "retained_bytes": the memory still allocated once the run returned, i.e. the size of its result (tracemalloc),
+        "rss_bytes": the growth of the resident set size while the result is alive (steady state),
+        "max_rss_bytes": the growth of the peak resident set size of the process (0 if the run stayed below an earlier
+        peak).
+
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = func()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    gc.collect()
+    rss_before, max_rss_before = rss_bytes(), max_rss_bytes()
+    result = func()
+    usage = {"peak_bytes": peak - baseline, "retained_bytes": retained - baseline,
+             "rss_bytes": rss_bytes() - rss_before, "max_rss_bytes": max_rss_bytes() - max_rss_before}
+    del result
+    gc.collect()
+    return usage
+
+
+def measure_representations(rows: int, seed: int) -> list[dict[str, Any]]:
+    """Measure how much memory each in-memory representation of a batch needs (see REPRESENTATIONS).
+
+    Args:
+        rows: Number of samples of the batch.
+        seed: Seed of the data generator.
+
+    Returns:
+        One result per representation, with the memory it retains in bytes and in bytes per sample.
+
+    """
+    results = []
+    for name, expand in REPRESENTATIONS.items():
+        def build():
+            metrics = next(generate_metric_batches(rows, rows, seed=seed))
+            return metrics if expand is None else expand(metrics)
+        usage = measure_memory(build)
+        result = {"representation": name, "rows": rows, **usage,
+                  "bytes_per_sample": usage["retained_bytes"] / rows}
+        results.append(result)
+        logger.info("%-8s %9d rows: %.1f bytes per sample (%.1f MiB, peak %.1f MiB while building).", name, rows,
+                    result["bytes_per_sample"], usage["retained_bytes"] / 2 ** 20, usage["peak_bytes"] / 2 ** 20)
+    return results
+
+
+def measure_codecs(
+        rows: int,
+        formats: list[str],
+        codecs: list[str],
+        seed: int,
+        schema_version: int,
+        warmup: int,
+        repeat: int,
+        max_seconds: float
+) -> dict[str, dict[str, dict[str, float]]]:
+    """Compare the at-rest codecs of the server (see compression.py) on every format.
+
+    The payload is encoded in records of CODEC_BATCH_ROWS samples, and every record is compressed on its own, as the
+    segment logs do. Every codec compresses the same records.
+
+    Args:
+        rows: Number of samples of the payload.
+        formats: Formats to compare (keys of FORMATS).
+        codecs: Codecs, with an optional level (e.g. "zlib:1").
+        seed: Seed of the data generator.
+        schema_version: Schema version of the row formats.
+        warmup: Number of untimed runs per measurement.
+        repeat: Maximum number of timed runs per measurement.
+        max_seconds: Time budget per measurement.
+
+    Returns:
+        A dictionary mapping each format and codec to the uncompressed size ("raw_bytes"), the compressed size
+        ("bytes"), the compression ratio, and the median compression and decompression times of all the records, in
+        seconds.
+
+    """
+    batches = list(generate_metric_batches(rows, min(rows, CODEC_BATCH_ROWS), seed=seed))
+    results = {}
+    for fmt in formats:
+        encode = FORMATS[fmt][0]
+        records = [encode(batch, schema_version) for batch in batches]
+        raw_bytes = sum(len(record) for record in records)
+        results[fmt] = {}
+        for spec in codecs:
+            codec, level = parse_codec(spec)
+            compressed = [compress(codec, record, level) for record in records]
+            size = sum(len(record) for record in compressed)
+            compress_ns = summarize(measure(lambda: [compress(codec, record, level) for record in records], warmup,
+                                            repeat, max_seconds))["median_ns"]
+            decompress_ns = summarize(measure(lambda: [decompress(codec, record) for record in compressed], warmup,
+                                              repeat, max_seconds))["median_ns"]
+            result = results[fmt][spec] = {"raw_bytes": raw_bytes, "bytes": size,
+                                           "ratio": raw_bytes / size if size else 0.0,
+                                           "compress_time": compress_ns / 1e9, "decompress_time": decompress_ns / 1e9}
+            logger.info("%-8s %-7s %9d rows: %d -> %d bytes (x%.2f), compression %.3f ms, decompression %.3f ms.",
+                        fmt, spec, rows, raw_bytes, size, result["ratio"], compress_ns / 1e6, decompress_ns / 1e6)
+    return results
+
+
+def measure_json_layouts(
+        rows: int,
+        seed: int,
+        workers: int,
+        warmup: int,
+        repeat: int,
+        max_seconds: float
+) -> dict[str, Any]:
+    """Compare reading the same samples as one JSON array and as newline-delimited JSON (NDJSON).
+
+    The samples are written in both layouts (schema v2) to temporary files, then counted:
+    * "json_load" — `json.load` of the array: the whole text and every dict are in memory at once;
+    * "ndjson_stream" — `codec.iter_ndjson`, one block of lines at a time, parsed into columns and dropped;
+    * "ndjson_parallel" — `codec.iter_ndjson_parallel`, line ranges parsed into columns by `workers` processes.
+    Every mode is timed, then run again for its memory (see `measure_memory`; the peak is that of this process only:
+    every worker also holds one range at a time).
+
+    Args:
+        rows: Number of samples.
+        seed: Seed of the data generator.
+        workers: Worker processes of the parallel mode (0 to skip it).
+        warmup: Number of untimed runs per measurement.
+        repeat: Maximum number of timed runs per measurement.
+        max_seconds: Time budget per measurement.
+
+    Returns:
+        The number of samples ("rows"), the size of both files ("array_bytes", "ndjson_bytes") and, for every mode, its
+        median duration in seconds ("time"), peak memory ("peak_bytes") and the number of rows read ("rows").
+
+    """
+    def json_load(path: str) -> int:
+        with open(path, "rb") as f_json:
+            return len(json.load(f_json))
+
+    def ndjson_stream(path: str) -> int:
+        with open(path, "rb") as f_ndjson:
+            return sum(len(block["server_index"]) for block in iter_ndjson(f_ndjson, columns=True))
+
+    def ndjson_parallel(path: str, executor: Executor) -> int:
+        return sum(len(columns["server_index"])
+                   for columns in iter_ndjson_parallel(path, executor, max_pending=2 * workers))
+
+    with tempfile.TemporaryDirectory() as directory:
+        array_path, ndjson_path = os.path.join(directory, "metrics.json"), os.path.join(directory, "metrics.ndjson")
+        metrics = next(generate_metric_batches(rows, rows, seed=seed))
+        with open(array_path, "wb") as f_json:
+            f_json.write(encode_json(metrics, 2))
+        with open(ndjson_path, "wb") as f_ndjson:
+            f_ndjson.write(encode_ndjson(metrics, 2))
+        del metrics
+        layouts = {"rows": rows, "array_bytes": os.path.getsize(array_path),
+                   "ndjson_bytes": os.path.getsize(ndjson_path)}
+        modes = {"json_load": lambda: json_load(array_path), "ndjson_stream": lambda: ndjson_stream(ndjson_path)}
+        executor = None
+        if workers > 0:
+            executor = ProcessPoolExecutor(workers)
+            list(executor.map(abs, range(workers)))  # Start the workers before timing.
+            modes["ndjson_parallel"] = lambda: ndjson_parallel(ndjson_path, executor)
+        try:
+            for mode, func in modes.items():
+                median_ns = summarize(measure(func, warmup, repeat, max_seconds))["median_ns"]
+                layouts[mode] = {"time": median_ns / 1e9, "peak_bytes": measure_memory(func)["peak_bytes"],
+                                 "rows": func()}
+                logger.info("JSON layouts, %s: %d rows in %.4f s, peak memory %.1f MiB.", mode, layouts[mode]["rows"],
+                            layouts[mode]["time"], layouts[mode]["peak_bytes"] / 2 ** 20)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    return layouts
+
+
+def run_benchmark(
+        sizes: list[int],
+        formats: list[str],
+        warmup: int,
+        repeat: int,
+        max_seconds: float,
+        input_type: str,
+        seed: int,
+        schema_version: int = 1,
+        executors: Optional[dict[int, Executor]] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        memory: bool = True
+) -> list[dict[str, Any]]:
+    """Run encode, decode and access benchmarks for every format and payload size.
+
+    Once a single run of a format takes longer than `max_seconds`, larger sizes are skipped for that format.
+
+    With `memory`, the encode and decode results also hold the memory used by one run (see `measure_memory`) and the
+    peak and retained bytes per sample.
+
+    With `executors`, the payload is also encoded into a multi-chunk container by each pool ("encode_parallel", see
+    `serializers.serialize_chunked`); the speedup of every pool over the single-process "encode" is reported.
+
+    Args:
+        sizes: Payload sizes (number of samples).
+        formats: Formats to benchmark (keys of FORMATS).
+        warmup: Number of untimed runs per measurement.
+        repeat: Maximum number of timed runs per measurement.
+        max_seconds: Time budget per measurement.
+        input_type: "columns" to encode MetricColumns batches, "dicts" to encode lists of dicts.
+        seed: Seed of the data generator.
+        schema_version: Schema version of the row formats (1: ISO 8601 timestamp strings, 2: epoch nanoseconds).
+        executors: Worker pools by number of workers, already started.
+        chunk_size: Samples per chunk of the parallel encoding.
+        memory: Also measure the memory of the encode and decode operations.
+
+    Returns:
+        One result per (format, operation, size), with the raw samples and their summary.
+
+    """
+    results = []
+    skipped = set()
+    for rows in sizes:
+        metrics = next(generate_metric_batches(rows, rows, seed=seed))
+        if input_type == "dicts":
+            metrics = to_dicts(metrics)
+        for fmt in formats:
+            if fmt in skipped:
+                continue
+            encode, decode, access = FORMATS[fmt]
+            buf = encode(metrics, schema_version)
+            for operation, func in (("encode", lambda: encode(metrics, schema_version)),
+                                    ("decode", lambda: decode(buf)),
+                                    ("access", lambda: access(decode(buf)))):
+                samples = measure(func, warmup, repeat, max_seconds)
+                result = {"format": fmt, "operation": operation, "rows": rows, "bytes": len(buf),
+                          "samples_ns": samples, **summarize(samples)}
+                results.append(result)
+                logger.info("%-8s %-6s %9d rows: median %.3f ms, p95 %.3f ms, p99 %.3f ms (%d runs).", fmt,
+                            operation, rows, result["median_ns"] / 1e6, result["p95_ns"] / 1e6,
+                            result["p99_ns"] / 1e6, len(samples))
+                if memory and operation != "access":  # Access retains nothing beyond what decode does.
+                    result.update(measure_memory(func))
+                    result["peak_bytes_per_sample"] = result["peak_bytes"] / rows
+                    result["retained_bytes_per_sample"] = result["retained_bytes"] / rows
+                    logger.info("%-8s %-6s %9d rows: peak %.1f, retained %.1f bytes per sample, RSS %+.1f MiB.", fmt,
+                                operation, rows, result["peak_bytes_per_sample"],
+                                result["retained_bytes_per_sample"], result["rss_bytes"] / 2 ** 20)
+                if result["min_ns"] > max_seconds * 1e9 and fmt not in skipped:
+                    logger.info("Time budget exceeded, skipping %s for payloads larger than %d rows.", fmt, rows)
+                    skipped.add(fmt)
+                if operation == "encode":
+                    results.extend(measure_parallel_encode(metrics, fmt, schema_version, executors or {}, chunk_size,
+                                                           result, warmup, repeat, max_seconds))
+        if len(skipped) == len(formats):
+            break
+    return results
+
+
+def measure_parallel_encode(
+        metrics,
+        fmt: str,
+        schema_version: int,
+        executors: dict[int, Executor],
+        chunk_size: int,
+        sequential: dict[str, Any],
+        warmup: int,
+        repeat: int,
+        max_seconds: float
+) -> list[dict[str, Any]]:
+    """Time the chunked encoding of a payload with every worker pool, and its speedup over the sequential encoding.
+
+    Args:
+        metrics: The payload.
+        fmt: The format.
+        schema_version: Schema version of the row formats.
+        executors: Worker pools by number of workers.
+        chunk_size: Samples per chunk.
+        sequential: The "encode" result of the same payload and format.
+        warmup: Number of untimed runs per measurement.
+        repeat: Maximum number of timed runs per measurement.
+        max_seconds: Time budget per measurement.
+
+    Returns:
+        One "encode_parallel" result per pool.
+
+    """
+    results = []
+    for workers, executor in sorted(executors.items()):
+        buf = serialize_chunked(metrics, fmt, schema_version, chunk_size=chunk_size, executor=executor)
+        samples = measure(lambda: serialize_chunked(metrics, fmt, schema_version, chunk_size=chunk_size,
+                                                    executor=executor), warmup, repeat, max_seconds)
+        result = {"format": fmt, "operation": "encode_parallel", "rows": len(metrics), "bytes": len(buf),
+                  "workers": workers, "chunk_size": chunk_size, "samples_ns": samples, **summarize(samples)}
+        result["speedup"] = sequential["median_ns"] / result["median_ns"]
+        results.append(result)
+        logger.info("%-8s %-6s %9d rows: median %.3f ms with %d workers (%d chunks), speedup %.2fx.", fmt, "encode",
+                    len(metrics), result["median_ns"] / 1e6, workers, -(-len(metrics) // chunk_size),
+                    result["speedup"])
+    return results
+
+
+def environment() -> dict[str, Any]:
+    """Describe the environment the benchmark runs in."""
+    import grpc
+    import flatbuffers
+    import numpy as np
+    import google.protobuf
+    return {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "grpc": grpc.__version__,
+        "protobuf": google.protobuf.__version__,
+        "flatbuffers": getattr(flatbuffers, "__version__", "unknown"),
+        "numpy": np.__version__
+    }
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Encode/decode/access benchmark of the metric serialization formats.")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="Comma-separated payload sizes in rows (default: 1e2 to 1e7).")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="Comma-separated formats to benchmark.")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed runs before each measurement.")
+    parser.add_argument("--repeat", type=int, default=20, help="Maximum timed runs per measurement.")
+    parser.add_argument("--max-seconds", type=float, default=10.0,
+                        help="Time budget per measurement; formats slower than this skip larger sizes.")
+    parser.add_argument("--input", choices=("columns", "dicts"), default="columns",
+                        help="Encode columnar batches or lists of dicts.")
+    parser.add_argument("--schema-version", type=int, choices=(1, 2), default=1,
+                        help="Schema version of the row formats (2: binary timestamps).")
+    parser.add_argument("--workers", default=str(os.cpu_count() or 1),
+                        help="Comma-separated worker counts of the parallel chunked encoding (default: the number of "
+                             "CPUs; empty or 0 to skip it).")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Samples per chunk of the parallel encoding.")
+    parser.add_argument("--codecs", default=",".join(COMPARED_CODECS),
+                        help="Comma-separated at-rest codecs compared on every format (empty to skip).")
+    parser.add_argument("--codec-rows", type=int, default=20_000, help="Samples of the codec comparison.")
+    parser.add_argument("--json-layout-rows", type=int, default=JSON_LAYOUT_ROWS,
+                        help="Samples of the JSON array vs NDJSON comparison (0 to skip it).")
+    parser.add_argument("--ndjson-workers", type=int,
+                        default=int(os.getenv("NDJSON_WORKERS", str(os.cpu_count() or 1))),
+                        help="Worker processes of the parallel NDJSON reader (default: NDJSON_WORKERS, or the number "
+                             "of CPUs; 0 to skip it).")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="Skip the memory measurements (tracemalloc and RSS).")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the data generator.")
+    parser.add_argument("--output", default=None,
+                        help="Output JSON file (default: RESULTS_PATH/benchmark.json, or ./benchmark.json).")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """Run the benchmark and write the results as JSON."""
+    args = parse_args(argv)
+    formats = args.formats.split(",")
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown formats: {', '.join(sorted(unknown))}")
+    output = args.output or os.path.join(os.getenv("RESULTS_PATH", "."), "benchmark.json")
+
+    workers = [int(n) for n in args.workers.split(",") if n and int(n) > 0]
+    executors = {n: ProcessPoolExecutor(n) for n in workers}
+    try:
+        for n, executor in executors.items():
+            list(executor.map(abs, range(n)))  # Start the workers before timing.
+        started = time.time()
+        sizes = [int(float(size)) for size in args.sizes.split(",")]
+        results = run_benchmark(sizes, formats, args.warmup, args.repeat, args.max_seconds, args.input, args.seed,
+                                args.schema_version, executors, args.chunk_size, args.memory)
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+    codecs = [spec for spec in args.codecs.split(",") if spec]
+    codec_results = measure_codecs(args.codec_rows, formats, codecs, args.seed, args.schema_version, args.warmup,
+                                   args.repeat, args.max_seconds) if codecs else {}
+    json_layouts = measure_json_layouts(args.json_layout_rows, args.seed, args.ndjson_workers, args.warmup,
+                                        args.repeat, args.max_seconds) if args.json_layout_rows > 0 else {}
+    # One size only, large enough for the fixed costs (list headers, the server ID dictionary) to be negligible.
+    representations = measure_representations(min(max(sizes), REPRESENTATION_ROWS), args.seed) if args.memory else []
+    report = {
+        "started": started,
+        "duration_s": time.time() - started,
+        "settings": {"warmup": args.warmup, "repeat": args.repeat, "max_seconds": args.max_seconds,
+                     "input": args.input, "seed": args.seed, "schema_version": args.schema_version,
+                     "workers": workers, "chunk_size": args.chunk_size, "memory": args.memory, "codecs": codecs,
+                     "codec_rows": args.codec_rows, "json_layout_rows": args.json_layout_rows,
+                     "ndjson_workers": args.ndjson_workers},
+        "environment": environment(),
+        "results": results,
+        "representations": representations,
+        "codecs": codec_results,
+        "json_layouts": json_layouts
+    }
+    with open(output, "w") as f_output:
+        json.dump(report, f_output)
+    logger.info("Benchmark results saved to %s", output)
+
+
+if __name__ == "__main__":
+    main()
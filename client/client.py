@@ -2,13 +2,20 @@ import os
 import logging
 import time
 import json
-from typing import Union
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union, Iterator, Optional, Any
 
 import grpc
 
+from metrics_pb2 import MetricsRequest, MetricsResponse, ServerInfoRequest
 from metrics_pb2_grpc import MetricsServiceStub
-from data_generator import generate_metrics
-from serializers import serialize_json, serialize_protobuf, serialize_flatbuffers
+from codec import iter_container_chunks, CONTAINER_FORMATS
+from data_generator import generate_metric_chunks, generate_metric_batches, MetricColumns
+from serializers import serialize_json, serialize_protobuf, serialize_flatbuffers, serialize_flatbuffers_columnar, \
+    serialize_chunked, SCHEMA_VERSIONS, DEFAULT_CHUNK_SIZE
+from shm_ring import DEFAULT_RING_BYTES
+from shm_client import ShmRingClient
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,17 +27,48 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+SEND_METRICS_STREAM_METHOD = "/MetricsService/SendMetricsStream"
 
-def check_metrics(metrics: list[dict[str, Union[str, float]]]) -> None:
+# Compression of the requests on the wire, selected by GRPC_COMPRESSION.
+GRPC_COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate
+}
+
+
+def grpc_compression_from_env() -> grpc.Compression:
+    """Return the compression of the requests selected by GRPC_COMPRESSION ("none" by default).
+
+    Raises:
+        ValueError: If GRPC_COMPRESSION is not one of the supported algorithms.
+
+    """
+    name = os.getenv("GRPC_COMPRESSION", "none")
+    if name not in GRPC_COMPRESSION:
+        raise ValueError(f"Unknown GRPC_COMPRESSION: {name} (expected one of: {', '.join(GRPC_COMPRESSION)})")
+    return GRPC_COMPRESSION[name]
+
+
+def check_metrics(metrics: Union[list[dict[str, Union[str, float]]], MetricColumns]) -> None:
     """Validate the structure and content of generated metrics.
 
     Args:
-        metrics: List of metrics to validate.
+        metrics: List of metrics or a columnar batch to validate.
 
     Raises:
-        ValueError: If metrics are empty, not a list, or missing required fields.
+        ValueError: If metrics are empty, not a list, or missing required fields (for a columnar batch: if it is empty,
+            its columns differ in length, or it refers to unknown server IDs).
 
     """
+    if isinstance(metrics, MetricColumns):
+        lengths = {len(column) for column in (metrics.server_index, metrics.cpu_usage, metrics.memory_usage,
+                                              metrics.disk_usage, metrics.timestamp_ns)}
+        if lengths != {len(metrics)} or not len(metrics) or int(metrics.server_index.max()) >= len(metrics.server_ids):
+            logger.error("Generated metric batch is empty or invalid.")
+            raise ValueError("Metric batch must be non-empty, with columns of equal length.")
+        logger.info("Metrics validated successfully.")
+        return
     if not metrics or not isinstance(metrics, list):
         logger.error("Generated metrics are empty or invalid.")
         raise ValueError("Metrics must be a non-empty list.")
@@ -42,81 +80,388 @@ def check_metrics(metrics: list[dict[str, Union[str, float]]]) -> None:
     return
 
 
+def server_target(server_host: str) -> str:
+    """Return the address of the server: the Unix socket SERVER_SOCKET if it is set, or port 50051 of the host."""
+    socket_path = os.getenv("SERVER_SOCKET")
+    return f"unix:{socket_path}" if socket_path else f"{server_host}:50051"
+
+
+def connect(
+        server_host: str,
+        options: Optional[list[tuple[str, Any]]] = None,
+        target: Optional[str] = None
+) -> Optional[grpc.Channel]:
+    """Open a gRPC channel to the server and wait until it is ready.
+
+    Calls on the channel are compressed according to GRPC_COMPRESSION ("none" by default, "gzip" or "deflate").
+
+    Args:
+        server_host: Host name of the gRPC server (port 50051 is used).
+        options: gRPC channel options.
+        target: The address to connect to instead (e.g. "unix:/path/to/socket"); see `server_target` by default.
+
+    Returns:
+        The ready channel, or None if the server does not respond within 10 seconds.
+
+    """
+    channel = grpc.insecure_channel(target or server_target(server_host), options,
+                                    compression=grpc_compression_from_env())
+    try:
+        grpc.channel_ready_future(channel).result(
+            timeout=10)  # `grpc.channel_ready_future` returns a Future object that completes when the channel is ready. `result(timeout=10)` blocks execution for up to 10 seconds, waiting for the server to be ready.
+        logger.info("gRPC server is ready.")  # If the server responds within 10 seconds.
+    except grpc.FutureTimeoutError:  # If the server does not respond within 10 seconds, a FutureTimeoutError exception is raised.
+        logger.error("gRPC server is not responding.")
+        channel.close()
+        return None
+    return channel
+
+
+def negotiate_schema_version(channel: grpc.Channel) -> int:
+    """Select the schema version of the requests sent on a channel.
+
+    SCHEMA_VERSION forces a version ("1" or "2"). With "auto" (the default), the highest version supported by both the
+    client and the server is used; servers that predate GetServerInfo only accept v1.
+
+    Args:
+        channel: A ready channel to the server.
+
+    Returns:
+        The schema version.
+
+    Raises:
+        ValueError: If SCHEMA_VERSION is not "auto" or a version supported by the client, or if the client and the
+            server have no version in common.
+
+    """
+    setting = os.getenv("SCHEMA_VERSION", "auto")
+    if setting != "auto":
+        if int(setting) not in SCHEMA_VERSIONS:
+            raise ValueError(f"Unsupported SCHEMA_VERSION: {setting}")
+        return int(setting)
+    try:
+        server_versions = MetricsServiceStub(channel).GetServerInfo(ServerInfoRequest(), timeout=5).schema_versions
+    except grpc.RpcError as e:
+        logger.warning("Server info not available (%s), falling back to schema v1.", e.code().name)
+        return 1
+    common = set(SCHEMA_VERSIONS) & set(server_versions)
+    if not common:
+        raise ValueError(f"No common schema version (client: {SCHEMA_VERSIONS}, server: {tuple(server_versions)})")
+    logger.info("Using schema v%d (server supports %s).", max(common), tuple(server_versions))
+    return max(common)
+
+
+def iter_generated_metrics(
+        count: int,
+        chunk_size: int
+) -> Iterator[Union[list[dict[str, Union[str, float]]], MetricColumns]]:
+    """Generate metrics in chunks with the generator selected by the GENERATOR environment variable.
+
+    "random" (the default) yields lists of dicts from `generate_metric_chunks`. "numpy" yields columnar batches from
+    `generate_metric_batches`, configured with SERVERS_COUNT (100 by default) and GENERATOR_SEED.
+
+    Args:
+        count: The total number of metrics.
+        chunk_size: The maximum number of metrics per chunk.
+
+    Yields:
+        Chunks of metrics.
+
+    """
+    generator = os.getenv("GENERATOR", "random")
+    if generator == "numpy":
+        seed = os.getenv("GENERATOR_SEED")
+        yield from generate_metric_batches(count, chunk_size, servers=int(os.getenv("SERVERS_COUNT", "100")),
+                                           seed=int(seed) if seed else None)
+    elif generator == "random":
+        yield from generate_metric_chunks(count, chunk_size)
+    else:
+        raise ValueError(f"Unknown GENERATOR: {generator}")
+
+
+def iter_metric_requests(count: int, chunk_size: int, schema_version: int = 1) -> Iterator[MetricsRequest]:
+    """Generate, validate and serialize metrics chunk by chunk for a client-streaming call.
+
+    The iterator is consumed by gRPC while the stream is being sent, so only one chunk is held in memory at a time.
+
+    Args:
+        count: The total number of metrics to send.
+        chunk_size: The number of metrics per MetricsRequest chunk.
+        schema_version: The schema version of the requests.
+
+    Yields:
+        Protobuf MetricsRequest objects with at most `chunk_size` metrics each.
+
+    """
+    for chunk in iter_generated_metrics(count, chunk_size):
+        check_metrics(chunk)
+        yield serialize_protobuf(chunk, schema_version, timestamp_delta())
+
+
+def run_stream(server_host: str, count: int, chunk_size: int) -> None:
+    """Send metrics to the gRPC server through the client-streaming SendMetricsStream call.
+
+    Serialization times are not measured in this mode: they are measured on the whole payload in the unary mode.
+
+    Args:
+        server_host: Host name of the gRPC server.
+        count: The total number of metrics to send.
+        chunk_size: The number of metrics per chunk.
+
+    """
+    logger.info("Streaming %d metrics in chunks of %d.", count, chunk_size)
+    channel = connect(server_host)
+    if channel is None:
+        return
+
+    with channel:
+        stub = MetricsServiceStub(channel)
+        try:
+            schema_version = negotiate_schema_version(channel)
+            response = stub.SendMetricsStream(iter_metric_requests(count, chunk_size, schema_version))
+            logger.info("Server response: %s (%d metrics in %d chunks)", response.message, response.metrics_count,
+                        response.chunks_count)
+        except (grpc.RpcError, ValueError) as e:
+            logger.error("gRPC call failed: %s", e)
+            return
+
+
+def send_container(channel: grpc.Channel, container: bytes) -> MetricsResponse:
+    """Send a Protobuf multi-chunk container through SendMetricsStream, one stream message per chunk.
+
+    The chunks are already serialized MetricsRequest messages, so they are sent as they are: the call is made without
+    a request serializer, and nothing is parsed or re-encoded on the client.
+
+    Args:
+        channel: A ready channel to the server.
+        container: A container produced by `serialize_chunked(..., "proto", ...)`.
+
+    Returns:
+        The response of the server.
+
+    Raises:
+        grpc.RpcError: If the call fails.
+
+    """
+    send = channel.stream_unary(SEND_METRICS_STREAM_METHOD, request_serializer=None,
+                                response_deserializer=MetricsResponse.FromString)
+    return send(bytes(chunk) for chunk in iter_container_chunks(container, "proto"))
+
+
+def measure_parallel_serialization(
+        metrics: Union[list[dict[str, Union[str, float]]], MetricColumns],
+        schema_version: int,
+        delta: bool,
+        workers: int,
+        chunk_size: int
+) -> tuple[dict[str, Any], bytes]:
+    """Serialize the payload into multi-chunk containers of every format with a pool of worker processes.
+
+    The workers are spawned rather than forked, since the gRPC channel of the process is already open (gRPC does not
+    support forking while it has active threads). The pool is started before timing, so the times only cover
+    splitting, shipping the chunks to the workers, encoding them and joining the results.
+
+    Args:
+        metrics: The payload.
+        schema_version: The schema version of the row formats.
+        delta: Delta-encode the v2 timestamps of every chunk.
+        workers: Number of worker processes.
+        chunk_size: Samples per chunk.
+
+    Returns:
+        The settings and serialization time of every format, and the Protobuf container (to be sent).
+
+    """
+    times = {"workers": workers, "chunk_size": chunk_size}
+    containers = {}
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        list(executor.map(abs, range(workers)))  # Start the workers.
+        for fmt in CONTAINER_FORMATS:
+            start = time.time()
+            containers[fmt] = serialize_chunked(metrics, fmt, schema_version, delta, chunk_size, executor)
+            times[f"{fmt}_ser_time"] = time.time() - start
+            logger.info("Parallel %s serialization (%d workers, %d chunks) took %.4f seconds.", fmt, workers,
+                        -(-len(metrics) // chunk_size), times[f"{fmt}_ser_time"])
+    return times, containers["proto"]
+
+
+def send_shm(
+        socket_path: str,
+        metrics: Union[list[dict[str, Union[str, float]]], MetricColumns],
+        chunk_size: int,
+        ring_bytes: int = DEFAULT_RING_BYTES
+) -> int:
+    """Send metrics to a server on the same host through the shared-memory transport (see shm_client.py).
+
+    The payload is encoded into columnar FlatBuffers batches of `chunk_size` samples, which are written into the ring
+    one after the other while the server saves the previous ones.
+
+    Args:
+        socket_path: The Unix socket of the shared-memory transport of the server.
+        metrics: The payload.
+        chunk_size: Samples per batch.
+        ring_bytes: Size of the ring.
+
+    Returns:
+        The number of metrics saved by the server.
+
+    Raises:
+        OSError: If the server cannot be reached.
+        RuntimeError: If a batch was not saved by the server.
+
+    """
+    container = serialize_chunked(metrics, "flatcol", chunk_size=chunk_size)
+    with ShmRingClient(socket_path, ring_bytes) as ring:
+        for batch in iter_container_chunks(container, "flatcol"):
+            ring.send(batch)
+        return ring.flush()
+
+
+def timestamp_delta() -> bool:
+    """Return whether v2 timestamps are delta-encoded against the first one of each request (TIMESTAMP_DELTA)."""
+    return os.getenv("TIMESTAMP_DELTA", "1") not in ("0", "false", "no")
+
+
 def run() -> None:
     """Execute the client process: generate metrics, serialize them, and send to the gRPC server.
 
     This function handles metric generation, serialization timing, saving results, and communication
-    with a gRPC server.
+    with a gRPC server. The number of metrics is set by METRICS_COUNT (1000 by default). If STREAM_CHUNK_SIZE is set to
+    a positive number, the metrics are sent through the client-streaming call in chunks of that size instead. If
+    LOAD_DURATION_S is set to a positive number, a load test is run instead (see load_generator.py), and if
+    COLLECT_RATE is set to a positive number, the client runs as a long-lived collector (see collector.py). The
+    payload is serialized in the schema version selected by `negotiate_schema_version`.
+
+    If ENCODE_WORKERS is set to a positive number, the payload is also serialized into multi-chunk containers of
+    ENCODE_CHUNK_SIZE samples by that many worker processes (timed next to the single-process times), and the Protobuf
+    container is sent chunk by chunk through SendMetricsStream instead of SendMetrics.
+
+    gRPC calls go over the Unix socket SERVER_SOCKET if it is set. If SHM_SOCKET is set, the payload is sent through
+    the shared-memory transport of a server on the same host instead, in batches of SHM_CHUNK_SIZE samples, through a
+    ring of SHM_RING_BYTES bytes (see `send_shm`).
 
     Raises:
         Exception: If any step (metric generation, serialization, or gRPC communication) fails.
 
     """
     server_host = os.getenv("SERVER_HOST")
-    logger.info("Starting client, connecting to %s:50051", server_host)
+    metrics_count = int(os.getenv("METRICS_COUNT", "1000"))
+    stream_chunk_size = int(os.getenv("STREAM_CHUNK_SIZE", "0"))
+    logger.info("Starting client, connecting to %s", server_target(server_host))
+
+    if stream_chunk_size > 0:
+        run_stream(server_host, metrics_count, stream_chunk_size)
+        return
+
+    if float(os.getenv("LOAD_DURATION_S", "0")) > 0:
+        from load_generator import parse_args, run_load_test  # load_generator imports this module.
+        args = parse_args([])  # Settings come from the LOAD_* environment variables.
+        run_load_test(server_host, args.channels, args.concurrency, args.qps, args.batch_size, args.duration,
+                      args.timeout, args.output)
+        return
+
+    if float(os.getenv("COLLECT_RATE", "0")) > 0:
+        from collector import parse_args, run_collector  # collector imports this module.
+        args = parse_args([])  # Settings come from the COLLECT_* and SPILL_* environment variables.
+        run_collector(server_host, args.rate, args.duration, args.min_batch, args.max_batch, args.max_delay_ms,
+                      args.target_latency_ms, args.spill_path, args.spill_max_bytes, output=args.output)
+        return
 
     # Data generation and validation.
     try:
-        metrics = generate_metrics(1000)
+        metrics = next(iter_generated_metrics(metrics_count, metrics_count), [])
         check_metrics(metrics)
     except Exception as e:
         logger.error("Failed to generate metrics: %s", e)
         return
 
-    # Serialization
-    try:
-        start = time.time()
-        json_data = serialize_json(metrics)
-        json_ser_time = time.time() - start
-        logger.info("JSON serialization took %.4f seconds.", json_ser_time)
-
-        start = time.time()
-        proto_data = serialize_protobuf(metrics)
-        proto_ser_time = time.time() - start
-        logger.info("Protobuf serialization took %.4f seconds.", proto_ser_time)
-
-        start = time.time()
-        flat_data = serialize_flatbuffers(metrics)
-        flat_ser_time = time.time() - start
-        logger.info("FlatBuffers serialization took %.4f seconds.", flat_ser_time)
-
-        serialize_times = {
-            "json_ser_time": json_ser_time,
-            "proto_ser_time": proto_ser_time,
-            "flat_ser_time": flat_ser_time
-        }
-
-        results_path = os.getenv("RESULTS_PATH")
-        os.makedirs(results_path, exist_ok=True)
-        try:
-            with open(f"{results_path}/serialize_times.json", "w") as f_serialize_times:
-                json.dump(serialize_times, f_serialize_times)
-            logger.info("Serialization times saved to serialize_times.json")
-        except Exception as e:
-            logger.error("Failed to save serialization times: %s", e)
-    except Exception as e:
-        logger.error("Serialization failed: %s", e)
-        return
-
-    # Server availability check and data transmission.
-    channel = grpc.insecure_channel(f"{server_host}:50051")
-    try:
-        grpc.channel_ready_future(channel).result(
-            timeout=10)  # `grpc.channel_ready_future` returns a Future object that completes when the channel is ready. `result(timeout=10)` blocks execution for up to 10 seconds, waiting for the server to be ready.
-        logger.info("gRPC server is ready.")  # If the server responds within 10 seconds.
-    except grpc.FutureTimeoutError:  # If the server does not respond within 10 seconds, a FutureTimeoutError exception is raised.
-        logger.error("gRPC server is not responding.")
+    # Server availability check and schema version negotiation: the payload is serialized in the version the server
+    # accepts.
+    channel = connect(server_host)
+    if channel is None:
         return
 
     with channel:
+        try:
+            schema_version = negotiate_schema_version(channel)
+        except ValueError as e:
+            logger.error("Schema negotiation failed: %s", e)
+            return
+        delta = timestamp_delta()
+
+        # Serialization
+        try:
+            start = time.time()
+            json_data = serialize_json(metrics, schema_version)
+            json_ser_time = time.time() - start
+            logger.info("JSON serialization took %.4f seconds.", json_ser_time)
+
+            start = time.time()
+            proto_data = serialize_protobuf(metrics, schema_version, delta)
+            proto_ser_time = time.time() - start
+            logger.info("Protobuf serialization took %.4f seconds.", proto_ser_time)
+
+            start = time.time()
+            flat_data = serialize_flatbuffers(metrics, schema_version, delta)
+            flat_ser_time = time.time() - start
+            logger.info("FlatBuffers serialization took %.4f seconds.", flat_ser_time)
+
+            start = time.time()
+            flatcol_data = serialize_flatbuffers_columnar(metrics)
+            flatcol_ser_time = time.time() - start
+            logger.info("Columnar FlatBuffers serialization took %.4f seconds.", flatcol_ser_time)
+
+            serialize_times = {
+                "json_ser_time": json_ser_time,
+                "proto_ser_time": proto_ser_time,
+                "flat_ser_time": flat_ser_time,
+                "flatcol_ser_time": flatcol_ser_time,
+                "schema_version": schema_version,
+                "metrics_count": len(metrics)
+            }
+
+            proto_container = None
+            encode_workers = int(os.getenv("ENCODE_WORKERS", "0"))
+            if encode_workers > 0:
+                serialize_times["parallel"], proto_container = measure_parallel_serialization(
+                    metrics, schema_version, delta, encode_workers,
+                    int(os.getenv("ENCODE_CHUNK_SIZE", str(DEFAULT_CHUNK_SIZE))))
+
+            results_path = os.getenv("RESULTS_PATH")
+            os.makedirs(results_path, exist_ok=True)
+            try:
+                with open(f"{results_path}/serialize_times.json", "w") as f_serialize_times:
+                    json.dump(serialize_times, f_serialize_times)
+                logger.info("Serialization times saved to serialize_times.json")
+            except Exception as e:
+                logger.error("Failed to save serialization times: %s", e)
+        except Exception as e:
+            logger.error("Serialization failed: %s", e)
+            return
+
+        # Data transmission.
         stub = MetricsServiceStub(
             channel)  # Create a stub object — a client interface for calling RPC methods of the MetricsService. MetricsServiceStub is generated from metrics.proto and bound to the channel.
         try:
-            response = stub.SendMetrics(proto_data)  # Returns a MetricsResponse object with a message field.
-            logger.info("Server response: %s", response.message)
+            shm_socket = os.getenv("SHM_SOCKET")
+            if shm_socket:
+                start = time.time()
+                saved = send_shm(shm_socket, metrics, int(os.getenv("SHM_CHUNK_SIZE", str(DEFAULT_CHUNK_SIZE))),
+                                 int(os.getenv("SHM_RING_BYTES", str(DEFAULT_RING_BYTES))))
+                logger.info("Sent %d metrics through shared memory in %.4f seconds.", saved, time.time() - start)
+            elif proto_container is not None:
+                response = send_container(channel, proto_container)
+                logger.info("Server response: %s (%d metrics in %d chunks)", response.message, response.metrics_count,
+                            response.chunks_count)
+            else:
+                response = stub.SendMetrics(proto_data)  # Returns a MetricsResponse object with a message field.
+                logger.info("Server response: %s", response.message)
         except grpc.RpcError as e:  # Handle possible gRPC errors (e.g., server not responding or returning an error).
             logger.error("gRPC call failed: %s", e)
             return
+        except (OSError, RuntimeError, ValueError) as e:  # Shared-memory transport.
+            logger.error("Shared-memory transfer failed: %s", e)
+            return
 
 
 if __name__ == "__main__":
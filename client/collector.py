@@ -0,0 +1,458 @@
+import os
+import json
+import time
+import signal
+import logging
+import argparse
+import threading
+import collections
+from typing import Any, Optional
+
+import grpc
+
+from metrics_pb2 import MetricsResponse
+from client import server_target, negotiate_schema_version, timestamp_delta, grpc_compression_from_env
+from data_generator import generate_metric_batches, MetricColumns
+from serializers import serialize_protobuf
+
+logger = logging.getLogger(__name__)
+
+SEND_METRICS_METHOD = "/MetricsService/SendMetrics"
+# The channel stays open for the whole run: HTTP/2 pings keep it alive through idle periods and detect a dead server
+# without waiting for the next call (the server accepts pings every 10 seconds, see SERVER_OPTIONS in server.py).
+CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30_000),
+    ("grpc.keepalive_timeout_ms", 10_000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0)
+]
+# Errors after which a batch is kept and sent again later; after any other error (e.g. INVALID_ARGUMENT), sending it
+# again would fail the same way, so it is dropped.
+RETRYABLE_CODES = {grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.RESOURCE_EXHAUSTED,
+                   grpc.StatusCode.ABORTED, grpc.StatusCode.INTERNAL, grpc.StatusCode.UNKNOWN,
+                   grpc.StatusCode.CANCELLED}
+SPILL_SUFFIX = ".batch"
+
+
+class BatchSizeController:
+    """Adapt the batch size to the measured latency and throughput of the calls.
+
+    The size moves by a constant factor after every `window` calls, by hill climbing: it keeps moving in the same
+    direction while the throughput (rows per second of call time) improves, and turns back when it drops. Whenever the
+    mean latency of the window is above the target, the size shrinks, whatever the throughput.
+
+    """
+
+    def __init__(
+            self,
+            initial: int,
+            min_size: int,
+            max_size: int,
+            target_latency_s: float,
+            step: float = 1.25,
+            window: int = 4
+    ) -> None:
+        """Initialize the controller.
+
+        Args:
+            initial: The first batch size.
+            min_size: The smallest batch size.
+            max_size: The largest batch size.
+            target_latency_s: Latency above which the batch size shrinks.
+            step: Factor of every move.
+            window: Number of calls measured at every size.
+
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.batch_size = min(max(initial, min_size), max_size)
+        self.target_latency_s = target_latency_s
+        self.step = step
+        self.window = window
+        self.direction = 1
+        self.previous_throughput = None
+        self._rows = 0
+        self._seconds = 0.0
+        self._calls = 0
+
+    def update(self, rows: int, latency_s: float) -> None:
+        """Record a call of a full batch and move the batch size at the end of a window."""
+        self._rows += rows
+        self._seconds += latency_s
+        self._calls += 1
+        if self._calls < self.window:
+            return
+        throughput = self._rows / self._seconds
+        mean_latency = self._seconds / self._calls
+        self._rows, self._seconds, self._calls = 0, 0.0, 0
+        if mean_latency > self.target_latency_s:
+            self.direction = -1
+        elif self.previous_throughput is not None and throughput < self.previous_throughput:
+            self.direction = -self.direction  # The last move made things worse: go back.
+        self.previous_throughput = throughput
+        size = min(max(int(round(self.batch_size * self.step ** self.direction)), self.min_size), self.max_size)
+        if size != self.batch_size:
+            logger.info("Batch size %d -> %d (%.0f rows/s, mean latency %.1f ms).", self.batch_size, size, throughput,
+                        mean_latency * 1e3)
+        self.batch_size = size
+
+
+class SpillQueue:
+    """Bounded on-disk FIFO queue of serialized requests, kept while the server is not available.
+
+    Every request is a file named by its sequence number, so the queue survives a restart of the collector and is
+    replayed in order. Once the queue holds more than `max_bytes`, the oldest requests are dropped.
+
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        """Open the queue, with the requests left by a previous run.
+
+        Raises:
+            OSError: If the directory cannot be created.
+
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._entries = collections.deque()  # (path, size), oldest first.
+        for name in sorted(name for name in os.listdir(directory) if name.endswith(SPILL_SUFFIX)):
+            path = os.path.join(directory, name)
+            self._entries.append((path, os.path.getsize(path)))
+        self.size = sum(size for _, size in self._entries)
+        self._sequence = int(os.path.basename(self._entries[-1][0])[:-len(SPILL_SUFFIX)]) + 1 if self._entries else 0
+        self.dropped_count = 0
+        if self._entries:
+            logger.info("Spill queue holds %d requests (%d bytes) from a previous run.", len(self), self.size)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, payload: bytes) -> None:
+        """Append a request, dropping the oldest ones if the queue gets too large."""
+        path = os.path.join(self.directory, f"{self._sequence:016d}{SPILL_SUFFIX}")
+        self._sequence += 1
+        with open(path + ".tmp", "wb") as f_batch:
+            f_batch.write(payload)
+        os.replace(path + ".tmp", path)  # A crash never leaves a partial request in the queue.
+        self._entries.append((path, len(payload)))
+        self.size += len(payload)
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            self.pop()
+            self.dropped_count += 1
+            logger.warning("Spill queue full (%d bytes): oldest request dropped.", self.max_bytes)
+
+    def peek(self) -> bytes:
+        """Return the oldest request."""
+        with open(self._entries[0][0], "rb") as f_batch:
+            return f_batch.read()
+
+    def pop(self) -> None:
+        """Remove the oldest request."""
+        path, size = self._entries.popleft()
+        self.size -= size
+        os.remove(path)
+
+
+class Collector:
+    """Long-running sender of the samples produced by the host: micro-batches them and sends them on one channel.
+
+    Samples are buffered as they are added, and a sender thread flushes them as one SendMetrics call as soon as the
+    buffer holds a batch (whose size is adapted by a BatchSizeController) or its oldest sample is `max_delay_s` old,
+    whichever comes first. If the server is not available, batches go to the spill queue instead; the queue is
+    replayed in order (before newer batches) once the server answers again, retrying every `retry_interval_s`.
+
+    """
+
+    def __init__(
+            self,
+            channel: grpc.Channel,
+            controller: BatchSizeController,
+            spill: SpillQueue,
+            max_delay_s: float = 1.0,
+            timeout_s: float = 5.0,
+            retry_interval_s: float = 2.0,
+            max_buffered: Optional[int] = None,
+            schema_version: Optional[int] = None
+    ) -> None:
+        """Initialize the collector (call `start` to start sending).
+
+        Args:
+            channel: The channel to the server.
+            controller: Chooses the batch size.
+            spill: Where batches are kept while the server is not available.
+            max_delay_s: Maximum time a sample waits in the buffer.
+            timeout_s: Deadline of every call.
+            retry_interval_s: Time between two attempts to replay the spill queue.
+            max_buffered: Maximum number of buffered samples; `add` blocks beyond it (4 maximum batches by default).
+            schema_version: Schema version of the requests, or None to ask the server once it answers (v1 until then).
+
+        """
+        self.controller = controller
+        self.spill = spill
+        self.max_delay_s = max_delay_s
+        self.timeout_s = timeout_s
+        self.retry_interval_s = retry_interval_s
+        self.max_buffered = max_buffered or 4 * controller.max_size
+        self.channel = channel
+        self.schema_version = schema_version
+        self.delta = timestamp_delta()
+        # The requests are serialized once, to be sent or spilled as they are.
+        self._call = channel.unary_unary(SEND_METRICS_METHOD, request_serializer=None,
+                                         response_deserializer=MetricsResponse.FromString)
+        self._buffer = collections.deque()  # MetricColumns, oldest first.
+        self._buffered = 0
+        self._oldest = 0.0  # Monotonic time at which the oldest buffered sample was added.
+        self._condition = threading.Condition()
+        self._closing = False
+        self._next_retry = 0.0
+        self._thread = threading.Thread(target=self._run, name="collector-sender", daemon=True)
+        self.counters = collections.Counter()
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def add(self, metrics: MetricColumns) -> None:
+        """Buffer samples, blocking while the buffer is full."""
+        with self._condition:
+            while self._buffered >= self.max_buffered and not self._closing:
+                self._condition.wait()
+            first = not self._buffered
+            if first:
+                self._oldest = time.monotonic()
+            self._buffer.append(metrics)
+            self._buffered += len(metrics)
+            if first or self._buffered >= self.controller.batch_size:  # A deadline to wait for, or a full batch.
+                self._condition.notify_all()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Send (or spill) the buffered samples, try once more to replay the spill queue, and stop the sender."""
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def _take(self, count: int) -> MetricColumns:
+        """Remove the `count` oldest samples from the buffer (called with the condition held)."""
+        pieces = []
+        taken = 0
+        while taken < count:
+            piece = self._buffer.popleft()
+            if taken + len(piece) > count:
+                self._buffer.appendleft(piece.slice(count - taken, len(piece)))
+                piece = piece.slice(0, count - taken)
+            pieces.append(piece)
+            taken += len(piece)
+        self._buffered -= count
+        self._oldest = time.monotonic()  # The rest was added later; this errs on the side of an early flush.
+        self._condition.notify_all()  # Room for `add`.
+        return MetricColumns.concat(pieces)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    full = self._buffered >= self.controller.batch_size
+                    due = self._buffered and (now >= self._oldest + self.max_delay_s or self._closing)
+                    if full or due or (self._closing and not self._buffered):
+                        break
+                    timeout = self._oldest + self.max_delay_s - now if self._buffered else None
+                    if len(self.spill) and (timeout is None or self._next_retry - now < timeout):
+                        timeout = max(self._next_retry - now, 0)
+                    if timeout == 0:
+                        break
+                    self._condition.wait(timeout)
+                batch = self._take(min(self._buffered, self.controller.batch_size)) if (full or due) else None
+                closing = self._closing and not self._buffered
+            if batch is not None:
+                self._ship(batch, full)
+            elif len(self.spill):
+                self._replay()
+            if closing:
+                if len(self.spill):
+                    self._next_retry = 0.0
+                    self._replay()
+                return
+
+    def _ship(self, batch: MetricColumns, full: bool) -> None:
+        """Send a batch, or spill it if the server is not available (or older batches are still spilled)."""
+        payload = serialize_protobuf(batch, self.schema_version or 1, self.delta).SerializeToString()
+        if len(self.spill):
+            self.spill.put(payload)  # Batches are sent in order: this one goes after the spilled ones.
+            self.counters["spilled_batches"] += 1
+            self._replay()
+            return
+        try:
+            start = time.perf_counter()
+            self._send(payload)
+            if full:
+                self.controller.update(len(batch), time.perf_counter() - start)
+            self.counters["sent_batches"] += 1
+        except grpc.RpcError as e:
+            if e.code() not in RETRYABLE_CODES:
+                logger.error("Batch of %d metrics rejected, dropped: %s", len(batch), e.details())
+                self.counters["rejected_batches"] += 1
+                return
+            logger.warning("Server not available (%s), spilling to %s.", e.code().name, self.spill.directory)
+            self.spill.put(payload)
+            self.counters["spilled_batches"] += 1
+            self._next_retry = time.monotonic() + self.retry_interval_s
+
+    def _replay(self) -> None:
+        """Send the spilled requests in order, until the queue is empty or the server fails again."""
+        if time.monotonic() < self._next_retry:
+            return
+        replayed = 0
+        while len(self.spill):
+            try:
+                self._send(self.spill.peek())
+            except grpc.RpcError as e:
+                if e.code() in RETRYABLE_CODES:
+                    self._next_retry = time.monotonic() + self.retry_interval_s
+                    break
+                logger.error("Spilled request rejected, dropped: %s", e.details())
+                self.counters["rejected_batches"] += 1
+            else:
+                replayed += 1
+            self.spill.pop()
+        self.counters["replayed_batches"] += replayed
+        if replayed:
+            logger.info("Replayed %d spilled requests (%d left).", replayed, len(self.spill))
+
+    def _send(self, payload: bytes) -> None:
+        self.counters["saved_rows"] += self._call(payload, timeout=self.timeout_s).metrics_count
+        if self.schema_version is None:  # The server answers: ask it for the best schema version from now on.
+            self.schema_version = negotiate_schema_version(self.channel)
+
+
+def produce(collector: Collector, rate: float, stop: threading.Event, servers: int, seed: Optional[int],
+            tick_s: float = 0.1) -> None:
+    """Add synthetic samples to the collector at a steady rate until `stop` is set.
+
+    Args:
+        collector: The collector.
+        rate: Samples per second.
+        stop: Set to stop producing.
+        servers: Number of distinct server IDs.
+        seed: Seed of the generator.
+        tick_s: Samples are produced in bursts of `rate * tick_s` samples, every `tick_s` seconds.
+
+    """
+    per_tick = max(int(rate * tick_s), 1)
+    batches = generate_metric_batches(2 ** 62, per_tick, servers=servers, seed=seed, interval_ns=int(1e9 / rate))
+    next_tick = time.monotonic()
+    while not stop.is_set():
+        collector.add(next(batches))
+        next_tick += per_tick / rate
+        stop.wait(max(next_tick - time.monotonic(), 0))
+
+
+def run_collector(
+        server_host: str,
+        rate: float,
+        duration_s: float,
+        min_batch: int,
+        max_batch: int,
+        max_delay_ms: float,
+        target_latency_ms: float,
+        spill_path: str,
+        spill_max_bytes: int,
+        timeout_s: float = 5.0,
+        output: Optional[str] = None
+) -> dict[str, Any]:
+    """Run the collector until SIGTERM or SIGINT (or for `duration_s` seconds), and save its report as JSON.
+
+    Args:
+        server_host: Host name of the gRPC server (see `client.server_target`).
+        rate: Samples produced per second.
+        duration_s: Run time, or 0 to run until stopped.
+        min_batch: Smallest batch size.
+        max_batch: Largest batch size.
+        max_delay_ms: Maximum time a sample waits before it is sent.
+        target_latency_ms: Call latency above which the batch size shrinks.
+        spill_path: Directory of the spill queue.
+        spill_max_bytes: Maximum size of the spill queue.
+        timeout_s: Deadline of every call.
+        output: Path of the JSON report (default: RESULTS_PATH/collector_report.json).
+
+    Returns:
+        The report.
+
+    """
+    channel = grpc.insecure_channel(server_target(server_host), CHANNEL_OPTIONS,
+                                    compression=grpc_compression_from_env())
+    schema_version = None
+    try:
+        grpc.channel_ready_future(channel).result(timeout=1)
+        schema_version = negotiate_schema_version(channel)
+    except grpc.FutureTimeoutError:
+        logger.warning("Server not available yet: batches are spilled until it answers.")
+    controller = BatchSizeController(min(max(int(rate * max_delay_ms / 1e3), min_batch), max_batch), min_batch,
+                                     max_batch, target_latency_ms / 1e3)
+    collector = Collector(channel, controller, SpillQueue(spill_path, spill_max_bytes), max_delay_ms / 1e3, timeout_s,
+                          schema_version=schema_version)
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    logger.info("Collector started: %.0f samples/s, batches of %d to %d samples within %.0f ms.", rate, min_batch,
+                max_batch, max_delay_ms)
+    started = time.monotonic()
+    collector.start()
+    if duration_s > 0:
+        timer = threading.Timer(duration_s, stop.set)
+        timer.daemon = True
+        timer.start()
+    try:
+        seed = os.getenv("GENERATOR_SEED")
+        produce(collector, rate, stop, int(os.getenv("SERVERS_COUNT", "100")), int(seed) if seed else None)
+    finally:
+        collector.close(timeout=timeout_s * (len(collector.spill) + 2))
+        channel.close()
+    report = {
+        "duration_s": time.monotonic() - started,
+        "settings": {"rate": rate, "min_batch": min_batch, "max_batch": max_batch, "max_delay_ms": max_delay_ms,
+                     "target_latency_ms": target_latency_ms, "spill_max_bytes": spill_max_bytes},
+        "final_batch_size": controller.batch_size,
+        "spill_queue_batches": len(collector.spill),
+        "spill_dropped_batches": collector.spill.dropped_count,
+        **collector.counters
+    }
+    logger.info("Collector stopped: %d metrics saved, %d batches sent, %d batches spilled, %d replayed, %d left in the "
+                "spill queue.", report.get("saved_rows", 0), report.get("sent_batches", 0),
+                report.get("spilled_batches", 0), report.get("replayed_batches", 0), report["spill_queue_batches"])
+    output = output or os.path.join(os.getenv("RESULTS_PATH", "."), "collector_report.json")
+    with open(output, "w") as f_report:
+        json.dump(report, f_report, indent=2)
+    return report
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Collector daemon: micro-batches samples on a persistent channel.")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "localhost"), help="Host name of the server.")
+    parser.add_argument("--rate", type=float, default=float(os.getenv("COLLECT_RATE", "10000")),
+                        help="Samples produced per second.")
+    parser.add_argument("--duration", type=float, default=float(os.getenv("COLLECT_DURATION_S", "0")),
+                        help="Run time in seconds (0: until SIGTERM or Ctrl+C).")
+    parser.add_argument("--min-batch", type=int, default=int(os.getenv("COLLECT_MIN_BATCH", "100")),
+                        help="Smallest batch size.")
+    parser.add_argument("--max-batch", type=int, default=int(os.getenv("COLLECT_MAX_BATCH", "50000")),
+                        help="Largest batch size.")
+    parser.add_argument("--max-delay-ms", type=float, default=float(os.getenv("COLLECT_MAX_DELAY_MS", "1000")),
+                        help="Maximum time a sample waits before it is sent.")
+    parser.add_argument("--target-latency-ms", type=float,
+                        default=float(os.getenv("COLLECT_TARGET_LATENCY_MS", "250")),
+                        help="Call latency above which the batch size shrinks.")
+    parser.add_argument("--spill-path", default=os.getenv("SPILL_PATH", os.path.join(os.getenv("RESULTS_PATH", "."),
+                                                                                     "spill")),
+                        help="Directory of the spill queue.")
+    parser.add_argument("--spill-max-bytes", type=int, default=int(os.getenv("SPILL_MAX_BYTES", str(256 * 2 ** 20))),
+                        help="Maximum size of the spill queue; the oldest batches are dropped beyond it.")
+    parser.add_argument("--output", default=None, help="JSON report (default: RESULTS_PATH/collector_report.json).")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run_collector(args.host, args.rate, args.duration, args.min_batch, args.max_batch, args.max_delay_ms,
+                  args.target_latency_ms, args.spill_path, args.spill_max_bytes, output=args.output)
@@ -0,0 +1,68 @@
+import os
+import logging
+import argparse
+from typing import Optional
+
+import grpc
+
+from metrics_pb2 import ProfilingSettings, ProfilingStatus
+from metrics_pb2_grpc import MetricsServiceStub
+from client import connect
+
+logger = logging.getLogger(__name__)
+
+
+def configure_profiling(
+        server_host: str,
+        sample_rate: Optional[float] = None,
+        trace_allocations: Optional[bool] = None,
+        timeout_s: float = 5.0
+) -> Optional[ProfilingStatus]:
+    """Change the profiling mode of the server and log it.
+
+    With several server workers, only the worker that answers the call is changed (PROFILE_SAMPLE_RATE configures
+    them all).
+
+    Args:
+        server_host: Host name of the gRPC server (port 50051 is used).
+        sample_rate: Share of the saved batches to profile, between 0 (off) and 1 (None to leave it unchanged).
+        trace_allocations: Whether to trace the allocations of the profiled batches (None to leave it unchanged).
+        timeout_s: Deadline of the call.
+
+    Returns:
+        The resulting mode, or None if the server is not available or the call failed.
+
+    """
+    channel = connect(server_host)
+    if channel is None:
+        return None
+    settings = ProfilingSettings()
+    if sample_rate is not None:
+        settings.sample_rate = sample_rate
+    if trace_allocations is not None:
+        settings.trace_allocations = trace_allocations
+    with channel:
+        try:
+            status = MetricsServiceStub(channel).ConfigureProfiling(settings, timeout=timeout_s)
+        except grpc.RpcError as e:
+            logger.error("Call failed: %s", e)
+            return None
+    logger.info("Profiling: sample rate %g, allocation tracing %s, %d batches profiled, dumps in %s.",
+                status.sample_rate, "on" if status.trace_allocations else "off", status.samples_count,
+                status.directory)
+    return status
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Turn the sampling profiler of the metrics server on or off.")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "localhost"), help="Host name of the server.")
+    parser.add_argument("--sample-rate", type=float, default=None,
+                        help="Share of the saved batches to profile, between 0 (off) and 1.")
+    parser.add_argument("--allocations", choices=("on", "off"), default=None,
+                        help="Trace the allocations of the profiled batches.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configure_profiling(args.host, args.sample_rate, None if args.allocations is None else args.allocations == "on")
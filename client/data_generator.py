@@ -1,13 +1,18 @@
+import time
 import random
 import datetime
-from typing import Union
+from typing import Union, Iterator, Optional
 
+import numpy as np
 
-def generate_metrics(count: int) -> list[dict[str, Union[str, float]]]:
+
+def generate_metrics(count: int, start: int = 0) -> list[dict[str, Union[str, float]]]:
     """Generate a list of synthetic server metrics.
 
     Args:
         count: The number of metric entries to generate.
+        start: The index of the first entry (used to build server IDs), so that consecutive calls can continue a
+            sequence.
 
     Returns:
         A list of dictionaries, where each dictionary represents a metric
@@ -15,7 +20,7 @@ def generate_metrics(count: int) -> list[dict[str, Union[str, float]]]:
 
     """
     metrics = []
-    for i in range(count):
+    for i in range(start, start + count):
         metric = {
             "server_id": f"srv{i}",
             "cpu_usage": random.uniform(0, 100),
@@ -25,3 +30,143 @@ def generate_metrics(count: int) -> list[dict[str, Union[str, float]]]:
         }
         metrics.append(metric)
     return metrics
+
+
+def generate_metric_chunks(count: int, chunk_size: int) -> Iterator[list[dict[str, Union[str, float]]]]:
+    """Lazily generate synthetic server metrics in chunks.
+
+    Only one chunk exists at a time, so arbitrarily large counts can be produced with constant memory.
+
+    Args:
+        count: The total number of metric entries to generate.
+        chunk_size: The maximum number of entries per chunk.
+
+    Yields:
+        Lists of at most `chunk_size` metrics, in the same format as `generate_metrics`.
+
+    """
+    for start in range(0, count, chunk_size):
+        yield generate_metrics(min(chunk_size, count - start), start)
+
+
+class MetricColumns:
+    """A batch of metrics stored column by column in NumPy arrays.
+
+    Server IDs are dictionary-encoded: `server_ids` holds every distinct ID once and `server_index` holds, for each
+    sample, the position of its ID in `server_ids`. All other attributes are arrays with one value per sample.
+
+    """
+
+    __slots__ = ("server_ids", "server_index", "cpu_usage", "memory_usage", "disk_usage", "timestamp_ns")
+
+    def __init__(
+            self,
+            server_ids: list[str],
+            server_index: np.ndarray,
+            cpu_usage: np.ndarray,
+            memory_usage: np.ndarray,
+            disk_usage: np.ndarray,
+            timestamp_ns: np.ndarray
+    ) -> None:
+        """Initialize the batch.
+
+        Args:
+            server_ids: Distinct server IDs.
+            server_index: uint32 array of indices into `server_ids`.
+            cpu_usage: float32 array of CPU usage values (percent).
+            memory_usage: float32 array of memory usage values (percent).
+            disk_usage: float32 array of disk usage values (percent).
+            timestamp_ns: int64 array of Unix epoch timestamps in nanoseconds.
+
+        """
+        self.server_ids = server_ids
+        self.server_index = server_index
+        self.cpu_usage = cpu_usage
+        self.memory_usage = memory_usage
+        self.disk_usage = disk_usage
+        self.timestamp_ns = timestamp_ns
+
+    def __len__(self) -> int:
+        return len(self.server_index)
+
+    def slice(self, start: int, stop: int) -> "MetricColumns":
+        """Return the samples [start, stop) as a batch that shares the arrays (and the server ID dictionary)."""
+        return MetricColumns(self.server_ids, self.server_index[start:stop], self.cpu_usage[start:stop],
+                             self.memory_usage[start:stop], self.disk_usage[start:stop], self.timestamp_ns[start:stop])
+
+    @classmethod
+    def concat(cls, batches: list["MetricColumns"]) -> "MetricColumns":
+        """Concatenate batches into one, merging their server ID dictionaries (batches must not be empty)."""
+        if len(batches) == 1:
+            return batches[0]
+        server_ids = batches[0].server_ids
+        if all(batch.server_ids is server_ids for batch in batches):  # Batches of the same generator.
+            server_index = np.concatenate([batch.server_index for batch in batches])
+        else:
+            codes = {}
+            server_index = np.concatenate([
+                np.array([codes.setdefault(server_id, len(codes)) for server_id in batch.server_ids],
+                         dtype=np.uint32)[batch.server_index]
+                for batch in batches])
+            server_ids = list(codes)
+        return cls(server_ids, server_index, *(np.concatenate([getattr(batch, name) for batch in batches])
+                                               for name in ("cpu_usage", "memory_usage", "disk_usage", "timestamp_ns")))
+
+    def iso_timestamps(self) -> np.ndarray:
+        """Return the timestamps as ISO 8601 strings (microsecond precision, as produced by `isoformat()`)."""
+        return self.timestamp_ns.view("datetime64[ns]").astype("datetime64[us]").astype(str)
+
+
+def generate_metric_batches(
+        count: int,
+        batch_size: int,
+        servers: int = 100,
+        seed: Optional[int] = None,
+        start_time_ns: Optional[int] = None,
+        interval_ns: int = 1_000_000,
+        burst_probability: float = 0.01
+) -> Iterator[MetricColumns]:
+    """Lazily generate synthetic server metrics as columnar batches.
+
+    Every server gets its own baseline CPU, memory and disk usage. Samples are drawn around the baseline of their
+    server with Gaussian noise, and a small share of the CPU samples are bursts well above the baseline. All values are
+    clipped to [0, 100]. Only one batch exists at a time, so arbitrarily large counts can be produced with constant
+    memory.
+
+    Args:
+        count: The total number of samples to generate.
+        batch_size: The maximum number of samples per batch.
+        servers: The number of distinct server IDs.
+        seed: Seed of the random generator; the same seed yields the same values.
+        start_time_ns: Timestamp of the first sample (the current time by default).
+        interval_ns: Time between two consecutive samples.
+        burst_probability: Probability that a CPU sample is a burst.
+
+    Yields:
+        MetricColumns batches with at most `batch_size` samples each.
+
+    """
+    rng = np.random.default_rng(seed)
+    server_ids = [f"srv{i}" for i in range(servers)]
+    cpu_baseline = rng.uniform(5, 60, servers)
+    memory_baseline = rng.uniform(20, 80, servers)
+    disk_baseline = rng.uniform(10, 90, servers)
+    if start_time_ns is None:
+        start_time_ns = time.time_ns()
+
+    for start in range(0, count, batch_size):
+        size = min(batch_size, count - start)
+        server_index = rng.integers(0, servers, size, dtype=np.uint32)
+        cpu_usage = cpu_baseline[server_index] + rng.normal(0, 5, size)
+        bursts = rng.random(size) < burst_probability
+        cpu_usage[bursts] += rng.uniform(20, 60, int(bursts.sum()))
+        memory_usage = memory_baseline[server_index] + rng.normal(0, 2, size)
+        disk_usage = disk_baseline[server_index] + rng.normal(0, 0.5, size)
+        yield MetricColumns(
+            server_ids=server_ids,
+            server_index=server_index,
+            cpu_usage=np.clip(cpu_usage, 0, 100).astype(np.float32),
+            memory_usage=np.clip(memory_usage, 0, 100).astype(np.float32),
+            disk_usage=np.clip(disk_usage, 0, 100).astype(np.float32),
+            timestamp_ns=start_time_ns + np.arange(start, start + size, dtype=np.int64) * interval_ns
+        )
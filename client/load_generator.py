@@ -0,0 +1,329 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+import itertools
+from typing import Any, Optional
+
+import grpc
+
+from metrics_pb2 import MetricsRequest
+from metrics_pb2_grpc import MetricsServiceStub
+from client import connect, iter_generated_metrics, negotiate_schema_version, timestamp_delta
+from serializers import serialize_protobuf
+
+logger = logging.getLogger(__name__)
+
+# Every channel gets its own subchannel pool, so N channels really open N connections (by default, channels with the
+# same target and arguments share one connection).
+CHANNEL_OPTIONS = [("grpc.use_local_subchannel_pool", 1)]
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """Histogram of latencies with a fixed number of buckets (log-linear, in the style of HdrHistogram).
+
+    Values are recorded in microseconds. Values below 2**sub_bucket_bits are counted exactly; above that, every power
+    of two is split into 2**sub_bucket_bits equal buckets, so the relative error of a percentile is below
+    1 / 2**sub_bucket_bits (< 1% with the default 7 bits). Memory does not depend on the number of recorded values.
+
+    Thread-safe.
+
+    """
+
+    def __init__(self, max_value_us: int = 2 ** 36, sub_bucket_bits: int = 7) -> None:
+        """Initialize an empty histogram.
+
+        Args:
+            max_value_us: Largest value that can be recorded (larger values are counted as this value). The default is
+                about 19 hours.
+            sub_bucket_bits: Precision of the buckets (number of sub-buckets per power of two, as a power of two).
+
+        """
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_buckets = 1 << sub_bucket_bits
+        self.max_value_us = max_value_us
+        self.counts = [0] * (self._index(max_value_us) + 1)
+        self.total = 0
+        self.sum_us = 0
+        self.min_us = None
+        self.max_us = 0
+        self._lock = threading.Lock()
+
+    def _index(self, value: int) -> int:
+        if value < self.sub_buckets:
+            return value
+        exponent = value.bit_length() - 1 - self.sub_bucket_bits
+        return self.sub_buckets * (exponent + 1) + (value >> exponent) - self.sub_buckets
+
+    def _bucket_bounds(self, index: int) -> tuple[int, int]:
+        if index < self.sub_buckets:
+            return index, index
+        exponent, offset = divmod(index - self.sub_buckets, self.sub_buckets)
+        lower = (self.sub_buckets + offset) << exponent
+        return lower, lower + (1 << exponent) - 1
+
+    def record(self, value_ns: int) -> None:
+        """Record one latency in nanoseconds."""
+        value = min(max(value_ns // 1000, 0), self.max_value_us)
+        with self._lock:
+            self.counts[self._index(value)] += 1
+            self.total += 1
+            self.sum_us += value
+            self.min_us = value if self.min_us is None else min(self.min_us, value)
+            self.max_us = max(self.max_us, value)
+
+    def percentile(self, q: float) -> float:
+        """Return the q-th percentile (0-100) in microseconds (the middle of the bucket that contains it)."""
+        with self._lock:
+            if not self.total:
+                return 0.0
+            rank = max(1, int(round(q / 100 * self.total)))
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    lower, upper = self._bucket_bounds(index)
+                    return min((lower + upper) / 2, self.max_us)
+            return float(self.max_us)
+
+    def summary(self) -> dict[str, float]:
+        """Return the count, min, mean, max and the percentiles of PERCENTILES, in microseconds."""
+        result = {
+            "count": self.total,
+            "min_us": self.min_us or 0,
+            "mean_us": self.sum_us / self.total if self.total else 0.0,
+            "max_us": self.max_us
+        }
+        for q in PERCENTILES:
+            result[f"p{q:g}_us"] = self.percentile(q)
+        return result
+
+
+class LoadGenerator:
+    """Send SendMetrics calls through a pool of persistent channels for a fixed duration.
+
+    Two modes are supported:
+    * closed loop (`qps` = 0): `concurrency` calls are always in flight; each completed call immediately starts the next.
+    * open loop (`qps` > 0): calls are started at a fixed rate, whatever the latency of the server. The latency of a
+      call is measured from its scheduled start time, so a stalled client or server does not hide the delay
+      (coordinated omission). At most `concurrency` calls are in flight; calls that would exceed it are skipped and
+      counted.
+
+    """
+
+    def __init__(
+            self,
+            stubs: list[MetricsServiceStub],
+            requests: list[MetricsRequest],
+            concurrency: int,
+            qps: float,
+            duration_s: float,
+            timeout_s: Optional[float] = None
+    ) -> None:
+        """Initialize the generator.
+
+        Args:
+            stubs: One stub per channel; calls are spread over them round-robin.
+            requests: Pre-serialized requests, sent in turn.
+            concurrency: Number of calls in flight (closed loop), or maximum number of calls in flight (open loop).
+            qps: Target calls per second, or 0 for the closed loop.
+            duration_s: Duration of the test.
+            timeout_s: Deadline of every call (None for no deadline).
+
+        """
+        self.stubs = itertools.cycle(stubs)
+        self.requests = itertools.cycle([(request, len(request.metrics), request.ByteSize()) for request in requests])
+        self.concurrency = concurrency
+        self.qps = qps
+        self.duration_s = duration_s
+        self.timeout_s = timeout_s
+        self.histogram = LatencyHistogram()
+        self.errors = {}  # gRPC status code name -> count.
+        self.rows = 0
+        self.bytes = 0
+        self.skipped = 0
+        self._lock = threading.Lock()  # Guards the counters, the iterators and `_in_flight`.
+        self._in_flight = 0
+        self._idle = threading.Condition(self._lock)
+        self._end = 0.0
+
+    def run(self) -> dict[str, Any]:
+        """Run the test and return its report."""
+        started = time.perf_counter()
+        self._end = started + self.duration_s
+        if self.qps > 0:
+            self._run_open_loop(started)
+        else:
+            for _ in range(self.concurrency):
+                self._send(time.perf_counter_ns())
+        with self._idle:
+            while self._in_flight:
+                self._idle.wait()
+        elapsed = time.perf_counter() - started
+        return {
+            "duration_s": elapsed,
+            "calls": self.histogram.total,
+            "errors": dict(self.errors),
+            "errors_count": sum(self.errors.values()),
+            "skipped": self.skipped,
+            "calls_per_s": self.histogram.total / elapsed,
+            "rows_per_s": self.rows / elapsed,
+            "bytes_per_s": self.bytes / elapsed,
+            "latency": self.histogram.summary()
+        }
+
+    def _run_open_loop(self, started: float) -> None:
+        interval = 1 / self.qps
+        for i in itertools.count():
+            scheduled = started + i * interval
+            if scheduled >= self._end:
+                return
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                if self._in_flight >= self.concurrency:
+                    self.skipped += 1
+                    continue
+            self._send(int(scheduled * 1e9))
+
+    def _send(self, start_ns: int) -> None:
+        with self._lock:
+            stub = next(self.stubs)
+            request, rows, size = next(self.requests)
+            self._in_flight += 1
+        self._call(stub, request, rows, size, start_ns)
+
+    def _call(self, stub: MetricsServiceStub, request: MetricsRequest, rows: int, size: int, start_ns: int) -> None:
+        # The slot of the call is already counted in `_in_flight`; it is released when no call takes it over.
+        try:
+            future = stub.SendMetrics.future(request, timeout=self.timeout_s)
+        except Exception:
+            with self._lock:
+                self._release()
+            raise
+        future.add_done_callback(lambda f: self._on_done(f, start_ns, rows, size))
+
+    def _release(self) -> None:
+        # Called with the lock held.
+        self._in_flight -= 1
+        if not self._in_flight:
+            self._idle.notify_all()
+
+    def _on_done(self, future: grpc.Future, start_ns: int, rows: int, size: int) -> None:
+        self.histogram.record(time.perf_counter_ns() - start_ns)
+        code = future.code()
+        with self._lock:
+            if code == grpc.StatusCode.OK:
+                self.rows += rows
+                self.bytes += size
+            else:
+                self.errors[code.name] = self.errors.get(code.name, 0) + 1
+            again = self.qps <= 0 and time.perf_counter() < self._end
+            if again:
+                # Closed loop: the next call takes over the slot of this one, so `run` never sees it free in between.
+                stub = next(self.stubs)
+                request, rows, size = next(self.requests)
+            else:
+                self._release()
+        if again:
+            self._call(stub, request, rows, size, time.perf_counter_ns())
+
+
+def run_load_test(
+        server_host: str,
+        channels: int,
+        concurrency: int,
+        qps: float,
+        batch_size: int,
+        duration_s: float,
+        timeout_s: Optional[float] = None,
+        output: Optional[str] = None
+) -> Optional[dict[str, Any]]:
+    """Run a load test against the server and save its report as JSON.
+
+    Args:
+        server_host: Host name of the gRPC server (port 50051 is used).
+        channels: Number of persistent channels (connections).
+        concurrency: Number of calls in flight (closed loop), or their maximum (open loop).
+        qps: Target calls per second, or 0 for the closed loop.
+        batch_size: Number of metrics per call.
+        duration_s: Duration of the test.
+        timeout_s: Deadline of every call (None for no deadline).
+        output: Path of the JSON report (default: RESULTS_PATH/load_report.json).
+
+    Returns:
+        The report, or None if the server is not available.
+
+    """
+    pool = []
+    for _ in range(channels):
+        channel = connect(server_host, CHANNEL_OPTIONS)
+        if channel is None:
+            for opened in pool:
+                opened.close()
+            return None
+        pool.append(channel)
+    # Requests are generated and serialized up front, in the negotiated schema version, so only the calls themselves
+    # are measured.
+    try:
+        schema_version = negotiate_schema_version(pool[0])
+    except ValueError:
+        for channel in pool:
+            channel.close()
+        raise
+    requests = [serialize_protobuf(chunk, schema_version, timestamp_delta())
+                for chunk in iter_generated_metrics(batch_size * 8, batch_size)]
+
+    mode = f"open loop at {qps:g} calls/s" if qps > 0 else "closed loop"
+    logger.info("Load test: %s, %d channels, concurrency %d, %d metrics per call, %.0f s.", mode, channels,
+                concurrency, batch_size, duration_s)
+    try:
+        report = LoadGenerator([MetricsServiceStub(channel) for channel in pool], requests, concurrency, qps,
+                               duration_s, timeout_s).run()
+    finally:
+        for channel in pool:
+            channel.close()
+    report["settings"] = {"channels": channels, "concurrency": concurrency, "qps": qps, "batch_size": batch_size,
+                          "duration_s": duration_s, "timeout_s": timeout_s, "schema_version": schema_version}
+
+    latency = report["latency"]
+    logger.info("%d calls (%d errors, %d skipped): %.0f calls/s, %.0f rows/s, %.2f MB/s.", report["calls"],
+                report["errors_count"], report["skipped"], report["calls_per_s"], report["rows_per_s"],
+                report["bytes_per_s"] / 1e6)
+    logger.info("Latency: p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, p99.9 %.2f ms, max %.2f ms.",
+                latency["p50_us"] / 1000, latency["p90_us"] / 1000, latency["p99_us"] / 1000,
+                latency["p99.9_us"] / 1000, latency["max_us"] / 1000)
+
+    output = output or os.path.join(os.getenv("RESULTS_PATH", "."), "load_report.json")
+    with open(output, "w") as f_report:
+        json.dump(report, f_report, indent=2)
+    logger.info("Load test report saved to %s", output)
+    return report
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test of the metrics server.")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "localhost"), help="Host name of the server.")
+    parser.add_argument("--channels", type=int, default=int(os.getenv("LOAD_CHANNELS", "4")),
+                        help="Number of persistent channels.")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("LOAD_CONCURRENCY", "16")),
+                        help="Calls in flight (closed loop) or their maximum (open loop).")
+    parser.add_argument("--qps", type=float, default=float(os.getenv("LOAD_QPS", "0")),
+                        help="Target calls per second (0: closed loop).")
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("LOAD_BATCH_SIZE", "1000")),
+                        help="Metrics per call.")
+    parser.add_argument("--duration", type=float, default=float(os.getenv("LOAD_DURATION_S", "30")),
+                        help="Test duration in seconds.")
+    parser.add_argument("--timeout", type=float, default=None, help="Deadline of every call in seconds.")
+    parser.add_argument("--output", default=None, help="JSON report (default: RESULTS_PATH/load_report.json).")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run_load_test(args.host, args.channels, args.concurrency, args.qps, args.batch_size, args.duration, args.timeout,
+                  args.output)
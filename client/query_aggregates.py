@@ -0,0 +1,74 @@
+import os
+import logging
+import argparse
+from typing import Optional
+
+import grpc
+
+from metrics_pb2 import AggregatesQuery, AggregatesResponse
+from metrics_pb2_grpc import MetricsServiceStub
+from client import connect
+
+logger = logging.getLogger(__name__)
+
+
+def query_aggregates(
+        server_host: str,
+        server_ids: list[str],
+        metrics: list[str],
+        window_s: int = 0,
+        range_s: int = 300,
+        quantiles: Optional[list[float]] = None,
+        timeout_s: float = 5.0
+) -> Optional[AggregatesResponse]:
+    """Query the rolling aggregates of the server and log them.
+
+    Args:
+        server_host: Host name of the gRPC server (port 50051 is used).
+        server_ids: Servers to query (all the servers known to the server if empty).
+        metrics: Metrics to query (all of them if empty).
+        window_s: Size of the tumbling windows, or 0 for one sliding window over the range.
+        range_s: How far back to look, in seconds.
+        quantiles: Quantiles to estimate (the server defaults if None).
+        timeout_s: Deadline of the call.
+
+    Returns:
+        The response, or None if the server is not available or the call failed.
+
+    """
+    channel = connect(server_host)
+    if channel is None:
+        return None
+    with channel:
+        try:
+            response = MetricsServiceStub(channel).QueryAggregates(
+                AggregatesQuery(server_ids=server_ids, metrics=metrics, window_s=window_s, range_s=range_s,
+                                quantiles=quantiles or []), timeout=timeout_s)
+        except grpc.RpcError as e:
+            logger.error("Query failed: %s", e)
+            return None
+    labels = ", ".join(f"p{q * 100:g}" for q in response.quantiles)
+    for series in response.series:
+        for window in series.windows:
+            values = ", ".join(f"{value:.2f}" for value in window.quantiles)
+            logger.info("%s %s [%d, %d): count %d, min %.2f, mean %.2f, max %.2f, %s: %s", series.server_id,
+                        series.metric, window.start_timestamp_ns, window.end_timestamp_ns, window.count, window.min,
+                        window.mean, window.max, labels, values)
+    return response
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Query the rolling aggregates of the metrics server.")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "localhost"), help="Host name of the server.")
+    parser.add_argument("--servers", default="", help="Comma-separated server IDs (default: all).")
+    parser.add_argument("--metrics", default="", help="Comma-separated metrics (default: all).")
+    parser.add_argument("--window", type=int, default=0, help="Tumbling window in seconds (0: one sliding window).")
+    parser.add_argument("--range", type=int, default=300, help="How far back to look, in seconds.")
+    parser.add_argument("--quantiles", default="", help="Comma-separated quantiles between 0 and 1.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    query_aggregates(args.host, [s for s in args.servers.split(",") if s], [m for m in args.metrics.split(",") if m],
+                     args.window, args.range, [float(q) for q in args.quantiles.split(",") if q])
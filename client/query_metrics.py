@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import logging
+import argparse
+from typing import Optional
+
+import grpc
+
+from metrics_pb2 import MetricsQuery
+from metrics_pb2_grpc import MetricsServiceStub
+from client import connect
+
+logger = logging.getLogger(__name__)
+
+
+def query_metrics(
+        server_host: str,
+        server_ids: list[str],
+        start_ns: int,
+        end_ns: int = 0,
+        chunk_size: int = 1000,
+        limit: int = 0,
+        output: Optional[str] = None
+) -> Optional[int]:
+    """Fetch stored metrics by server and time range through the streaming QueryMetrics call.
+
+    Args:
+        server_host: Host name of the gRPC server (port 50051 is used).
+        server_ids: Servers to fetch (all of them if empty).
+        start_ns: Start of the time range (inclusive), in Unix epoch nanoseconds.
+        end_ns: End of the time range (exclusive), or 0 for no end.
+        chunk_size: Maximum number of rows per streamed message.
+        limit: Maximum number of rows (0 for no limit).
+        output: If set, the rows are written to this file as JSON lines, as they arrive.
+
+    Returns:
+        The number of rows received, or None if the server is not available or the call failed.
+
+    """
+    channel = connect(server_host)
+    if channel is None:
+        return None
+    rows_count = 0
+    chunks_count = 0
+    started = time.perf_counter()
+    f_output = open(output, "w") if output else None
+    try:
+        with channel:
+            for chunk in MetricsServiceStub(channel).QueryMetrics(
+                    MetricsQuery(server_ids=server_ids, start_timestamp_ns=start_ns, end_timestamp_ns=end_ns,
+                                 chunk_size=chunk_size, limit=limit)):
+                chunks_count += 1
+                rows_count += len(chunk.metrics)
+                if f_output is not None:
+                    for m in chunk.metrics:
+                        f_output.write(json.dumps({"server_id": m.server_id, "cpu_usage": m.cpu_usage,
+                                                   "memory_usage": m.memory_usage, "disk_usage": m.disk_usage,
+                                                   "timestamp_ns": m.timestamp_ns}) + "\n")
+    except grpc.RpcError as e:
+        logger.error("Query failed: %s", e)
+        return None
+    finally:
+        if f_output is not None:
+            f_output.close()
+    logger.info("Received %d rows in %d chunks in %.3f seconds.", rows_count, chunks_count,
+                time.perf_counter() - started)
+    return rows_count
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fetch stored metrics by server and time range.")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "localhost"), help="Host name of the server.")
+    parser.add_argument("--servers", default="", help="Comma-separated server IDs (default: all).")
+    parser.add_argument("--last", type=float, default=300,
+                        help="Fetch the last N seconds (ignored if --start is given).")
+    parser.add_argument("--start", type=int, default=None, help="Start of the range in epoch nanoseconds.")
+    parser.add_argument("--end", type=int, default=0, help="End of the range in epoch nanoseconds (0: no end).")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Rows per streamed message.")
+    parser.add_argument("--limit", type=int, default=0, help="Maximum number of rows (0: no limit).")
+    parser.add_argument("--output", default=None, help="Write the rows to this file as JSON lines.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    start = args.start if args.start is not None else time.time_ns() - int(args.last * 1e9)
+    query_metrics(args.host, [s for s in args.servers.split(",") if s], start, args.end, args.chunk_size, args.limit,
+                  args.output)
@@ -0,0 +1,93 @@
+import os
+import math
+import logging
+import argparse
+from typing import Optional
+
+import grpc
+
+from metrics_pb2 import StatsRequest, StatsResponse, HistogramValue
+from metrics_pb2_grpc import MetricsServiceStub
+from client import connect
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def histogram_quantile(q: float, histogram: HistogramValue) -> float:
+    """Estimate a quantile of a histogram, interpolating linearly within its bucket (like PromQL histogram_quantile).
+
+    Args:
+        q: The quantile, between 0 and 1.
+        histogram: The histogram.
+
+    Returns:
+        The estimate (the last bound if the quantile falls above it), or NaN if the histogram is empty.
+
+    """
+    total = sum(histogram.bucket_counts)
+    if not total:
+        return math.nan
+    rank = q * total
+    seen = 0
+    lower = 0.0
+    for bound, count in zip(histogram.bounds, histogram.bucket_counts):
+        if count and seen + count >= rank:
+            return lower + (bound - lower) * (rank - seen) / count
+        seen += count
+        lower = bound
+    return histogram.bounds[-1]
+
+
+def query_stats(server_host: str, timeout_s: float = 5.0) -> Optional[StatsResponse]:
+    """Fetch the statistics of the server and log them: where requests spend their time, and how large they are.
+
+    With several server workers, the statistics are those of the worker that answered the call.
+
+    Args:
+        server_host: Host name of the gRPC server (port 50051 is used).
+        timeout_s: Deadline of the call.
+
+    Returns:
+        The response, or None if the server is not available or the call failed.
+
+    """
+    channel = connect(server_host)
+    if channel is None:
+        return None
+    with channel:
+        try:
+            response = MetricsServiceStub(channel).GetStats(StatsRequest(), timeout=timeout_s)
+        except grpc.RpcError as e:
+            logger.error("Query failed: %s", e)
+            return None
+    logger.info("Server uptime: %.1f s.", response.uptime_s)
+    # Count, sum and mean are exact; the quantiles are estimated from the buckets (see `histogram_quantile`).
+    labels = ", ".join(f"p{q * 100:g}" for q in QUANTILES)
+    for histogram in response.histograms:
+        name = histogram.labels.get("stage") or histogram.labels.get("method", "")
+        if not histogram.count:
+            logger.info("%s %s: count 0", histogram.name, name)
+        elif histogram.name.endswith("_seconds"):
+            values = ", ".join(f"{histogram_quantile(q, histogram) * 1e3:.3f}" for q in QUANTILES)
+            logger.info("%s %s: count %d, sum %.3f s, mean %.3f ms, estimated %s: %s ms", histogram.name, name,
+                        histogram.count, histogram.sum, histogram.sum / histogram.count * 1e3, labels, values)
+        else:
+            values = ", ".join(f"{histogram_quantile(q, histogram):.0f}" for q in QUANTILES)
+            logger.info("%s %s: count %d, sum %d, mean %.0f, estimated %s: %s", histogram.name, name,
+                        histogram.count, histogram.sum, histogram.sum / histogram.count, labels, values)
+    for counter in response.counters:
+        logger.info("%s %s: %d", counter.name, ", ".join(f"{k}={v}" for k, v in sorted(counter.labels.items())),
+                    counter.value)
+    return response
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Show the stage latencies and call counters of the metrics server.")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "localhost"), help="Host name of the server.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    query_stats(parse_args().host)
@@ -1,37 +1,118 @@
 import json
-from typing import Union
+from array import array
+from functools import partial
+from concurrent.futures import Executor
+from typing import Union, Optional
 
+import numpy as np
 from metrics_pb2 import ServerMetrics, MetricsRequest
-import flatbuffers
-from flatbuffers_schema.MetricsRequest import MetricsRequestStart, MetricsRequestAddMetrics, MetricsRequestEnd, \
-    MetricsRequestStartMetricsVector
-from flatbuffers_schema.ServerMetrics import ServerMetricsStart, ServerMetricsAddServerId, ServerMetricsAddCpuUsage, \
-    ServerMetricsAddMemoryUsage, ServerMetricsAddDiskUsage, ServerMetricsAddTimestamp, ServerMetricsEnd
+from data_generator import MetricColumns
+from codec import iso_to_epoch_ns, encode_json_rows, encode_ndjson_rows, encode_flatbuffers_rows, \
+    encode_flatbuffers_columnar, decode_flatbuffers_columnar, delimit_protobuf
 
+# Schema versions this client can send (see proto/metrics.proto): v1 has ISO 8601 timestamp strings, v2 has int64
+# epoch-nanosecond timestamps, optionally delta-encoded against a per-batch base.
+SCHEMA_VERSIONS = (1, 2)
 
-def serialize_json(metrics: list[dict[str, Union[str, float]]]) -> str:
+DEFAULT_CHUNK_SIZE = 50_000  # Samples per chunk of a multi-chunk container (see `serialize_chunked`).
+
+
+def serialize_json(
+        metrics: Union[list[dict[str, Union[str, float]]], MetricColumns],
+        schema_version: int = 1
+) -> str:
     """Serialize a list of metrics into a JSON string.
 
     Args:
-        metrics: List of metrics.
+        metrics: List of metrics or a columnar batch.
+        schema_version: 1 for "timestamp" ISO 8601 strings, 2 for integer "timestamp_ns" values.
 
     Returns:
         A JSON-encoded string representing the metrics.
 
     """
+    if isinstance(metrics, MetricColumns):
+        return serialize_json_columns(metrics, schema_version)
+    if schema_version == 2:
+        return encode_json_rows((m["server_id"], m["cpu_usage"], m["memory_usage"], m["disk_usage"],
+                                 iso_to_epoch_ns(m["timestamp"])) for m in metrics)
     return json.dumps(metrics)
 
 
-def serialize_protobuf(metrics: list[dict[str, Union[str, float]]]) -> MetricsRequest:
+def serialize_json_columns(metrics: MetricColumns, schema_version: int = 1) -> str:
+    """Serialize a columnar batch into the same JSON array as `serialize_json`, without building a dict per row.
+
+    Args:
+        metrics: Columnar batch of metrics.
+        schema_version: 1 for "timestamp" ISO 8601 strings, 2 for integer "timestamp_ns" values.
+
+    Returns:
+        A JSON-encoded string representing the metrics.
+
+    """
+    server_ids = metrics.server_ids
+    timestamps = metrics.timestamp_ns.tolist() if schema_version == 2 else metrics.iso_timestamps().tolist()
+    return encode_json_rows(((server_ids[i], cpu, memory, disk, timestamp) for i, cpu, memory, disk, timestamp in zip(
+        metrics.server_index.tolist(), metrics.cpu_usage.tolist(), metrics.memory_usage.tolist(),
+        metrics.disk_usage.tolist(), timestamps)), schema_version)
+
+
+def serialize_ndjson(
+        metrics: Union[list[dict[str, Union[str, float]]], MetricColumns],
+        schema_version: int = 1
+) -> bytes:
+    """Serialize metrics into newline-delimited JSON: the objects of `serialize_json`, one per line.
+
+    The text is encoded a block of lines at a time (see `codec.encode_ndjson_rows`); write it to a file with
+    `codec.NdjsonWriter` instead to bound the memory by a block.
+
+    Args:
+        metrics: List of metrics or a columnar batch.
+        schema_version: 1 for "timestamp" ISO 8601 strings, 2 for integer "timestamp_ns" values.
+
+    Returns:
+        The UTF-8 encoded lines.
+
+    """
+    if isinstance(metrics, MetricColumns):
+        server_ids = metrics.server_ids
+        timestamps = metrics.timestamp_ns.tolist() if schema_version == 2 else metrics.iso_timestamps().tolist()
+        rows = ((server_ids[i], cpu, memory, disk, timestamp) for i, cpu, memory, disk, timestamp in zip(
+            metrics.server_index.tolist(), metrics.cpu_usage.tolist(), metrics.memory_usage.tolist(),
+            metrics.disk_usage.tolist(), timestamps))
+    elif schema_version == 2:
+        rows = ((m["server_id"], m["cpu_usage"], m["memory_usage"], m["disk_usage"], iso_to_epoch_ns(m["timestamp"]))
+                for m in metrics)
+    else:
+        rows = ((m["server_id"], m["cpu_usage"], m["memory_usage"], m["disk_usage"], m["timestamp"]) for m in metrics)
+    return b"".join(block.encode("utf-8") for block in encode_ndjson_rows(rows, schema_version))
+
+
+def serialize_protobuf(
+        metrics: Union[list[dict[str, Union[str, float]]], MetricColumns],
+        schema_version: int = 1,
+        delta: bool = True
+) -> MetricsRequest:
     """Serialize a list of metrics into a Protobuf MetricsRequest object.
 
     Args:
-        metrics: List of metrics.
+        metrics: List of metrics or a columnar batch.
+        schema_version: 1 for ISO 8601 timestamp strings, 2 for epoch-nanosecond timestamps.
+        delta: With schema v2, store the timestamps as offsets from the first one (`base_timestamp_ns`).
 
     Returns:
         A Protobuf MetricsRequest object containing the serialized metrics.
 
     """
+    if isinstance(metrics, MetricColumns):
+        return serialize_protobuf_columns(metrics, schema_version, delta)
+    if schema_version == 2:
+        timestamps = [iso_to_epoch_ns(m["timestamp"]) for m in metrics]
+        request = MetricsRequest(schema_version=2, base_timestamp_ns=timestamps[0] if delta and timestamps else 0)
+        for m, timestamp in zip(metrics, timestamps):
+            request.metrics.add(server_id=m["server_id"], cpu_usage=m["cpu_usage"], memory_usage=m["memory_usage"],
+                                disk_usage=m["disk_usage"], timestamp_ns=timestamp - request.base_timestamp_ns)
+        return request
     request = MetricsRequest()  # Create an empty MetricsRequest object that will contain an array of metrics.
     for m in metrics:
         metric = request.metrics.add()  # Add a new ServerMetrics object to the request.metrics list. `add()` creates a new element and returns it for further filling.
@@ -43,45 +124,233 @@ def serialize_protobuf(metrics: list[dict[str, Union[str, float]]]) -> MetricsRe
     return request
 
 
-def serialize_flatbuffers(metrics: list[dict[str, Union[str, float]]]) -> bytes:
+def serialize_protobuf_columns(metrics: MetricColumns, schema_version: int = 1, delta: bool = True) -> MetricsRequest:
+    """Serialize a columnar batch into a Protobuf MetricsRequest object.
+
+    Args:
+        metrics: Columnar batch of metrics.
+        schema_version: 1 for ISO 8601 timestamp strings, 2 for epoch-nanosecond timestamps.
+        delta: With schema v2, store the timestamps as offsets from the first one (`base_timestamp_ns`).
+
+    Returns:
+        A Protobuf MetricsRequest object containing the serialized metrics.
+
+    """
+    request = MetricsRequest()
+    server_ids = metrics.server_ids
+    if schema_version == 2:
+        request.schema_version = 2
+        if delta and len(metrics):
+            request.base_timestamp_ns = int(metrics.timestamp_ns[0])
+        # The offsets are computed on the whole column at once; no timestamp is formatted or parsed.
+        for i, cpu, memory, disk, timestamp in zip(metrics.server_index.tolist(), metrics.cpu_usage.tolist(),
+                                                   metrics.memory_usage.tolist(), metrics.disk_usage.tolist(),
+                                                   (metrics.timestamp_ns - request.base_timestamp_ns).tolist()):
+            request.metrics.add(server_id=server_ids[i], cpu_usage=cpu, memory_usage=memory, disk_usage=disk,
+                                timestamp_ns=timestamp)
+        return request
+    for i, cpu, memory, disk, timestamp in zip(metrics.server_index.tolist(), metrics.cpu_usage.tolist(),
+                                               metrics.memory_usage.tolist(), metrics.disk_usage.tolist(),
+                                               metrics.iso_timestamps().tolist()):
+        request.metrics.add(server_id=server_ids[i], cpu_usage=cpu, memory_usage=memory, disk_usage=disk,
+                            timestamp=timestamp)
+    return request
+
+
+def serialize_flatbuffers(
+        metrics: Union[list[dict[str, Union[str, float]]], MetricColumns],
+        schema_version: int = 1,
+        delta: bool = True,
+        size_prefixed: bool = False
+) -> bytes:
     """Serialize a list of metrics into a FlatBuffers binary buffer.
 
     Args:
-        metrics: List of metrics.
+        metrics: List of metrics or a columnar batch.
+        schema_version: 1 for ISO 8601 timestamp strings, 2 for epoch-nanosecond timestamps.
+        delta: With schema v2, store the timestamps as offsets from the first one (`base_timestamp_ns`). FlatBuffers
+            scalars have a fixed size, so this does not make the buffer smaller; it is supported for symmetry with
+            Protobuf.
+        size_prefixed: Start the buffer with its size, for multi-chunk containers (see `serialize_chunked`).
 
     Returns:
         A FlatBuffers-encoded byte string containing the serialized metrics.
 
     """
-    builder = flatbuffers.Builder(
-        1024)  # Create a Builder object — a tool for constructing a FlatBuffers buffer. 1024 is the initial buffer size in bytes, which will grow if needed.
-    metric_offsets = []
-    for m in metrics:
-        # Create a string offset for server_id by writing the string into the buffer. CreateString returns the offset pointing to the beginning of the string in the buffer.
-        server_id = builder.CreateString(m["server_id"])
-        timestamp = builder.CreateString(m["timestamp"])
-        # Start building the ServerMetrics object in the buffer. ServerMetricsStart prepares a table for the ServerMetrics object, allocating space for field pointers.
-        ServerMetricsStart(builder)
-        # Add server_id to the ServerMetrics table using its offset.
-        ServerMetricsAddServerId(builder, server_id)
-        # Add cpu_usage as a float directly (without an offset, since it's a primitive type).
-        ServerMetricsAddCpuUsage(builder, m["cpu_usage"])
-        ServerMetricsAddMemoryUsage(builder, m["memory_usage"])
-        ServerMetricsAddDiskUsage(builder, m["disk_usage"])
-        ServerMetricsAddTimestamp(builder, timestamp)
-        # Finalize the ServerMetrics object and get its offset in the buffer.
-        metric_offsets.append(ServerMetricsEnd(builder))
-
-    MetricsRequestStartMetricsVector(
-        builder,
-        len(metrics))  # Start creating the metrics vector (array) in MetricsRequest. Specify the number of elements (len(metrics)) to reserve space.
-    # Add offsets of ServerMetrics objects to the vector in reverse order. PrependUOffsetTRelative adds offsets at the beginning of the vector (FlatBuffers builds the buffer from the end).
-    for offset in reversed(metric_offsets):
-        builder.PrependUOffsetTRelative(offset)
-    metrics_array = builder.EndVector(len(metrics))  # Finalize the vector and get its offset.
-
-    MetricsRequestStart(builder)  # Start building the root MetricsRequest object.
-    MetricsRequestAddMetrics(builder, metrics_array)  # Add the metrics vector to MetricsRequest using its offset.
-    request = MetricsRequestEnd(builder)  # Finalize MetricsRequest and get its offset.
-    builder.Finish(request)  # Finalize the entire buffer, specifying that request is the root object.
-    return builder.Output()  # Retrieve the final byte string (FlatBuffers buffer) for transmission or storage.
+    if isinstance(metrics, MetricColumns):
+        return serialize_flatbuffers_columns(metrics, schema_version, delta, size_prefixed)
+    if schema_version == 2:
+        timestamps = [iso_to_epoch_ns(m["timestamp"]) for m in metrics]
+        base = timestamps[0] if delta and timestamps else 0
+        return encode_flatbuffers_rows(
+            ((m["server_id"], m["cpu_usage"], m["memory_usage"], m["disk_usage"], timestamp - base)
+             for m, timestamp in zip(metrics, timestamps)), len(metrics), schema_version, base, size_prefixed)
+    return encode_flatbuffers_rows(
+        ((m["server_id"], m["cpu_usage"], m["memory_usage"], m["disk_usage"], m["timestamp"]) for m in metrics),
+        len(metrics), schema_version, size_prefixed=size_prefixed)
+
+
+def serialize_flatbuffers_columns(
+        metrics: MetricColumns,
+        schema_version: int = 1,
+        delta: bool = True,
+        size_prefixed: bool = False
+) -> bytes:
+    """Serialize a columnar batch into the same FlatBuffers MetricsRequest buffer as `serialize_flatbuffers`.
+
+    Every distinct server ID is written once and its offset is shared by all the tables that refer to it.
+
+    Args:
+        metrics: Columnar batch of metrics.
+        schema_version: 1 for ISO 8601 timestamp strings, 2 for epoch-nanosecond timestamps.
+        delta: With schema v2, store the timestamps as offsets from the first one (`base_timestamp_ns`).
+        size_prefixed: Start the buffer with its size.
+
+    Returns:
+        A FlatBuffers-encoded byte string containing the serialized metrics.
+
+    """
+    base = 0
+    if schema_version == 2:
+        base = int(metrics.timestamp_ns[0]) if delta and len(metrics) else 0
+        timestamps = (metrics.timestamp_ns - base).tolist()
+    else:
+        timestamps = metrics.iso_timestamps().tolist()
+    server_ids = metrics.server_ids
+    rows = ((server_ids[i], cpu, memory, disk, timestamp) for i, cpu, memory, disk, timestamp in zip(
+        metrics.server_index.tolist(), metrics.cpu_usage.tolist(), metrics.memory_usage.tolist(),
+        metrics.disk_usage.tolist(), timestamps))
+    return encode_flatbuffers_rows(rows, len(metrics), schema_version, base, size_prefixed)
+
+
+def serialize_flatbuffers_columnar(
+        metrics: Union[list[dict[str, Union[str, float]]], MetricColumns],
+        size_prefixed: bool = False
+) -> bytes:
+    """Serialize a list of metrics into a columnar FlatBuffers MetricsBatch buffer.
+
+    Args:
+        metrics: List of metrics or a columnar batch.
+        size_prefixed: Start the buffer with its size, for multi-chunk containers (see `serialize_chunked`).
+
+    Returns:
+        A FlatBuffers-encoded byte string with one vector per field and dictionary-encoded server IDs.
+
+    """
+    if isinstance(metrics, MetricColumns):
+        return serialize_flatbuffers_columnar_columns(metrics, size_prefixed)
+    server_ids = {}  # Server ID -> index in the dictionary (dicts keep insertion order).
+    server_index = array("I", [server_ids.setdefault(m["server_id"], len(server_ids)) for m in metrics])
+    return encode_flatbuffers_columnar(list(server_ids), server_index, array("f", [m["cpu_usage"] for m in metrics]),
+                                       array("f", [m["memory_usage"] for m in metrics]),
+                                       array("f", [m["disk_usage"] for m in metrics]),
+                                       array("q", [iso_to_epoch_ns(m["timestamp"]) for m in metrics]), size_prefixed)
+
+
+def serialize_flatbuffers_columnar_columns(metrics: MetricColumns, size_prefixed: bool = False) -> bytes:
+    """Serialize a columnar batch into a MetricsBatch buffer, copying every NumPy column into the buffer in one step.
+
+    Args:
+        metrics: Columnar batch of metrics.
+        size_prefixed: Start the buffer with its size.
+
+    Returns:
+        A FlatBuffers-encoded byte string with one vector per field and dictionary-encoded server IDs.
+
+    """
+    return encode_flatbuffers_columnar(metrics.server_ids, metrics.server_index, metrics.cpu_usage,
+                                       metrics.memory_usage, metrics.disk_usage, metrics.timestamp_ns, size_prefixed)
+
+
+def deserialize_flatbuffers_columnar(buf: bytes) -> dict[str, Union[list[str], np.ndarray]]:
+    """Read the columns of a MetricsBatch buffer without copying them (see `codec.decode_flatbuffers_columnar`).
+
+    Args:
+        buf: A buffer produced by `serialize_flatbuffers_columnar`.
+
+    Returns:
+        A dictionary with the server ID dictionary ("server_ids", a list of strings) and one NumPy array per column
+        ("server_index", "cpu_usage", "memory_usage", "disk_usage", "timestamp_ns") that points into `buf`.
+
+    """
+    return decode_flatbuffers_columnar(buf)
+
+
+def serialize_chunk(
+        fmt: str,
+        metrics: Union[list[dict[str, Union[str, float]]], MetricColumns],
+        schema_version: int = 1,
+        delta: bool = True
+) -> bytes:
+    """Serialize one chunk of a multi-chunk container, with its framing (see `codec.iter_container_chunks`).
+
+    This is the function run by the worker processes of `serialize_chunked`, so it is defined at module level.
+
+    Args:
+        fmt: The format ("json", "ndjson", "proto", "flatbuf" or "flatcol").
+        metrics: The metrics of the chunk.
+        schema_version: The schema version of the row formats.
+        delta: With schema v2, delta-encode the timestamps of the chunk against its first one.
+
+    Returns:
+        The framed chunk: a JSON array and a newline, NDJSON lines, a length-delimited MetricsRequest, or a
+        size-prefixed buffer.
+
+    Raises:
+        ValueError: If the format is unknown.
+
+    """
+    if fmt == "json":
+        return serialize_json(metrics, schema_version).encode("utf-8") + b"\n"
+    if fmt == "ndjson":  # Self-delimiting: the container is the concatenated lines, i.e. NDJSON of all the metrics.
+        return serialize_ndjson(metrics, schema_version)
+    if fmt == "proto":
+        return delimit_protobuf(serialize_protobuf(metrics, schema_version, delta).SerializeToString())
+    if fmt == "flatbuf":
+        return serialize_flatbuffers(metrics, schema_version, delta, size_prefixed=True)
+    if fmt == "flatcol":
+        return serialize_flatbuffers_columnar(metrics, size_prefixed=True)
+    raise ValueError(f"Unknown format: {fmt}")
+
+
+def split_metrics(
+        metrics: Union[list[dict[str, Union[str, float]]], MetricColumns],
+        chunk_size: int
+) -> list[Union[list[dict[str, Union[str, float]]], MetricColumns]]:
+    """Split metrics into consecutive chunks of at most `chunk_size` samples."""
+    if isinstance(metrics, MetricColumns):
+        return [metrics.slice(start, start + chunk_size) for start in range(0, len(metrics), chunk_size)]
+    return [metrics[start:start + chunk_size] for start in range(0, len(metrics), chunk_size)]
+
+
+def serialize_chunked(
+        metrics: Union[list[dict[str, Union[str, float]]], MetricColumns],
+        fmt: str,
+        schema_version: int = 1,
+        delta: bool = True,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        executor: Optional[Executor] = None
+) -> bytes:
+    """Serialize metrics into a multi-chunk container, encoding the chunks in parallel.
+
+    Every chunk is a complete payload of the format, so the container can be read (or sent, see
+    `client.send_container`) one chunk at a time with `codec.iter_container_chunks`.
+
+    Args:
+        metrics: List of metrics or a columnar batch.
+        fmt: The format ("json", "ndjson", "proto", "flatbuf" or "flatcol").
+        schema_version: The schema version of the row formats.
+        delta: With schema v2, delta-encode the timestamps of every chunk against its first one.
+        chunk_size: The maximum number of samples per chunk.
+        executor: The executor that encodes the chunks, typically a ProcessPoolExecutor (a thread pool would be held
+            back by the GIL). The chunks are encoded one after another in the calling process if it is None.
+
+    Returns:
+        The container: the framed chunks, in order.
+
+    """
+    encode = partial(serialize_chunk, fmt, schema_version=schema_version, delta=delta)
+    chunks = split_metrics(metrics, chunk_size)
+    if executor is None:
+        return b"".join(map(encode, chunks))
+    return b"".join(executor.map(encode, chunks))
@@ -0,0 +1,153 @@
+import socket
+import logging
+import collections
+from multiprocessing import shared_memory
+from typing import Any, Optional, Union
+
+from shm_ring import HELLO, BATCH, ACK, MAGIC, ACK_OK, ACK_STATUSES, DEFAULT_RING_BYTES, align, recv_exactly
+
+logger = logging.getLogger(__name__)
+
+
+class ShmRingClient:
+    """Send batches to a server on the same host through a shared-memory ring buffer (see shm_ring.py).
+
+    `send` copies a batch into the ring and announces it on the control channel without waiting for the server, so
+    several batches can be in flight; it blocks while the ring has no room for the batch or `max_in_flight` batches
+    are unacknowledged. `flush` waits until every batch sent so far is acknowledged.
+
+    The ring is created by the client and removed by `close`.
+
+    """
+
+    def __init__(
+            self,
+            socket_path: str,
+            capacity: int = DEFAULT_RING_BYTES,
+            max_in_flight: int = 64,
+            timeout_s: Optional[float] = 30.0
+    ) -> None:
+        """Create the ring and connect to the server.
+
+        Args:
+            socket_path: Path of the Unix socket of the server (SHM_SOCKET on the server).
+            capacity: Size of the ring in bytes; no batch can be larger.
+            max_in_flight: Maximum number of unacknowledged batches.
+            timeout_s: Maximum time to wait for an acknowledgement (None to wait forever).
+
+        Raises:
+            OSError: If the ring cannot be created or the server cannot be reached.
+
+        """
+        self.capacity = align(capacity)
+        self.max_in_flight = max_in_flight
+        self.ring = shared_memory.SharedMemory(create=True, size=self.capacity)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(timeout_s)
+            self.sock.connect(socket_path)
+            name = self.ring.name.encode("utf-8")
+            self.sock.sendall(HELLO.pack(MAGIC, self.capacity, len(name)) + name)
+        except OSError:
+            self._release()
+            raise
+        self.head = 0  # Where the next batch is written.
+        self.pending = collections.deque()  # (sequence, start, end) of the unacknowledged batches, in ring order.
+        self.sequence = 0
+        self.metrics_count = 0  # Metrics saved by the server (acknowledged).
+        logger.info("Connected to %s with a %.1f MiB shared-memory ring (%s).", socket_path, self.capacity / 2 ** 20,
+                    self.ring.name)
+
+    def __enter__(self) -> "ShmRingClient":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def _allocate(self, size: int) -> Optional[int]:
+        """Return where a batch of `size` (aligned) bytes fits in the free space of the ring, or None if it does not."""
+        if not self.pending:
+            self.head = 0
+            return 0
+        tail = self.pending[0][1]  # Start of the oldest unacknowledged batch.
+        if self.head > tail:  # Free space after the head and before the tail (at the start of the ring).
+            if self.head + size <= self.capacity:
+                return self.head
+            # Wrap around: the end of the ring stays unused until the batches before it are freed.
+            return 0 if size <= tail else None
+        return self.head if self.head + size <= tail else None  # Wrapped around: head == tail means full.
+
+    def _read_ack(self) -> None:
+        """Wait for the acknowledgement of the oldest batch in flight and free its space.
+
+        Raises:
+            RuntimeError: If the server did not save the batch.
+            ConnectionError: If the control channel is closed or out of sync.
+
+        """
+        sequence, metrics_count, status = ACK.unpack(recv_exactly(self.sock, ACK.size))
+        expected = self.pending.popleft()[0]
+        if sequence != expected:
+            raise ConnectionError(f"Acknowledgement of batch {sequence} received while waiting for batch {expected}.")
+        if status != ACK_OK:
+            raise RuntimeError(f"Batch {sequence} was not saved by the server: "
+                               f"{ACK_STATUSES.get(status, status)} (see the server log).")
+        self.metrics_count += metrics_count
+
+    def send(self, batch: Union[bytes, memoryview]) -> int:
+        """Copy a batch into the ring and announce it to the server.
+
+        Args:
+            batch: A MetricsBatch buffer (see `serializers.serialize_flatbuffers_columnar`).
+
+        Returns:
+            The sequence number of the batch.
+
+        Raises:
+            ValueError: If the batch is larger than the ring.
+            RuntimeError: If an earlier batch was not saved by the server.
+            ConnectionError: If the control channel is closed.
+
+        """
+        size = len(batch)
+        aligned = align(size)
+        if aligned > self.capacity:
+            raise ValueError(f"Batch of {size} bytes larger than the {self.capacity}-byte ring.")
+        while True:
+            if len(self.pending) < self.max_in_flight:
+                offset = self._allocate(aligned)
+                if offset is not None:
+                    break
+            self._read_ack()  # Back-pressure: wait until the server frees some space.
+        self.ring.buf[offset:offset + size] = batch
+        sequence = self.sequence
+        self.sequence += 1
+        self.pending.append((sequence, offset, offset + aligned))
+        self.head = offset + aligned
+        self.sock.sendall(BATCH.pack(sequence, offset, size))
+        return sequence
+
+    def flush(self) -> int:
+        """Wait until every batch sent so far is saved, and return the number of metrics saved since the start.
+
+        Raises:
+            RuntimeError: If a batch was not saved by the server.
+            ConnectionError: If the control channel is closed.
+
+        """
+        while self.pending:
+            self._read_ack()
+        return self.metrics_count
+
+    def close(self) -> None:
+        """Wait for the batches in flight, disconnect, and remove the ring."""
+        try:
+            if self.pending:
+                self.flush()
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        self.sock.close()
+        self.ring.close()
+        self.ring.unlink()
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import logging
+import argparse
+from functools import partial
+from typing import Any, Callable, Optional
+
+import grpc
+
+from metrics_pb2 import MetricsResponse, StatsRequest
+from metrics_pb2_grpc import MetricsServiceStub
+from client import connect
+from data_generator import generate_metric_batches
+from serializers import serialize_protobuf, serialize_flatbuffers_columnar
+from shm_ring import DEFAULT_RING_BYTES
+from shm_client import ShmRingClient
+from load_generator import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+SEND_METRICS_METHOD = "/MetricsService/SendMetrics"
+TRANSPORTS = ("tcp", "uds", "shm")
+DISTINCT_BATCHES = 8  # Batches are generated once and sent in turn.
+SERVER_METHODS = {"tcp": "SendMetrics", "uds": "SendMetrics", "shm": "SendMetricsShm"}  # Method labels in GetStats.
+
+
+def server_time(stub: MetricsServiceStub, method: str) -> tuple[int, float]:
+    """Return the number of calls of a method recorded by the server, and the time spent parsing and handling calls.
+
+    The parse time is not broken down by method, so it is only meaningful while one transport is used at a time.
+
+    """
+    response = stub.GetStats(StatsRequest(), timeout=5)
+    calls = 0
+    seconds = 0.0
+    for histogram in response.histograms:
+        if histogram.name == "rpc_duration_seconds" and histogram.labels.get("method") == method:
+            calls += histogram.count
+            seconds += histogram.sum
+        elif histogram.name == "stage_duration_seconds" and histogram.labels.get("stage") == "parse":
+            seconds += histogram.sum
+    return calls, seconds
+
+
+def measure_transport(
+        send: Callable[[bytes], int],
+        payloads: list[bytes],
+        batches: int,
+        warmup: int,
+        server_totals: Optional[Callable[[], tuple[int, float]]] = None
+) -> dict[str, Any]:
+    """Send batches one at a time and measure the latency of every one, from the send to the acknowledgement.
+
+    Args:
+        send: Sends one batch and waits until the server has saved it; returns the number of saved metrics.
+        payloads: The batches, sent in turn.
+        batches: Number of measured batches.
+        warmup: Number of batches sent before measuring.
+        server_totals: Returns the calls recorded by the server and the time it spent on them (see `server_time`).
+
+    Returns:
+        The number of batches, the throughput (batches, rows and bytes per second) and the latency summary. With
+        `server_totals`, also the mean time the server spent on a batch, and the mean transport overhead: the rest of
+        the latency (sending, receiving and copying the batch and its acknowledgement, on both sides).
+
+    """
+    for i in range(warmup):
+        send(payloads[i % len(payloads)])
+    before = server_totals() if server_totals is not None else None
+    histogram = LatencyHistogram()
+    rows = size = 0
+    started = time.perf_counter_ns()
+    for i in range(batches):
+        payload = payloads[i % len(payloads)]
+        start = time.perf_counter_ns()
+        rows += send(payload)
+        histogram.record(time.perf_counter_ns() - start)
+        size += len(payload)
+    elapsed = (time.perf_counter_ns() - started) / 1e9
+    result = {"batches": batches, "batches_per_s": batches / elapsed, "rows_per_s": rows / elapsed,
+              "bytes_per_s": size / elapsed, "latency": histogram.summary()}
+    if before is not None:
+        calls, seconds = server_totals()
+        if calls > before[0]:
+            result["server_mean_us"] = (seconds - before[1]) / (calls - before[0]) * 1e6
+            result["overhead_mean_us"] = result["latency"]["mean_us"] - result["server_mean_us"]
+    return result
+
+
+def run_transport_bench(
+        server_host: str,
+        transports: list[str],
+        socket_path: Optional[str],
+        shm_socket: Optional[str],
+        batch_size: int,
+        batches: int,
+        warmup: int,
+        ring_bytes: int = DEFAULT_RING_BYTES,
+        output: Optional[str] = None
+) -> dict[str, Any]:
+    """Compare the transports to a server on the same host, and save the report as JSON.
+
+    * "tcp": SendMetrics over TCP (port 50051 of the host);
+    * "uds": SendMetrics over the Unix socket of the server (SERVER_SOCKET on the server);
+    * "shm": the shared-memory transport (SHM_SOCKET on the server).
+
+    The gRPC transports send serialized schema v2 MetricsRequest messages, and the shared-memory transport columnar
+    FlatBuffers batches; both are encoded before measuring. Every batch is saved by the server before the next one is
+    sent, so the latencies include the work of the server. The time the server spent parsing and saving the batches is
+    read from its statistics (GetStats) and subtracted, which gives the overhead of every transport; this requires a
+    single server process (SERVER_WORKERS=1).
+
+    Args:
+        server_host: Host name of the gRPC server.
+        transports: The transports to compare (see TRANSPORTS).
+        socket_path: The Unix socket of the gRPC server ("uds").
+        shm_socket: The Unix socket of the shared-memory transport ("shm").
+        batch_size: Metrics per batch.
+        batches: Number of measured batches per transport.
+        warmup: Number of batches sent before measuring.
+        ring_bytes: Size of the shared-memory ring.
+        output: Path of the JSON report (default: RESULTS_PATH/transport_bench.json).
+
+    Returns:
+        The report.
+
+    """
+    chunks = list(generate_metric_batches(batch_size * DISTINCT_BATCHES, batch_size, seed=42))
+    payloads = {
+        "grpc": [serialize_protobuf(chunk, 2).SerializeToString() for chunk in chunks],
+        "shm": [serialize_flatbuffers_columnar(chunk) for chunk in chunks]
+    }
+    stats_channel = connect(server_host)
+    if stats_channel is None:
+        raise ConnectionError(f"Server {server_host} not available.")
+    stats_stub = MetricsServiceStub(stats_channel)
+    results = {}
+    try:
+        for transport in transports:
+            method_time = partial(server_time, stats_stub, SERVER_METHODS[transport])
+            if transport == "shm":
+                if not shm_socket:
+                    logger.warning("Skipping shm: no shared-memory socket (--shm-socket or SHM_SOCKET).")
+                    continue
+                with ShmRingClient(shm_socket, ring_bytes) as ring:
+                    def send(payload: bytes) -> int:
+                        before = ring.metrics_count
+                        ring.send(payload)
+                        return ring.flush() - before
+
+                    results[transport] = measure_transport(send, payloads["shm"], batches, warmup, method_time)
+            else:
+                if transport == "uds" and not socket_path:
+                    logger.warning("Skipping uds: no server socket (--socket or SERVER_SOCKET).")
+                    continue
+                channel = connect(server_host, target=f"unix:{socket_path}" if transport == "uds" else
+                                  f"{server_host}:50051")
+                if channel is None:
+                    continue
+                with channel:
+                    # The messages are already serialized: they are sent as they are.
+                    call = channel.unary_unary(SEND_METRICS_METHOD, request_serializer=None,
+                                               response_deserializer=MetricsResponse.FromString)
+                    results[transport] = measure_transport(lambda payload: call(payload).metrics_count,
+                                                           payloads["grpc"], batches, warmup, method_time)
+            result = results[transport]
+            latency = result["latency"]
+            logger.info("%-3s: %.0f batches/s, %.0f rows/s, %.1f MB/s; latency p50 %.3f ms, p99 %.3f ms, max %.3f ms; "
+                        "transport overhead %.1f us per batch.", transport, result["batches_per_s"],
+                        result["rows_per_s"], result["bytes_per_s"] / 1e6, latency["p50_us"] / 1000,
+                        latency["p99_us"] / 1000, latency["max_us"] / 1000,
+                        result.get("overhead_mean_us", float("nan")))
+    finally:
+        stats_channel.close()
+
+    report = {
+        "settings": {"batch_size": batch_size, "batches": batches, "warmup": warmup, "ring_bytes": ring_bytes,
+                     "grpc_batch_bytes": len(payloads["grpc"][0]), "shm_batch_bytes": len(payloads["shm"][0])},
+        "transports": results
+    }
+    output = output or os.path.join(os.getenv("RESULTS_PATH", "."), "transport_bench.json")
+    with open(output, "w") as f_report:
+        json.dump(report, f_report, indent=2)
+    logger.info("Transport benchmark report saved to %s", output)
+    return report
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare TCP, Unix socket and shared-memory transports to a local "
+                                                 "metrics server.")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "localhost"), help="Host name of the server.")
+    parser.add_argument("--transports", default=",".join(TRANSPORTS), help="Comma-separated transports to compare.")
+    parser.add_argument("--socket", default=os.getenv("SERVER_SOCKET"), help="Unix socket of the gRPC server.")
+    parser.add_argument("--shm-socket", default=os.getenv("SHM_SOCKET"),
+                        help="Unix socket of the shared-memory transport.")
+    parser.add_argument("--batch-size", type=int, default=10_000, help="Metrics per batch.")
+    parser.add_argument("--batches", type=int, default=200, help="Measured batches per transport.")
+    parser.add_argument("--warmup", type=int, default=10, help="Batches sent before measuring.")
+    parser.add_argument("--ring-bytes", type=int, default=int(os.getenv("SHM_RING_BYTES", str(DEFAULT_RING_BYTES))),
+                        help="Size of the shared-memory ring.")
+    parser.add_argument("--output", default=None, help="JSON report (default: RESULTS_PATH/transport_bench.json).")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    unknown = set(args.transports.split(",")) - set(TRANSPORTS)
+    if unknown:
+        raise ValueError(f"Unknown transports: {', '.join(sorted(unknown))}")
+    try:
+        run_transport_bench(args.host, args.transports.split(","), args.socket, args.shm_socket, args.batch_size,
+                            args.batches, args.warmup, args.ring_bytes, args.output)
+    except (grpc.RpcError, OSError, RuntimeError) as e:  # ConnectionError is an OSError.
+        logger.error("Transport benchmark failed: %s", e)
@@ -0,0 +1,667 @@
+import os
+import json
+import math
+import struct
+import datetime
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from operator import itemgetter
+from typing import BinaryIO, Iterable, Iterator, Optional, Union
+
+import flatbuffers
+import numpy as np
+from flatbuffers_schema.MetricsRequest import MetricsRequestStart, MetricsRequestAddMetrics, MetricsRequestEnd, \
+    MetricsRequestStartMetricsVector, MetricsRequestAddSchemaVersion, MetricsRequestAddBaseTimestampNs
+from flatbuffers_schema.ServerMetrics import ServerMetricsStart, ServerMetricsAddServerId, ServerMetricsAddCpuUsage, \
+    ServerMetricsAddMemoryUsage, ServerMetricsAddDiskUsage, ServerMetricsAddTimestamp, ServerMetricsAddTimestampNs, \
+    ServerMetricsEnd
+from flatbuffers_schema.MetricsBatch import MetricsBatch, MetricsBatchStart, MetricsBatchAddServerIds, \
+    MetricsBatchAddServerIndex, MetricsBatchAddCpuUsage, MetricsBatchAddMemoryUsage, MetricsBatchAddDiskUsage, \
+    MetricsBatchAddTimestampNs, MetricsBatchEnd, MetricsBatchStartServerIdsVector
+
+# Encoders and decoders shared by the client and the server (copied next to both of them in their images, and imported
+# as `codec`). Rows are passed around as (server_id, cpu_usage, memory_usage, disk_usage, timestamp) tuples, so every
+# format is written straight from the source objects, without building a dict per sample.
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# The numeric columns of a MetricsBatch, with the generated accessors that return them as NumPy arrays over the buffer
+# (without going through the per-element accessors), and their type.
+METRICS_BATCH_COLUMNS = {
+    "server_index": (MetricsBatch.ServerIndexAsNumpy, np.uint32),
+    "cpu_usage": (MetricsBatch.CpuUsageAsNumpy, np.float32),
+    "memory_usage": (MetricsBatch.MemoryUsageAsNumpy, np.float32),
+    "disk_usage": (MetricsBatch.DiskUsageAsNumpy, np.float32),
+    "timestamp_ns": (MetricsBatch.TimestampNsAsNumpy, np.int64)
+}
+
+ROW_TABLE_BYTES = 48  # Approximate size of one ServerMetrics table (without its server ID), for pre-sizing.
+
+MAX_REUSED_BUILDER_BYTES = 16 * 1024 * 1024  # Larger builders are dropped after use instead of being kept per thread.
+
+Row = tuple[str, float, float, float, Union[int, str]]
+
+# Multi-chunk containers (see `iter_container_chunks`).
+CONTAINER_FORMATS = ("json", "proto", "flatbuf", "flatcol")
+SIZE_PREFIX = struct.Struct("<I")  # The size prefix of FlatBuffers buffers finished with `FinishSizePrefixed`.
+
+# Newline-delimited JSON (see `NdjsonWriter` and `iter_ndjson`): rows encoded per write, bytes parsed per read, and
+# bytes per range of the parallel reader.
+NDJSON_BLOCK_ROWS = 10_000
+NDJSON_BLOCK_BYTES = 1024 * 1024
+NDJSON_RANGE_BYTES = 8 * 1024 * 1024
+
+_builders = threading.local()
+
+
+def iso_to_epoch_ns(timestamp: str) -> int:
+    """Convert an ISO 8601 timestamp to Unix epoch nanoseconds.
+
+    Args:
+        timestamp: The timestamp string. Naive timestamps (as produced by `datetime.now().isoformat()`) are treated as
+            UTC.
+
+    Returns:
+        The number of nanoseconds since the Unix epoch.
+
+    """
+    dt = datetime.datetime.fromisoformat(timestamp)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return (dt - EPOCH) // datetime.timedelta(microseconds=1) * 1000  # Integer arithmetic: no float rounding.
+
+
+@contextmanager
+def reused_builder(size_hint: int) -> Iterator[flatbuffers.Builder]:
+    """Lend the FlatBuffers builder of the calling thread, cleared and at least `size_hint` bytes large.
+
+    Reusing the builder avoids allocating (and growing, which copies the buffer every time it doubles) a new bytearray
+    for every batch. `Output()` copies the finished buffer, so the result stays valid after the builder is reused. A
+    nested call in the same thread gets a fresh builder.
+
+    """
+    builder = getattr(_builders, "builder", None)
+    if builder is None or getattr(_builders, "in_use", False) or len(builder.Bytes) < size_hint:
+        builder = flatbuffers.Builder(size_hint)
+    else:
+        builder.Clear()
+    nested = getattr(_builders, "in_use", False)
+    _builders.in_use = True
+    try:
+        yield builder
+    finally:
+        if not nested:
+            _builders.in_use = False
+            _builders.builder = builder if len(builder.Bytes) <= MAX_REUSED_BUILDER_BYTES else None
+
+
+def json_float(value: float) -> str:
+    """Format a float exactly as the json module does (repr, with NaN and infinities spelled the JSON way)."""
+    return repr(value) if math.isfinite(value) else json.dumps(value)
+
+
+def iter_json_objects(rows: Iterable[Row], schema_version: int = 2, escaped: Optional[dict[str, str]] = None
+                      ) -> Iterator[str]:
+    """Format rows as the JSON objects `json.dumps` writes for the equivalent dicts, one string per row.
+
+    Every distinct server ID is escaped once; the objects are formatted directly into the output.
+
+    Args:
+        rows: The rows. Timestamps are epoch nanoseconds (schema v2) or ISO 8601 strings (schema v1).
+        schema_version: 2 to write "timestamp_ns" integers, 1 to write "timestamp" strings.
+        escaped: Cache of the escaped server IDs (server ID -> JSON string literal), kept across calls by the caller.
+
+    Yields:
+        The JSON text of every row.
+
+    """
+    escaped = {} if escaped is None else escaped
+    timestamp_key = '"timestamp_ns"' if schema_version == 2 else '"timestamp"'
+    if schema_version != 2:
+        rows = ((server_id, cpu, memory, disk, json.dumps(timestamp))  # Quoted (and escaped) ISO 8601 strings.
+                for server_id, cpu, memory, disk, timestamp in rows)
+    for server_id, cpu, memory, disk, timestamp in rows:
+        literal = escaped.get(server_id)
+        if literal is None:
+            literal = escaped[server_id] = json.dumps(server_id)
+        total = cpu + memory + disk
+        if total - total == 0.0:  # All three are finite (NaN and infinities make the difference NaN).
+            yield (f'{{"server_id": {literal}, "cpu_usage": {cpu!r}, "memory_usage": {memory!r}, '
+                   f'"disk_usage": {disk!r}, {timestamp_key}: {timestamp}}}')
+        else:
+            yield (f'{{"server_id": {literal}, "cpu_usage": {json_float(cpu)}, "memory_usage": {json_float(memory)}, '
+                   f'"disk_usage": {json_float(disk)}, {timestamp_key}: {timestamp}}}')
+
+
+def encode_json_rows(rows: Iterable[Row], schema_version: int = 2) -> str:
+    """Write rows as the JSON array produced by `json.dumps` on the equivalent list of dicts, in one pass.
+
+    Args:
+        rows: The rows. Timestamps are epoch nanoseconds (schema v2) or ISO 8601 strings (schema v1).
+        schema_version: 2 to write "timestamp_ns" integers, 1 to write "timestamp" strings.
+
+    Returns:
+        The JSON text.
+
+    """
+    return "[" + ", ".join(iter_json_objects(rows, schema_version)) + "]"
+
+
+def encode_ndjson_rows(
+        rows: Iterable[Row],
+        schema_version: int = 2,
+        block_rows: int = NDJSON_BLOCK_ROWS,
+        escaped: Optional[dict[str, str]] = None
+) -> Iterator[str]:
+    """Write rows as newline-delimited JSON (one object per line, see `iter_json_objects`), a block at a time.
+
+    Only one block of lines is held at a time, whatever the number of rows.
+
+    Yields:
+        Blocks of at most `block_rows` lines, each line ending with a newline.
+
+    """
+    block = []
+    for line in iter_json_objects(rows, schema_version, escaped):
+        block.append(line)
+        if len(block) == block_rows:
+            block.append("")
+            yield "\n".join(block)
+            block = []
+    if block:
+        block.append("")
+        yield "\n".join(block)
+
+
+class NdjsonWriter:
+    """Chunked writer of newline-delimited JSON rows to a binary file.
+
+    Rows are encoded and written a block at a time, so the memory used does not depend on how many rows are written,
+    in one call or over many. The escaped server IDs are cached for the life of the writer.
+
+    """
+
+    def __init__(self, f: BinaryIO, schema_version: int = 2, block_rows: int = NDJSON_BLOCK_ROWS) -> None:
+        """Initialize the writer.
+
+        Args:
+            f: The output, opened for writing in binary mode (ideally buffered: see `open`).
+            schema_version: 2 to write "timestamp_ns" integers, 1 to write "timestamp" strings.
+            block_rows: Rows encoded per write.
+
+        """
+        self.f = f
+        self.schema_version = schema_version
+        self.block_rows = block_rows
+        self.rows_count = 0
+        self.bytes_count = 0
+        self._escaped = {}
+
+    def write_rows(self, rows: Iterable[Row]) -> None:
+        for block in encode_ndjson_rows(rows, self.schema_version, self.block_rows, self._escaped):
+            data = block.encode("utf-8")
+            self.f.write(data)
+            self.rows_count += block.count("\n")
+            self.bytes_count += len(data)
+
+
+def parse_ndjson_block(data: Union[bytes, memoryview], columns: bool = False) -> Union[list[dict], dict]:
+    """Parse complete lines of newline-delimited JSON metrics.
+
+    The lines are parsed by one `json.loads` call, as the elements of an array: raw newlines cannot appear inside
+    JSON values, so they only separate the objects.
+
+    Args:
+        data: Whole lines (the last newline is optional; blank lines are skipped).
+        columns: Return columns instead of dicts.
+
+    Returns:
+        The rows as dicts, or the columns: the server ID dictionary ("server_ids") and NumPy arrays like those of
+        `decode_flatbuffers_columnar` ("server_index", "cpu_usage", "memory_usage", "disk_usage", "timestamp_ns";
+        schema v1 timestamps are converted).
+
+    Raises:
+        ValueError: If a line is not valid JSON.
+
+    """
+    data = bytes(data).strip()
+    if b"\n\n" in data or b"\r" in data:
+        data = b"\n".join(line for line in data.splitlines() if line.strip())
+    rows = json.loads(b"[" + data.replace(b"\n", b",") + b"]") if data else []
+    if not columns:
+        return rows
+    if not rows:
+        return concat_columns([])
+    # Transposed with C-level iteration (itemgetter, zip) rather than a Python loop per row.
+    server_id, cpu_usage, memory_usage, disk_usage = zip(*map(
+        itemgetter("server_id", "cpu_usage", "memory_usage", "disk_usage"), rows))
+    codes = {key: code for code, key in enumerate(dict.fromkeys(server_id))}
+    try:
+        timestamp_ns = np.fromiter(map(itemgetter("timestamp_ns"), rows), np.int64, len(rows))
+    except KeyError:  # Schema v1 rows.
+        timestamp_ns = np.fromiter((m["timestamp_ns"] if "timestamp_ns" in m else iso_to_epoch_ns(m["timestamp"])
+                                    for m in rows), np.int64, len(rows))
+    return {
+        "server_ids": list(codes),
+        "server_index": np.fromiter(map(codes.__getitem__, server_id), np.uint32, len(rows)),
+        "cpu_usage": np.array(cpu_usage, dtype=np.float32),
+        "memory_usage": np.array(memory_usage, dtype=np.float32),
+        "disk_usage": np.array(disk_usage, dtype=np.float32),
+        "timestamp_ns": timestamp_ns
+    }
+
+
+def iter_ndjson(
+        f: BinaryIO,
+        columns: bool = False,
+        block_bytes: int = NDJSON_BLOCK_BYTES,
+        end: Optional[int] = None
+) -> Iterator[Union[list[dict], dict]]:
+    """Read newline-delimited JSON metrics incrementally, a block of lines at a time.
+
+    Memory is bounded by the block size (plus the longest line), whatever the size of the file.
+
+    Args:
+        f: The input, opened in binary mode and positioned at the start of a line.
+        columns: Yield columns instead of dicts (see `parse_ndjson_block`).
+        block_bytes: Bytes read at a time.
+        end: Stop at this offset of the file (the end of a line), instead of the end of the file.
+
+    Yields:
+        The parsed blocks: lists of dicts, or columns.
+
+    Raises:
+        ValueError: If a line is not valid JSON.
+
+    """
+    remaining = None if end is None else end - f.tell()
+    rest = b""
+    while remaining is None or remaining > 0:
+        data = f.read(block_bytes if remaining is None else min(block_bytes, remaining))
+        if not data:
+            break
+        if remaining is not None:
+            remaining -= len(data)
+        last_line_end = data.rfind(b"\n") + 1
+        if not last_line_end:  # A line longer than the block.
+            rest += data
+            continue
+        yield parse_ndjson_block(rest + data[:last_line_end], columns)
+        rest = data[last_line_end:]
+    if rest.strip():
+        yield parse_ndjson_block(rest, columns)
+
+
+def ndjson_ranges(path: str, range_bytes: int) -> list[tuple[int, int]]:
+    """Split a newline-delimited JSON file into byte ranges of about `range_bytes` bytes that hold whole lines."""
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as f_ndjson:
+        while boundaries[-1] + range_bytes < size:
+            f_ndjson.seek(boundaries[-1] + range_bytes - 1)
+            f_ndjson.readline()  # To the start of the next line (the range may already end with a newline).
+            boundaries.append(f_ndjson.tell())
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def read_ndjson_range(path: str, start: int, end: int, block_bytes: int = NDJSON_BLOCK_BYTES) -> dict:
+    """Parse the lines of a byte range of a newline-delimited JSON file into columns.
+
+    This is the function run by the worker processes of `iter_ndjson_parallel`, so it is defined at module level.
+
+    """
+    with open(path, "rb") as f_ndjson:
+        f_ndjson.seek(start)
+        return concat_columns(list(iter_ndjson(f_ndjson, True, block_bytes, end)))
+
+
+def concat_columns(chunks: list[dict]) -> dict:
+    """Concatenate columns (see `parse_ndjson_block`) into one set of columns, merging the server ID dictionaries."""
+    codes = {}
+    server_index = []
+    for chunk in chunks:
+        remap = np.array([codes.setdefault(server_id, len(codes)) for server_id in chunk["server_ids"]],
+                         dtype=np.uint32)
+        server_index.append(remap[chunk["server_index"]])
+    columns = {"server_ids": list(codes),
+               "server_index": np.concatenate(server_index) if chunks else np.empty(0, np.uint32)}
+    for name, dtype in (("cpu_usage", np.float32), ("memory_usage", np.float32), ("disk_usage", np.float32),
+                        ("timestamp_ns", np.int64)):
+        columns[name] = np.concatenate([chunk[name] for chunk in chunks]) if chunks else np.empty(0, dtype)
+    return columns
+
+
+def iter_ndjson_parallel(
+        path: str,
+        executor: Executor,
+        range_bytes: int = NDJSON_RANGE_BYTES,
+        max_pending: int = 4
+) -> Iterator[dict]:
+    """Parse a newline-delimited JSON file in parallel: independent line ranges, parsed by the workers of `executor`.
+
+    At most `max_pending` ranges are submitted ahead of the one being consumed, so the memory used is bounded by a
+    few ranges whatever the size of the file.
+
+    Args:
+        path: The file.
+        executor: Parses the ranges, typically a ProcessPoolExecutor (a thread pool would be held back by the GIL).
+        range_bytes: Approximate size of a range.
+        max_pending: Maximum number of ranges parsed or waiting to be consumed.
+
+    Yields:
+        The columns of every range (see `parse_ndjson_block`), in file order.
+
+    Raises:
+        ValueError: If a line is not valid JSON.
+
+    """
+    pending = deque()
+    try:
+        for start, end in ndjson_ranges(path, range_bytes):
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(read_ndjson_range, path, start, end))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:  # The consumer stopped early.
+            future.cancel()
+
+
+def encode_flatbuffers_rows(
+        rows: Iterable[Row],
+        count: int,
+        schema_version: int = 2,
+        base_timestamp_ns: int = 0,
+        size_prefixed: bool = False
+) -> bytes:
+    """Write rows as a FlatBuffers MetricsRequest buffer, in one pass.
+
+    Repeated server IDs are written once and shared by all the tables that refer to them (`CreateSharedString`), and
+    the thread's builder is reused (see `reused_builder`).
+
+    Args:
+        rows: The rows. Timestamps are epoch nanoseconds, relative to `base_timestamp_ns` (schema v2), or ISO 8601
+            strings (schema v1).
+        count: The number of rows, used to pre-size the builder.
+        schema_version: The schema version of the rows.
+        base_timestamp_ns: The base of delta-encoded v2 timestamps (0 if they are absolute).
+        size_prefixed: Start the buffer with its size (see `iter_container_chunks`).
+
+    Returns:
+        The finished buffer.
+
+    """
+    with reused_builder(ROW_TABLE_BYTES * count + 1024) as builder:
+        metric_offsets = []
+        append = metric_offsets.append
+        for server_id, cpu, memory, disk, timestamp in rows:
+            server_id = builder.CreateSharedString(server_id)
+            if schema_version == 1:
+                timestamp = builder.CreateString(timestamp)  # Strings must be written before the table starts.
+            ServerMetricsStart(builder)
+            ServerMetricsAddServerId(builder, server_id)
+            ServerMetricsAddCpuUsage(builder, cpu)
+            ServerMetricsAddMemoryUsage(builder, memory)
+            ServerMetricsAddDiskUsage(builder, disk)
+            if schema_version == 1:
+                ServerMetricsAddTimestamp(builder, timestamp)
+            else:
+                ServerMetricsAddTimestampNs(builder, timestamp)  # A scalar stored inline: no string to write or parse.
+            append(ServerMetricsEnd(builder))
+
+        MetricsRequestStartMetricsVector(builder, len(metric_offsets))
+        # FlatBuffers builds the buffer from the end, so the offsets are prepended in reverse order.
+        for offset in reversed(metric_offsets):
+            builder.PrependUOffsetTRelative(offset)
+        return finish_metrics_request(builder, builder.EndVector(), schema_version, base_timestamp_ns, size_prefixed)
+
+
+def finish_metrics_request(
+        builder: flatbuffers.Builder,
+        metrics_vector: int,
+        schema_version: int,
+        base_timestamp_ns: int = 0,
+        size_prefixed: bool = False
+) -> bytes:
+    """Write the MetricsRequest root table around a finished vector of ServerMetrics and finish the buffer.
+
+    Args:
+        builder: The builder holding the ServerMetrics tables and the vector.
+        metrics_vector: The offset of the vector.
+        schema_version: The schema version of the tables (only written for v2, so v1 buffers are unchanged).
+        base_timestamp_ns: The base of delta-encoded v2 timestamps (0 if they are absolute).
+        size_prefixed: Start the buffer with its size (see `iter_container_chunks`).
+
+    Returns:
+        The finished buffer.
+
+    """
+    MetricsRequestStart(builder)
+    MetricsRequestAddMetrics(builder, metrics_vector)
+    if schema_version != 1:  # v1 buffers are left exactly as they were before schema versions existed.
+        MetricsRequestAddSchemaVersion(builder, schema_version)
+    if base_timestamp_ns:
+        MetricsRequestAddBaseTimestampNs(builder, base_timestamp_ns)
+    finish_buffer(builder, MetricsRequestEnd(builder), size_prefixed)
+    return builder.Output()
+
+
+def finish_buffer(builder: flatbuffers.Builder, root_table: int, size_prefixed: bool = False) -> None:
+    """Finish a buffer, optionally with the standard 4-byte size prefix (`Builder.FinishSizePrefixed`)."""
+    if size_prefixed:
+        builder.FinishSizePrefixed(root_table)
+    else:
+        builder.Finish(root_table)
+
+
+def encode_flatbuffers_columnar(server_ids: list[str], server_index, cpu_usage, memory_usage, disk_usage,
+                                timestamp_ns, size_prefixed: bool = False) -> bytes:
+    """Write columns as a FlatBuffers MetricsBatch buffer.
+
+    Args:
+        server_ids: The server ID dictionary.
+        server_index: Index of the server ID of every row (uint32).
+        cpu_usage: CPU usage of every row (float32).
+        memory_usage: Memory usage of every row (float32).
+        disk_usage: Disk usage of every row (float32).
+        timestamp_ns: Epoch-nanosecond timestamp of every row (int64).
+        Every column is an `array.array` or a NumPy array of the given type; each is copied in one step.
+        size_prefixed: Start the buffer with its size (see `iter_container_chunks`).
+
+    Returns:
+        The finished buffer, with one vector per field and dictionary-encoded server IDs.
+
+    """
+    # Pre-size the buffer (24 bytes per sample plus the dictionary) so that it does not have to grow while building.
+    with reused_builder(24 * len(server_index) + sum(len(s) + 8 for s in server_ids) + 1024) as builder:
+        id_offsets = [builder.CreateString(server_id) for server_id in server_ids]
+        MetricsBatchStartServerIdsVector(builder, len(id_offsets))
+        for offset in reversed(id_offsets):
+            builder.PrependUOffsetTRelative(offset)
+        server_ids_vector = builder.EndVector()
+        # `np.asarray` only copies a column that does not have the type of its vector already (arrays are wrapped).
+        vectors = [builder.CreateNumpyVector(np.asarray(values, dtype=dtype)) for values, dtype in (
+            (server_index, "<u4"), (cpu_usage, "<f4"), (memory_usage, "<f4"), (disk_usage, "<f4"),
+            (timestamp_ns, "<i8"))]
+
+        MetricsBatchStart(builder)
+        MetricsBatchAddServerIds(builder, server_ids_vector)
+        for add_field, vector in zip((MetricsBatchAddServerIndex, MetricsBatchAddCpuUsage, MetricsBatchAddMemoryUsage,
+                                      MetricsBatchAddDiskUsage, MetricsBatchAddTimestampNs), vectors):
+            add_field(builder, vector)
+        finish_buffer(builder, MetricsBatchEnd(builder), size_prefixed)
+        return builder.Output()
+
+
+def decode_flatbuffers_columnar(
+        buf: Union[bytes, memoryview],
+        fields: Optional[Iterable[str]] = None
+) -> dict[str, Union[list[str], np.ndarray]]:
+    """Read the columns of a MetricsBatch buffer without copying them.
+
+    Args:
+        buf: A buffer produced by `encode_flatbuffers_columnar`.
+        fields: The columns to read ("server_ids", "server_index", "cpu_usage", "memory_usage", "disk_usage",
+            "timestamp_ns"); all of them by default. Columns that are not requested are not touched at all.
+
+    Returns:
+        A dictionary with the requested columns: the server ID dictionary ("server_ids", a list of strings) and
+        read-only NumPy arrays that point into `buf` for all other columns.
+
+    """
+    fields = set(fields) if fields is not None else {"server_ids", *METRICS_BATCH_COLUMNS}
+    batch = MetricsBatch.GetRootAs(buf, 0)
+    columns = {}
+    if "server_ids" in fields:
+        columns["server_ids"] = [batch.ServerIds(i).decode("utf-8") for i in range(batch.ServerIdsLength())]
+    for name, (as_numpy, dtype) in METRICS_BATCH_COLUMNS.items():
+        if name in fields:
+            values = as_numpy(batch)
+            columns[name] = values if isinstance(values, np.ndarray) else np.empty(0, dtype=dtype)  # 0: absent.
+    return columns
+
+
+def encode_varint(value: int) -> bytes:
+    """Encode a non-negative integer as a Protobuf base-128 varint."""
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data: Union[bytes, memoryview], position: int) -> tuple[int, int]:
+    """Decode a Protobuf base-128 varint.
+
+    Args:
+        data: The buffer.
+        position: Position of the varint in the buffer.
+
+    Returns:
+        The value and the position right after the varint.
+
+    Raises:
+        ValueError: If the varint is truncated or longer than 64 bits.
+
+    """
+    value = shift = 0
+    while shift < 64:
+        if position >= len(data):
+            raise ValueError("Truncated varint.")
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+    raise ValueError("Varint longer than 64 bits.")
+
+
+def delimit_protobuf(payload: bytes) -> bytes:
+    """Prefix a serialized message with its varint size (the Protobuf length-delimited framing)."""
+    return encode_varint(len(payload)) + payload
+
+
+def iter_container_chunks(container: Union[bytes, memoryview], fmt: str) -> Iterator[memoryview]:
+    """Split a multi-chunk container into its chunks (without copying them, except for JSON).
+
+    A container is the concatenation of self-delimited chunks, each a complete payload of its format, so it can be
+    produced by independent encoders and consumed one chunk at a time:
+    * "proto": length-delimited MetricsRequest messages (the varint size of the message, then the message);
+    * "flatbuf", "flatcol": size-prefixed FlatBuffers buffers (4-byte little-endian size, then the buffer, as written
+      by `FinishSizePrefixed`). The size of every prefixed buffer is a multiple of its alignment, so concatenated
+      buffers stay aligned;
+    * "json": one JSON array per line.
+
+    Args:
+        container: The container.
+        fmt: The format of the chunks (one of CONTAINER_FORMATS).
+
+    Yields:
+        The chunks, without their size prefix: every one is a buffer that the regular decoder of the format accepts.
+
+    Raises:
+        ValueError: If the format is unknown or the container is truncated.
+
+    """
+    if fmt not in CONTAINER_FORMATS:
+        raise ValueError(f"Unknown container format: {fmt}")
+    if fmt == "json":
+        for line in bytes(container).split(b"\n"):  # JSON text is parsed from a copy anyway.
+            if line:
+                yield memoryview(line)
+        return
+    view = memoryview(container)
+    position = 0
+    while position < len(view):
+        if fmt == "proto":
+            size, position = decode_varint(view, position)
+        else:
+            if position + SIZE_PREFIX.size > len(view):
+                raise ValueError("Truncated size prefix.")
+            size, = SIZE_PREFIX.unpack_from(view, position)
+            position += SIZE_PREFIX.size
+        if position + size > len(view):
+            raise ValueError("Truncated chunk.")
+        yield view[position:position + size]
+        position += size
+
+
+def collect_protobuf(metrics: Iterable, base_timestamp_ns: int = 0) -> tuple[list[Row], list[str], tuple[array, ...]]:
+    """Read Protobuf ServerMetrics messages once, into row tuples and typed columns with absolute timestamps.
+
+    Every field of every message is read once, into plain tuples (for the JSON text and the FlatBuffers tables) and
+    typed columns (for the columnar FlatBuffers batch); nothing is converted to a dict.
+
+    Args:
+        metrics: Schema v2 ServerMetrics messages.
+        base_timestamp_ns: The base the `timestamp_ns` values are relative to (0 if they are absolute).
+
+    Returns:
+        A tuple (rows, distinct server IDs, columns), where the columns are the arguments of
+        `encode_flatbuffers_columnar` that follow the server IDs.
+
+    """
+    server_codes = {}  # Server ID -> index in the dictionary (dicts keep insertion order).
+    server_index = array("I")
+    cpu_column = array("f")
+    memory_column = array("f")
+    disk_column = array("f")
+    timestamp_column = array("q")
+    rows = []
+    for m in metrics:
+        row = (m.server_id, m.cpu_usage, m.memory_usage, m.disk_usage, base_timestamp_ns + m.timestamp_ns)
+        rows.append(row)
+        code = server_codes.get(row[0])
+        if code is None:
+            code = server_codes[row[0]] = len(server_codes)
+        server_index.append(code)
+        cpu_column.append(row[1])
+        memory_column.append(row[2])
+        disk_column.append(row[3])
+        timestamp_column.append(row[4])
+    return rows, list(server_codes), (server_index, cpu_column, memory_column, disk_column, timestamp_column)
+
+
+def transcode_protobuf(metrics: Iterable, base_timestamp_ns: int = 0) -> tuple[bytes, bytes, bytes]:
+    """Transcode Protobuf ServerMetrics messages to JSON, FlatBuffers and columnar FlatBuffers, in a single pass.
+
+    All outputs carry absolute timestamps (see `collect_protobuf`).
+
+    Args:
+        metrics: Schema v2 ServerMetrics messages.
+        base_timestamp_ns: The base the `timestamp_ns` values are relative to (0 if they are absolute).
+
+    Returns:
+        A tuple (UTF-8 JSON array, MetricsRequest buffer, MetricsBatch buffer).
+
+    """
+    rows, server_ids, columns = collect_protobuf(metrics, base_timestamp_ns)
+    return (encode_json_rows(rows).encode("utf-8"), encode_flatbuffers_rows(rows, len(rows)),
+            encode_flatbuffers_columnar(server_ids, *columns))
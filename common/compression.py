@@ -0,0 +1,74 @@
+import bz2
+import lzma
+import zlib
+from typing import Optional, Union
+
+# At-rest codecs of the segment logs (standard library only). Every record is compressed on its own, so records can
+# still be located, checksummed and recovered one by one; a codec therefore gains less on small batches than on a
+# whole file.
+CODECS = ("none", "zlib", "bz2", "lzma")
+DEFAULT_LEVELS = {"zlib": 6, "bz2": 9, "lzma": 6}  # The defaults of the stdlib modules.
+
+
+def parse_codec(spec: str) -> tuple[str, Optional[int]]:
+    """Parse a codec setting of the form "name" or "name:level" (e.g. "zlib:1", "lzma").
+
+    Args:
+        spec: The codec setting.
+
+    Returns:
+        A tuple (codec name, level or None for the default level).
+
+    Raises:
+        ValueError: If the codec is unknown or the level is not an integer.
+
+    """
+    name, _, level = spec.partition(":")
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec: {name}")
+    return name, int(level) if level else None
+
+
+def compress(codec: str, data: bytes, level: Optional[int] = None) -> bytes:
+    """Compress a record.
+
+    Args:
+        codec: One of CODECS.
+        data: The record.
+        level: Compression level (zlib: 0-9, bz2: 1-9, lzma: 0-9 presets), or None for the default.
+
+    Returns:
+        The compressed record (`data` itself for "none").
+
+    """
+    if codec == "none":
+        return data
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    if codec == "bz2":
+        return bz2.compress(data, level)
+    return lzma.compress(data, preset=level)
+
+
+def decompress(codec: str, data: Union[bytes, memoryview]) -> Union[bytes, memoryview]:
+    """Decompress a record written by `compress`.
+
+    Args:
+        codec: The codec the record was compressed with.
+        data: The stored record.
+
+    Returns:
+        The original record (`data` itself, without a copy, for "none").
+
+    """
+    if codec == "none":
+        return data
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "bz2":
+        return bz2.decompress(data)
+    if codec == "lzma":
+        return lzma.decompress(data)
+    raise ValueError(f"Unknown codec: {codec}")
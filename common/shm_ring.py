@@ -0,0 +1,61 @@
+import socket
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+# Protocol of the shared-memory transport between a client and a server on the same host (shared by both, copied next
+# to them in their images like codec.py; see client/shm_client.py and server/shm_server.py).
+#
+# The client creates a ring buffer in shared memory and connects to the Unix socket of the server, the control
+# channel. Every batch (a columnar FlatBuffers MetricsBatch) is written into the ring and announced with a BATCH frame
+# (its sequence number, offset and size); the server reads it in place, saves it, and answers with an ACK frame, which
+# gives its space back to the client. Only the client allocates space in the ring, and it only reuses space that has
+# been acknowledged, so the ring holds no shared counters and needs no locks. A full ring, or too many unacknowledged
+# batches, blocks the client until acknowledgements arrive: this is the back-pressure of the transport.
+
+MAGIC = b"MSR1"
+HELLO = struct.Struct("<4sQH")  # Magic, capacity of the ring, length of its name (followed by the UTF-8 name).
+BATCH = struct.Struct("<QQI")  # Sequence number, offset of the batch in the ring, size of the batch.
+ACK = struct.Struct("<QIB")  # Sequence number, number of saved metrics, status.
+
+ACK_OK = 0
+ACK_INVALID = 1  # The batch is not a valid MetricsBatch (nothing was saved).
+ACK_FAILED = 2  # The batch could not be saved.
+ACK_STATUSES = {ACK_OK: "OK", ACK_INVALID: "INVALID_ARGUMENT", ACK_FAILED: "INTERNAL"}  # As gRPC status codes.
+
+RECORD_ALIGNMENT = 8  # Batches start at multiples of 8 bytes, so that the 64-bit columns are aligned.
+DEFAULT_RING_BYTES = 16 * 1024 * 1024
+
+
+def align(size: int) -> int:
+    """Round a size up to the record alignment."""
+    return -(-size // RECORD_ALIGNMENT) * RECORD_ALIGNMENT
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    """Read exactly `size` bytes from a stream socket.
+
+    Raises:
+        ConnectionError: If the peer closes the connection first.
+
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("Control channel closed by the peer.")
+        received += count
+    return bytes(data)
+
+
+def attach_ring(name: str) -> shared_memory.SharedMemory:
+    """Open a ring created by another process.
+
+    Before Python 3.13, the resource tracker of every process that opens a segment unlinks it when that process exits;
+    the segment belongs to the client that created it, so the server stops tracking it.
+
+    """
+    ring = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(ring._name, "shared_memory")
+    return ring
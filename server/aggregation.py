@@ -0,0 +1,457 @@
+import os
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+
+from metrics_pb2 import ServerMetrics, AggregatesQuery, AggregatesResponse
+
+logger = logging.getLogger(__name__)
+
+AGGREGATED_METRICS = ("cpu_usage", "memory_usage", "disk_usage")
+DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+AGGREGATION_DISABLED = "Aggregation is disabled (AGGREGATION=off, or SERVER_WORKERS > 1)."
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch with a relative-error guarantee (the DDSketch algorithm).
+
+    Positive values are counted in logarithmic buckets: bucket i holds the values in (gamma**(i-1), gamma**i], with
+    gamma = (1 + accuracy) / (1 - accuracy), so any quantile is returned within `accuracy` of the true value (1% by
+    default). Zeros (and negative values) are counted apart. Two sketches with the same accuracy merge by adding their
+    bucket counts, with no loss of accuracy, which is what lets windows be built from smaller panes.
+
+    Memory is proportional to the number of distinct buckets used, at most `max_buckets`: beyond that, the lowest
+    buckets are collapsed into one, which only affects the accuracy of the lowest quantiles.
+
+    """
+
+    __slots__ = ("accuracy", "gamma_log", "max_buckets", "buckets", "zero_count", "count")
+
+    def __init__(self, accuracy: float = 0.01, max_buckets: int = 256) -> None:
+        """Initialize an empty sketch.
+
+        Args:
+            accuracy: Relative accuracy of the quantiles (0 < accuracy < 1).
+            max_buckets: Maximum number of buckets.
+
+        """
+        self.accuracy = accuracy
+        self.gamma_log = math.log((1 + accuracy) / (1 - accuracy))
+        self.max_buckets = max_buckets
+        self.buckets = {}  # Bucket index -> count.
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        """Count one value."""
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self.gamma_log)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def add_counts(self, indexes: Sequence[int], counts: Sequence[int], zero_count: int = 0) -> None:
+        """Count many values at once, already counted per bucket (see `bucket_indexes`).
+
+        Args:
+            indexes: Bucket indexes.
+            counts: Number of values in each bucket.
+            zero_count: Number of values that are zero (or negative).
+
+        """
+        buckets = self.buckets
+        if buckets:
+            for index, count in zip(indexes, counts):
+                buckets[index] = buckets.get(index, 0) + count
+        else:
+            buckets.update(zip(indexes, counts))
+        self.zero_count += zero_count
+        self.count += zero_count + sum(counts)
+        if len(buckets) > self.max_buckets:
+            self._collapse()
+
+    def bucket_indexes(self, values: np.ndarray) -> np.ndarray:
+        """Return the bucket index of every positive value of an array (the vectorized form of `add`)."""
+        return np.ceil(np.log(values) / self.gamma_log).astype(np.int64)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Add the counts of another sketch with the same accuracy to this one.
+
+        Raises:
+            ValueError: If the accuracies differ.
+
+        """
+        if other.gamma_log != self.gamma_log:
+            raise ValueError("Cannot merge sketches with different accuracies.")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def _collapse(self) -> None:
+        indexes = sorted(self.buckets)
+        excess = indexes[:len(indexes) - self.max_buckets + 1]
+        self.buckets[excess[-1]] += sum(self.buckets.pop(index) for index in excess[:-1])
+
+    def quantile(self, q: float) -> float:
+        """Return the q-th quantile (0 <= q <= 1), or NaN if the sketch is empty."""
+        if not self.count:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # The middle of the bucket (in the relative sense), which is within `accuracy` of all its values.
+                return 2 * math.exp(index * self.gamma_log) / (1 + math.exp(self.gamma_log))
+        return 2 * math.exp(max(self.buckets) * self.gamma_log) / (1 + math.exp(self.gamma_log))
+
+
+class WindowStats:
+    """Count, min, max, sum and quantile sketch of the values of one metric over a time window. Mergeable."""
+
+    __slots__ = ("count", "min", "max", "sum", "sketch")
+
+    def __init__(self, accuracy: float = 0.01) -> None:
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0.0
+        self.sketch = QuantileSketch(accuracy)
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sum += value
+        self.sketch.add(value)
+
+    def add_summary(self, count: int, minimum: float, maximum: float, total: float, indexes: Sequence[int],
+                    bucket_counts: Sequence[int], zero_count: int) -> None:
+        """Count a group of values summarized beforehand (see `MetricsAggregator.update`)."""
+        self.count += count
+        if minimum < self.min:
+            self.min = minimum
+        if maximum > self.max:
+            self.max = maximum
+        self.sum += total
+        self.sketch.add_counts(indexes, bucket_counts, zero_count)
+
+    def merge(self, other: "WindowStats") -> None:
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+        self.sketch.merge(other.sketch)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else math.nan
+
+
+class ServerSeries:
+    """The panes of one server: pane start (ns) -> {metric name: WindowStats}, in time order."""
+
+    __slots__ = ("panes", "latest_ns", "last_update")
+
+    def __init__(self) -> None:
+        self.panes = OrderedDict()
+        self.latest_ns = 0  # Newest sample timestamp.
+        self.last_update = time.monotonic()  # Time of the last update, for idle eviction.
+
+
+class MetricsAggregator:
+    """In-memory rolling aggregates of the received metrics, per server and per metric.
+
+    Samples are counted in fixed panes of `pane_s` seconds of event time (the sample timestamps, aligned to the Unix
+    epoch). Windows are built at query time by merging panes, so a single set of panes answers both kinds of queries:
+    * tumbling windows: consecutive, non-overlapping windows of a multiple of `pane_s`, aligned to the epoch;
+    * sliding windows: one window covering the last N seconds before the query time, at pane granularity.
+
+    Memory is bounded in three ways: panes older than `retention_s` before the newest sample of their server are
+    dropped (as are late samples of such panes), servers without updates for `idle_s` seconds are evicted, and at
+    most `max_servers` servers are kept (the least recently updated is evicted first). With the defaults, that is at
+    most 1000 servers x 90 panes x 3 sketches of at most 256 buckets each.
+
+    Thread-safe: updates and queries hold one lock; an update only holds it to merge its batch, already grouped by
+    server and pane (see `update`).
+
+    """
+
+    def __init__(
+            self,
+            pane_s: int = 10,
+            retention_s: int = 900,
+            idle_s: float = 600.0,
+            max_servers: int = 1000,
+            accuracy: float = 0.01
+    ) -> None:
+        """Initialize an empty aggregator.
+
+        Args:
+            pane_s: Pane size in seconds: the granularity of the windows.
+            retention_s: How far back (in seconds of event time) panes are kept.
+            idle_s: Servers without updates for this long (wall-clock time) are evicted.
+            max_servers: Maximum number of servers kept.
+            accuracy: Relative accuracy of the quantiles.
+
+        """
+        self.pane_ns = pane_s * 1_000_000_000
+        self.retention_ns = retention_s * 1_000_000_000
+        self.idle_s = idle_s
+        self.max_servers = max_servers
+        self.accuracy = accuracy
+        self._series = OrderedDict()  # Server ID -> ServerSeries, least recently updated first.
+        self._bucketing = QuantileSketch(accuracy)  # Only used for its bucket indexes (see `_summarize`).
+        self._lock = threading.Lock()
+        self._next_eviction = time.monotonic() + idle_s
+        self.late_count = 0
+        self.evicted_count = 0
+
+    def update(self, metrics: Iterable[ServerMetrics], base_timestamp_ns: int = 0) -> None:
+        """Count a batch of samples.
+
+        The batch is read into arrays and grouped by server and pane with NumPy before the lock is taken: count, min,
+        max, sum and sketch bucket counts are computed per (server, pane) group, so the lock is only held for one merge
+        per group and metric, not for every sample.
+
+        Args:
+            metrics: Schema v2 ServerMetrics (see schema.normalize_request).
+            base_timestamp_ns: The base the `timestamp_ns` values are relative to (0 if they are absolute).
+
+        """
+        metrics = list(metrics)
+        if not metrics:
+            return
+        server_codes = {}  # Server ID -> index in the batch (dicts keep insertion order).
+        codes = np.array([server_codes.setdefault(m.server_id, len(server_codes)) for m in metrics], dtype=np.int64)
+        timestamps = np.array([m.timestamp_ns for m in metrics], dtype=np.int64) + base_timestamp_ns
+        columns = ([m.cpu_usage for m in metrics], [m.memory_usage for m in metrics], [m.disk_usage for m in metrics])
+        newest = np.full(len(server_codes), np.iinfo(np.int64).min)
+        np.maximum.at(newest, codes, timestamps)
+        pane_starts = timestamps - timestamps % self.pane_ns
+        order = np.lexsort((pane_starts, codes))  # By server, then by pane.
+        codes, pane_starts = codes[order], pane_starts[order]
+        first = _group_starts(codes, pane_starts)
+        groups = zip(codes[first].tolist(), pane_starts[first].tolist(), np.diff(first, append=len(codes)).tolist())
+        summaries = [self._summarize(np.array(column, dtype=np.float64)[order], first) for column in columns]
+        newest = newest.tolist()
+
+        now = time.monotonic()
+        with self._lock:
+            series = self._series
+            entries = []
+            for code, server_id in enumerate(server_codes):
+                entry = series.get(server_id)
+                if entry is None:
+                    entry = series[server_id] = ServerSeries()
+                    if len(series) > self.max_servers:
+                        series.popitem(last=False)
+                        self.evicted_count += 1
+                else:
+                    series.move_to_end(server_id)
+                entry.last_update = now
+                entry.latest_ns = max(entry.latest_ns, newest[code])
+                entries.append(entry)
+            for i, (code, start, count) in enumerate(groups):
+                entry = entries[code]
+                if start + self.pane_ns <= entry.latest_ns - self.retention_ns:
+                    self.late_count += count  # Samples of an expired pane.
+                    continue
+                pane = entry.panes.get(start)
+                if pane is None:
+                    pane = entry.panes[start] = {name: WindowStats(self.accuracy) for name in AGGREGATED_METRICS}
+                    if len(entry.panes) > 1 and start < next(reversed(entry.panes)):
+                        # Out-of-order pane: keep the panes sorted so that expiry and queries can walk them in order.
+                        entry.panes = OrderedDict(sorted(entry.panes.items()))
+                    self._expire_panes(entry)  # The retention limit only moves by whole panes.
+                for name, (minima, maxima, sums, zero_counts, indexes, bucket_counts, bounds) in zip(
+                        AGGREGATED_METRICS, summaries):
+                    low, high = bounds[i], bounds[i + 1]
+                    pane[name].add_summary(count, minima[i], maxima[i], sums[i], indexes[low:high],
+                                           bucket_counts[low:high], zero_counts[i])
+            if now >= self._next_eviction:
+                self._evict_idle(now)
+
+    def _summarize(self, values: np.ndarray, first: np.ndarray) -> tuple[list, ...]:
+        """Summarize the values of one metric per group, for `WindowStats.add_summary`.
+
+        Args:
+            values: The values, sorted by group.
+            first: Position of the first value of every group.
+
+        Returns:
+            A tuple (minima, maxima, sums, zero counts, bucket indexes, bucket counts, bounds) of lists, where the
+            buckets of group i are at positions bounds[i] to bounds[i + 1] of the bucket indexes and counts.
+
+        """
+        group = np.repeat(np.arange(len(first)), np.diff(first, append=len(values)))
+        positive = values > 0
+        zero_counts = np.bincount(group[~positive], minlength=len(first))
+        group = group[positive]
+        indexes = self._bucketing.bucket_indexes(values[positive])
+        order = np.lexsort((indexes, group))  # By group, then by bucket.
+        group, indexes = group[order], indexes[order]
+        first_bucket = _group_starts(group, indexes)
+        bounds = np.searchsorted(group[first_bucket], np.arange(len(first) + 1))
+        return (np.minimum.reduceat(values, first).tolist(), np.maximum.reduceat(values, first).tolist(),
+                np.add.reduceat(values, first).tolist(), zero_counts.tolist(), indexes[first_bucket].tolist(),
+                np.diff(first_bucket, append=len(indexes)).tolist(), bounds.tolist())
+
+    def _expire_panes(self, entry: ServerSeries) -> None:
+        oldest = entry.latest_ns - self.retention_ns
+        while entry.panes:
+            start = next(iter(entry.panes))
+            if start + self.pane_ns > oldest:
+                break
+            del entry.panes[start]
+
+    def _evict_idle(self, now: float) -> None:
+        while self._series:
+            server_id, entry = next(iter(self._series.items()))
+            if now - entry.last_update < self.idle_s:
+                break
+            del self._series[server_id]
+            self.evicted_count += 1
+        self._next_eviction = now + min(self.idle_s, 60.0)
+
+    def query(
+            self,
+            server_ids: Iterable[str] = (),
+            metrics: Iterable[str] = (),
+            window_s: int = 0,
+            range_s: int = 300,
+            end_ns: Optional[int] = None
+    ) -> list[tuple[str, str, list[tuple[int, int, WindowStats]]]]:
+        """Return the aggregates of the requested servers and metrics.
+
+        Args:
+            server_ids: Servers to return (all the servers currently kept if empty).
+            metrics: Metrics to return (all of AGGREGATED_METRICS if empty).
+            window_s: Size of the tumbling windows in seconds (a multiple of the pane size), or 0 for one sliding
+                window over the whole range.
+            range_s: How far back from `end_ns` to look, in seconds.
+            end_ns: End of the queried range (exclusive), in Unix epoch nanoseconds. Defaults to the current time.
+
+        Returns:
+            A list of (server ID, metric, windows) tuples, where windows is a list of (start ns, end ns, stats) tuples
+            in time order, without the empty windows. Unknown servers are returned with no windows.
+
+        Raises:
+            ValueError: If a metric is unknown, or if the window or the range is not valid.
+
+        """
+        metrics = tuple(metrics) or AGGREGATED_METRICS
+        unknown = set(metrics) - set(AGGREGATED_METRICS)
+        if unknown:
+            raise ValueError(f"Unknown metrics: {', '.join(sorted(unknown))}")
+        window_ns = window_s * 1_000_000_000
+        if window_s < 0 or window_ns % self.pane_ns:
+            raise ValueError(f"The window must be a multiple of the pane size ({self.pane_ns // 1_000_000_000} s).")
+        if range_s <= 0:
+            raise ValueError("The range must be positive.")
+        end_ns = time.time_ns() if end_ns is None else end_ns
+        start_ns = end_ns - range_s * 1_000_000_000
+
+        results = []
+        with self._lock:
+            for server_id in server_ids or list(self._series):
+                entry = self._series.get(server_id)
+                windows = {name: {} for name in metrics}  # Metric -> window start -> stats.
+                for pane_start, pane in (entry.panes.items() if entry is not None else ()):
+                    # A pane is included if it starts in the range, so windows have pane granularity.
+                    if pane_start < start_ns or pane_start >= end_ns:
+                        continue
+                    if window_ns:
+                        window_start = pane_start - pane_start % window_ns
+                        window_end = window_start + window_ns
+                    else:
+                        window_start, window_end = start_ns, end_ns
+                    for name in metrics:
+                        stats = windows[name].get((window_start, window_end))
+                        if stats is None:
+                            stats = windows[name][(window_start, window_end)] = WindowStats(self.accuracy)
+                        stats.merge(pane[name])
+                for name in metrics:
+                    results.append((server_id, name, [(start, end, stats) for (start, end), stats
+                                                      in sorted(windows[name].items())]))
+        return results
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of servers and panes kept, and the counts of late samples and evicted servers."""
+        with self._lock:
+            return {
+                "servers": len(self._series),
+                "panes": sum(len(entry.panes) for entry in self._series.values()),
+                "late": self.late_count,
+                "evicted": self.evicted_count
+            }
+
+
+def _group_starts(*keys: np.ndarray) -> np.ndarray:
+    """Return the positions where any of some sorted keys changes, i.e. the first position of every group."""
+    if not len(keys[0]):
+        return np.zeros(0, dtype=np.intp)
+    changed = np.zeros(len(keys[0]), dtype=bool)
+    changed[0] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(changed)
+
+
+def answer_query(aggregator: MetricsAggregator, query: AggregatesQuery) -> AggregatesResponse:
+    """Answer a QueryAggregates call.
+
+    Args:
+        aggregator: The aggregator of the server.
+        query: The query.
+
+    Returns:
+        The aggregates of the requested servers and metrics.
+
+    Raises:
+        ValueError: If the query is not valid.
+
+    """
+    quantiles = tuple(query.quantiles) or DEFAULT_QUANTILES
+    if any(not 0 <= q <= 1 for q in quantiles):
+        raise ValueError("Quantiles must be between 0 and 1.")
+    results = aggregator.query(query.server_ids, query.metrics, query.window_s, query.range_s or 300,
+                               query.end_timestamp_ns or None)
+    response = AggregatesResponse(quantiles=quantiles)
+    for server_id, metric, windows in results:
+        series = response.series.add(server_id=server_id, metric=metric)
+        for start, end, stats in windows:
+            series.windows.add(start_timestamp_ns=start, end_timestamp_ns=end, count=stats.count, min=stats.min,
+                               max=stats.max, mean=stats.mean,
+                               quantiles=[stats.sketch.quantile(q) for q in quantiles])
+    return response
+
+
+def aggregator_from_env() -> Optional[MetricsAggregator]:
+    """Create the aggregator configured by the AGGREGATION* environment variables, or None if AGGREGATION is "off"."""
+    mode = os.getenv("AGGREGATION", "on")
+    if mode not in ("on", "off"):
+        raise ValueError(f"Unknown AGGREGATION: {mode}")
+    if mode == "off":
+        return None
+    return MetricsAggregator(
+        pane_s=int(os.getenv("AGGREGATION_PANE_S", "10")),
+        retention_s=int(os.getenv("AGGREGATION_RETENTION_S", "900")),
+        idle_s=float(os.getenv("AGGREGATION_IDLE_S", "600")),
+        max_servers=int(os.getenv("AGGREGATION_MAX_SERVERS", "1000"))
+    )
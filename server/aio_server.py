@@ -0,0 +1,396 @@
+import asyncio
+import logging
+import signal
+from typing import Any, AsyncIterator, Callable, Optional, Union
+from concurrent import futures
+
+import grpc
+
+from metrics_pb2 import MetricsResponse, MetricsRequest, ServerInfo, ServerInfoRequest, AggregatesQuery, \
+    AggregatesResponse, MetricsQuery, StatsRequest, StatsResponse, ProfilingSettings, ProfilingStatus
+from metrics_pb2_grpc import MetricsServiceServicer, add_MetricsServiceServicer_to_server
+from storage import MetricsStore, query_parameters
+from group_commit import GroupCommitWriter
+from schema import normalize_request, SchemaVersionError, SUPPORTED_SCHEMA_VERSIONS
+from aggregation import AGGREGATION_DISABLED, MetricsAggregator, answer_query
+from deserialize_perfomance import measure_deserialize_performance, BenchmarkWorker
+from stats import StatsRegistry, AsyncStatsInterceptor
+from profiling import RequestProfiler, apply_settings
+from shm_server import ShmIngestServer
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a request is rejected because too many requests are already waiting."""
+
+
+class AdmissionController:
+    """Bound the number of requests doing blocking work, and shed load once too many are waiting.
+
+    At most `max_in_flight` requests hold a slot (i.e. run in the executor) at a time. Up to `max_queue_depth` more
+    requests may wait for a slot; beyond that, new requests are rejected immediately instead of queueing without bound,
+    so that an overload shows up as fast RESOURCE_EXHAUSTED errors rather than growing latency for everybody.
+
+    Must be created in the event loop it is used from.
+
+    """
+
+    def __init__(self, max_in_flight: int, max_queue_depth: int) -> None:
+        """Initialize the controller.
+
+        Args:
+            max_in_flight: Maximum number of requests holding a slot.
+            max_queue_depth: Maximum number of requests waiting for a slot.
+
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue_depth = max_queue_depth
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.waiting = 0
+        self.shed_count = 0
+        self.expired_count = 0
+
+    async def acquire(self, timeout: Optional[float]) -> None:
+        """Wait for a slot.
+
+        Args:
+            timeout: Maximum number of seconds to wait (None to wait without limit).
+
+        Raises:
+            Overloaded: If all slots are taken and `max_queue_depth` requests are already waiting.
+            asyncio.TimeoutError: If no slot became free within `timeout`.
+
+        """
+        if self._slots.locked() and self.waiting >= self.max_queue_depth:
+            self.shed_count += 1
+            raise Overloaded(f"Server overloaded: {self.in_flight} requests in flight, {self.waiting} waiting.")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):  # gRPC cancels the handler when the deadline passes.
+            self.expired_count += 1
+            raise
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def release(self) -> None:
+        """Give a slot back."""
+        self.in_flight -= 1
+        self._slots.release()
+
+
+class AsyncMetricsService(MetricsServiceServicer):
+    """asyncio implementation of the MetricsService gRPC service.
+
+    Handlers run on the event loop and never block it: persistence (and the inline benchmark) runs in a thread pool,
+    and an AdmissionController caps how many requests use the pool at once. The deadline of every request is honored:
+    a request whose deadline expires while it waits for a slot is answered with DEADLINE_EXCEEDED without being
+    written.
+
+    """
+
+    def __init__(
+            self,
+            store: Union[MetricsStore, GroupCommitWriter],
+            executor: futures.Executor,
+            admission: AdmissionController,
+            benchmark_mode: str = "background",
+            benchmark_worker: Optional[BenchmarkWorker] = None,
+            aggregator: Optional[MetricsAggregator] = None,
+            stats: Optional[StatsRegistry] = None,
+            profiler: Optional[RequestProfiler] = None
+    ) -> None:
+        """Initialize the service.
+
+        Args:
+            store: The storage that received metrics are appended to (directly or through the group commit writer).
+            executor: The pool that runs blocking work.
+            admission: The controller bounding the requests that use `executor`.
+            benchmark_mode: How SendMetrics runs the deserialization benchmark ("inline", "background" or "off").
+            benchmark_worker: The worker used in the "background" mode.
+            aggregator: The rolling aggregates updated with the saved metrics (None to disable QueryAggregates).
+            stats: The registry of the stage timings, returned by GetStats.
+            profiler: The profiler of a sample of the saved batches (off by default), configured by ConfigureProfiling.
+
+        """
+        self.store = store
+        self.executor = executor
+        self.admission = admission
+        self.benchmark_mode = benchmark_mode
+        self.benchmark_worker = benchmark_worker
+        self.aggregator = aggregator
+        self.stats = stats if stats is not None else StatsRegistry()
+        self.profiler = profiler if profiler is not None else RequestProfiler()
+
+    def save(self, request: MetricsRequest) -> None:
+        """Convert a request to schema v2, save its metrics and count them in the aggregates (blocking).
+
+        Runs in the executor, so a sampled batch is profiled in the thread that does the work.
+
+        """
+        with self.profiler.sample():
+            with self.stats.timer("normalize"):
+                request = normalize_request(request)
+            self.store.save_metrics(request.metrics, request.base_timestamp_ns)
+            if self.aggregator is not None:
+                with self.stats.timer("aggregate"):
+                    self.aggregator.update(request.metrics, request.base_timestamp_ns)
+
+    async def run_blocking(self, context: grpc.aio.ServicerContext, func: Callable[[], Any]) -> Any:
+        """Run a blocking function in the executor once a slot is free, within the deadline of the request.
+
+        Aborts the RPC with RESOURCE_EXHAUSTED if the request is shed, or with DEADLINE_EXCEEDED if the deadline
+        expires before the function is started. Once started, the function always runs to completion (a write cannot be
+        interrupted halfway), and its slot is only given back when it has finished, even if the RPC is cancelled.
+
+        Args:
+            context: The context of the RPC.
+            func: The function to run.
+
+        Returns:
+            The result of the function.
+
+        """
+        try:
+            await self.admission.acquire(context.time_remaining())
+        except Overloaded as e:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+        except asyncio.TimeoutError:
+            await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "Deadline expired while waiting for a slot.")
+        remaining = context.time_remaining()
+        if remaining is not None and remaining <= 0:
+            self.admission.release()
+            self.admission.expired_count += 1
+            await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "Deadline expired before processing.")
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func)
+        future.add_done_callback(lambda _: self.admission.release())
+        return await future
+
+    async def SendMetrics(
+            self,
+            request: MetricsRequest,
+            context: grpc.aio.ServicerContext
+    ) -> MetricsResponse:
+        """Process incoming metrics and save them, measuring deserialization performance.
+
+        Args:
+            request: A Protobuf MetricsRequest object containing an array of metrics.
+            context: The gRPC context for managing the RPC call.
+
+        Returns:
+            A Protobuf response object with a success or error message.
+
+        """
+        logger.info("Received %d metrics.", len(request.metrics))
+        try:
+            def process() -> None:
+                self.save(request)
+                if self.benchmark_mode == "inline":
+                    with self.stats.timer("benchmark"):
+                        measure_deserialize_performance()
+
+            await self.run_blocking(context, process)
+            if self.benchmark_mode == "background":
+                self.benchmark_worker.submit()
+            logger.info("Metrics processed successfully.")
+            return MetricsResponse(message="Data received and processed.", metrics_count=len(request.metrics),
+                                   chunks_count=1)
+        except (asyncio.CancelledError, grpc.aio.AbortError):  # Cancelled by the client, or shed/expired.
+            raise
+        except SchemaVersionError as e:
+            logger.error("Rejected metrics: %s", e)
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return MetricsResponse(message="Error processing data.")
+        except Exception as e:
+            logger.error("Failed to process metrics: %s", e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(str(e))
+            return MetricsResponse(message="Error processing data.")
+
+    async def SendMetricsStream(
+            self,
+            request_iterator: AsyncIterator[MetricsRequest],
+            context: grpc.aio.ServicerContext
+    ) -> MetricsResponse:
+        """Process a client stream of metric chunks, saving each chunk as soon as it arrives.
+
+        Every chunk goes through admission control on its own, so a long stream does not hold a slot while the client
+        is sending. If a chunk is shed, the stream is aborted; the chunks received before it remain stored.
+
+        Args:
+            request_iterator: An async iterator over Protobuf MetricsRequest chunks sent by the client.
+            context: The gRPC context for managing the RPC call.
+
+        Returns:
+            A Protobuf response object with a summary of the stream or an error message.
+
+        """
+        logger.info("Metrics stream opened.")
+        metrics_count = 0
+        chunks_count = 0
+        try:
+            async for request in request_iterator:
+                await self.run_blocking(context, lambda: self.save(request))
+                metrics_count += len(request.metrics)
+                chunks_count += 1
+            logger.info("Metrics stream processed successfully: %d metrics in %d chunks.", metrics_count,
+                        chunks_count)
+            return MetricsResponse(message="Data received and processed.", metrics_count=metrics_count,
+                                   chunks_count=chunks_count)
+        except (asyncio.CancelledError, grpc.aio.AbortError):
+            raise
+        except SchemaVersionError as e:
+            logger.error("Rejected metrics stream: %s", e)
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return MetricsResponse(message="Error processing data.")
+        except Exception as e:
+            logger.error("Failed to process metrics stream: %s", e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(str(e))
+            return MetricsResponse(message="Error processing data.")
+
+    async def GetServerInfo(self, request: ServerInfoRequest, context: grpc.aio.ServicerContext) -> ServerInfo:
+        """Advertise the schema versions accepted by SendMetrics and SendMetricsStream."""
+        return ServerInfo(schema_versions=SUPPORTED_SCHEMA_VERSIONS)
+
+    async def QueryMetrics(
+            self,
+            request: MetricsQuery,
+            context: grpc.aio.ServicerContext
+    ) -> AsyncIterator[MetricsRequest]:
+        """Stream the stored rows of some servers in a time range, in chunks of bounded size.
+
+        Every chunk is read in the executor under admission control, like a chunk of SendMetricsStream, so a large
+        query cannot starve the writes.
+
+        Args:
+            request: The servers, time range, chunk size and row limit.
+            context: The gRPC context for managing the RPC call.
+
+        Yields:
+            Schema v2 MetricsRequest chunks with absolute timestamps.
+
+        """
+        try:
+            parameters = query_parameters(request)
+        except ValueError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        chunks = self.store.query_metrics(**parameters)
+        rows_count = 0
+        try:
+            while True:
+                chunk = await self.run_blocking(context, lambda: next(chunks, None))
+                if chunk is None:
+                    break
+                rows_count += len(chunk.metrics)
+                yield chunk
+        except (asyncio.CancelledError, grpc.aio.AbortError):
+            raise
+        except Exception as e:
+            logger.error("Metrics query failed: %s", e)
+            await context.abort(grpc.StatusCode.INTERNAL, str(e))
+        logger.info("Metrics query returned %d rows.", rows_count)
+
+    async def QueryAggregates(
+            self,
+            request: AggregatesQuery,
+            context: grpc.aio.ServicerContext
+    ) -> AggregatesResponse:
+        """Return the rolling aggregates of the recently received metrics (see aggregation.py).
+
+        A query only merges in-memory panes and takes well under a millisecond, so it runs on the event loop, without
+        admission control: dashboards are still answered while writes are being shed.
+
+        """
+        if self.aggregator is None:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, AGGREGATION_DISABLED)
+        try:
+            return answer_query(self.aggregator, request)
+        except ValueError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    async def GetStats(self, request: StatsRequest, context: grpc.aio.ServicerContext) -> StatsResponse:
+        """Return the stage timings, request sizes and call counters of this server process (see stats.py)."""
+        return self.stats.to_proto()
+
+    async def ConfigureProfiling(
+            self,
+            request: ProfilingSettings,
+            context: grpc.aio.ServicerContext
+    ) -> ProfilingStatus:
+        """Change the profiling mode of this server process (see profiling.py) and return it."""
+        try:
+            return apply_settings(self.profiler, request)
+        except ValueError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+
+async def serve_aio(
+        store: Union[MetricsStore, GroupCommitWriter],
+        benchmark_mode: str,
+        benchmark_worker: Optional[BenchmarkWorker],
+        max_in_flight: int,
+        max_queue_depth: int,
+        options: Optional[list[tuple[str, Any]]] = None,
+        compression: Optional[grpc.Compression] = None,
+        aggregator: Optional[MetricsAggregator] = None,
+        stats: Optional[StatsRegistry] = None,
+        profiler: Optional[RequestProfiler] = None,
+        unix_socket: Optional[str] = None,
+        shm_socket: Optional[str] = None
+) -> None:
+    """Run a grpc.aio server on port 50051 until SIGINT or SIGTERM.
+
+    Args:
+        store: The storage that received metrics are appended to.
+        benchmark_mode: How SendMetrics runs the deserialization benchmark ("inline", "background" or "off").
+        benchmark_worker: The worker used in the "background" mode.
+        max_in_flight: Maximum number of requests persisting at the same time (also the size of the thread pool).
+        max_queue_depth: Maximum number of requests waiting for a slot before new ones are rejected.
+        options: gRPC channel options of the server.
+        compression: Compression of the responses.
+        aggregator: The rolling aggregates answering QueryAggregates (None to disable the call).
+        stats: The registry every call and processing stage is recorded in, returned by GetStats.
+        profiler: The profiler of a sample of the saved batches, configured by ConfigureProfiling.
+        unix_socket: Path of a Unix socket to listen on as well, for local clients.
+        shm_socket: Path of the Unix socket of the shared-memory transport (see shm_server.py); its batches are saved
+            in the threads of the transport, outside the admission control.
+
+    """
+    executor = futures.ThreadPoolExecutor(max_in_flight, thread_name_prefix="persist")
+    admission = AdmissionController(max_in_flight, max_queue_depth)
+    stats = stats if stats is not None else StatsRegistry()
+    server = grpc.aio.server(interceptors=[AsyncStatsInterceptor(stats)], options=options, compression=compression)
+    service = AsyncMetricsService(store, executor, admission, benchmark_mode, benchmark_worker, aggregator, stats,
+                                  profiler)
+    add_MetricsServiceServicer_to_server(service, server)
+    server.add_insecure_port("[::]:50051")
+    if unix_socket:
+        server.add_insecure_port(f"unix:{unix_socket}")
+        logger.info("Also listening on unix:%s.", unix_socket)
+    await server.start()
+    shm_server = None
+    if shm_socket:
+        shm_server = ShmIngestServer(shm_socket, service.save, stats)
+        shm_server.start()
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        # Stop accepting requests and give in-flight ones 5 seconds to finish, as the sync server does.
+        loop.add_signal_handler(signum, lambda: asyncio.ensure_future(server.stop(5)))
+    logger.info("Async server started (max in flight: %d, max queue depth: %d). Press Ctrl+C to stop.",
+                max_in_flight, max_queue_depth)
+
+    try:
+        await server.wait_for_termination()
+    finally:
+        if shm_server is not None:
+            shm_server.stop()
+        executor.shutdown(wait=True)  # Let started writes finish before the store is closed.
+        logger.info("Async server stopped: %d requests shed, %d expired or cancelled while waiting.",
+                    admission.shed_count, admission.expired_count)
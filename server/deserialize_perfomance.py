@@ -1,65 +1,365 @@
 import time
 import os
 import json
+import queue
+import argparse
+import signal
 import logging
+import threading
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import Optional, Callable, Any, Iterable, Union
 
+import numpy as np
+from codec import decode_flatbuffers_columnar
+from storage import iter_recent_records, iter_recent_mapped_records, recent_record_counts, \
+    stored_size, log_directories, FORMATS
 from metrics_pb2 import MetricsRequest as ProtoMetricsRequest
 from flatbuffers_schema.MetricsRequest import MetricsRequest as FlatMetricsRequest
+from stats import StatsRegistry
 
 logger = logging.getLogger(__name__)
 
+Record = Union[bytes, memoryview]
 
-def measure_deserialize_performance(metrics: list) -> None:
-    """Measure and log the deserialization performance of metrics in JSON, Protobuf, and FlatBuffers formats.
+# Size of the sample of recent batches measured by `measure_deserialize_performance` (BENCHMARK_SAMPLE_BYTES).
+DEFAULT_SAMPLE_BYTES = 4 * 1024 * 1024
 
-    This function reads serialized metrics from files, measures the time taken to deserialize them,
-    logs the results, and saves the deserialization times to a JSON file.
+
+# Per-format readers used by the read-mode comparison. Every format gets the same three steps: decode a stored batch,
+# read every field of every sample ("scan"), and compute the sum of a single column ("cpu"), so that lazy formats such
+# as FlatBuffers pay for the fields they actually read.
+def decode_json(record: Record) -> list:
+    return json.loads(bytes(record) if isinstance(record, memoryview) else record)  # json only accepts bytes or str.
+
+
+def scan_json(record: Record) -> int:
+    batch = decode_json(record)
+    for m in batch:
+        m["server_id"], m["cpu_usage"], m["memory_usage"], m["disk_usage"], m.get("timestamp_ns")
+    return len(batch)
+
+
+def sum_cpu_json(record: Record) -> tuple[float, int]:
+    batch = decode_json(record)
+    return sum(m["cpu_usage"] for m in batch), len(batch)
+
+
+def decode_protobuf(record: Record) -> ProtoMetricsRequest:
+    return ProtoMetricsRequest.FromString(record)
+
+
+def scan_protobuf(record: Record) -> int:
+    batch = decode_protobuf(record)
+    for m in batch.metrics:
+        m.server_id, m.cpu_usage, m.memory_usage, m.disk_usage, batch.base_timestamp_ns + m.timestamp_ns
+    return len(batch.metrics)
+
+
+def sum_cpu_protobuf(record: Record) -> tuple[float, int]:
+    batch = decode_protobuf(record)
+    return sum(m.cpu_usage for m in batch.metrics), len(batch.metrics)
+
+
+def decode_flatbuffers(record: Record) -> FlatMetricsRequest:
+    return FlatMetricsRequest.GetRootAsMetricsRequest(record, 0)  # Lazy: only reads the root offset.
+
+
+def scan_flatbuffers(record: Record) -> int:
+    batch = decode_flatbuffers(record)
+    count = batch.MetricsLength()
+    for i in range(count):
+        m = batch.Metrics(i)
+        m.ServerId(), m.CpuUsage(), m.MemoryUsage(), m.DiskUsage(), m.TimestampNs()
+    return count
+
+
+def sum_cpu_flatbuffers(record: Record) -> tuple[float, int]:
+    batch = decode_flatbuffers(record)
+    count = batch.MetricsLength()
+    return sum(batch.Metrics(i).CpuUsage() for i in range(count)), count
+
+
+def decode_flatbuffers_columns(record: Record) -> dict:
+    return decode_flatbuffers_columnar(record)
+
+
+def scan_flatbuffers_columns(record: Record) -> int:
+    batch = decode_flatbuffers_columnar(record)
+    server_ids = batch["server_ids"]
+    for i, *values in zip(batch["server_index"].tolist(), batch["cpu_usage"].tolist(), batch["memory_usage"].tolist(),
+                          batch["disk_usage"].tolist(), batch["timestamp_ns"].tolist()):
+        server_ids[i]
+    return len(batch["server_index"])
+
+
+def sum_cpu_flatbuffers_columns(record: Record) -> tuple[float, int]:
+    cpu_usage = decode_flatbuffers_columnar(record, fields=["cpu_usage"])["cpu_usage"]  # No other column is touched.
+    return float(cpu_usage.sum(dtype=np.float64)), len(cpu_usage)
+
+
+READERS = {
+    "json": (decode_json, scan_json, sum_cpu_json),
+    "proto": (decode_protobuf, scan_protobuf, sum_cpu_protobuf),
+    "flatbuf": (decode_flatbuffers, scan_flatbuffers, sum_cpu_flatbuffers),
+    "flatcol": (decode_flatbuffers_columns, scan_flatbuffers_columns, sum_cpu_flatbuffers_columns)
+}
+
+
+# Keys of the decoding times in deserialize_times.json.
+DECODE_TIME_KEYS = {"json": "json_deser_time", "proto": "proto_deser_time", "flatbuf": "flat_deser_time",
+                    "flatcol": "flatcol_deser_time"}
+
+
+def decode_each(decode: Callable[[Record], Any], records: Iterable[Record]) -> None:
+    """Decode records one at a time, dropping every decoded batch before the next one is decoded."""
+    for record in records:
+        decode(record)
+
+
+def sample_bytes() -> int:
+    """Return the size of the sample of recent batches the benchmarks read (BENCHMARK_SAMPLE_BYTES)."""
+    return int(os.getenv("BENCHMARK_SAMPLE_BYTES", str(DEFAULT_SAMPLE_BYTES)))
+
+
+def save_json(path: str, data: Any) -> None:
+    """Write results as JSON, replacing the file atomically: an interrupted benchmark leaves the previous results."""
+    with open(f"{path}.tmp", "w") as f_results:
+        json.dump(data, f_results)
+    os.replace(f"{path}.tmp", path)
+
+
+def timed(func: Callable[[], Any]) -> tuple[float, Any]:
+    """Call a function and return its duration in seconds (`time.perf_counter`) and its result."""
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def measure_read_modes(results_path: str, counts: list[int]) -> dict[str, dict[str, float]]:
+    """Compare the ways of reading every stored format, on a sample of the most recent batches.
+
+    Modes:
+    * "read" — read every record into memory (`os.pread`) and decode it.
+    * "mmap" — memory-map the segments and decode every record straight from the mapping (no copy of the file).
+    * "scan" — "mmap" plus reading every field of every sample.
+    * "mean_cpu" — "mmap" plus computing the mean CPU usage (a single-column aggregate).
+    Every record is dropped once read. The records are usually in the page cache after the first mode, so the timings
+    mostly reflect CPU cost.
 
     Args:
-        metrics: List of metrics (used only for logging the count; format not enforced here).
+        results_path: Directory containing the segment logs.
+        counts: The number of most recent records of every log to read (see `storage.recent_record_counts`).
+
+    Returns:
+        A dictionary mapping each format to the duration (in seconds) of each mode, plus the computed "mean_cpu_usage"
+        (which should be the same for every format).
+
+    """
+    read_modes = {}
+    for fmt in FORMATS:
+        decode, scan, sum_cpu = READERS[fmt]
+        times = {}
+        times["read"], _ = timed(lambda: decode_each(decode, iter_recent_records(results_path, fmt, counts)))
+        times["mmap"], _ = timed(lambda: decode_each(decode, iter_recent_mapped_records(results_path, fmt, counts)))
+        times["scan"], _ = timed(
+            lambda: sum(scan(record) for record in iter_recent_mapped_records(results_path, fmt, counts)))
+        times["mean_cpu"], sums = timed(
+            lambda: [sum_cpu(record) for record in iter_recent_mapped_records(results_path, fmt, counts)])
+        count = sum(c for _, c in sums)
+        times["mean_cpu_usage"] = sum(s for s, _ in sums) / count if count else 0.0
+        logger.info("%s read modes: read %.4f s, mmap %.4f s, scan %.4f s, mean_cpu %.4f s (mean CPU usage: %.3f).",
+                    fmt, times["read"], times["mmap"], times["scan"], times["mean_cpu"], times["mean_cpu_usage"])
+        read_modes[fmt] = times
+    return read_modes
+
+
+def save_read_modes() -> None:
+    """Compare the read modes (see `measure_read_modes`) and save them to RESULTS_PATH/read_modes.json.
+
+    Run on demand (`python deserialize_perfomance.py --read-modes`), not by the background benchmark: every mode reads
+    the sample again. The sample is the one of `measure_deserialize_performance` (BENCHMARK_SAMPLE_BYTES).
+
+    """
+    results_path = os.getenv("RESULTS_PATH")
+    counts = recent_record_counts(results_path, sample_bytes())
+    save_json(f"{results_path}/read_modes.json",
+              {"sample_batches": sum(counts), "read_modes": measure_read_modes(results_path, counts)})
+
+
+def measure_deserialize_performance() -> None:
+    """Measure and log the deserialization performance of metrics in JSON, Protobuf, FlatBuffers, and columnar FlatBuffers formats.
+
+    Only the most recent batches are measured, the same ones in every format: as many as fit in BENCHMARK_SAMPLE_BYTES
+    of stored JSON records (see `storage.recent_record_counts`), so the cost of a measurement does not grow with the
+    store. The sampled records of a format are read, then decoded one at a time, every decoded batch being dropped
+    before the next one; the "*_deser_time" values only cover decoding (which is lazy for FlatBuffers). The "sizes" are
+    those of the whole logs. The results are saved to RESULTS_PATH/deserialize_times.json.
 
     """
     results_path = os.getenv("RESULTS_PATH")
 
-    json_path = f"{results_path}/metrics.json"
-    proto_path = f"{results_path}/metrics.proto.bin"
-    flat_path = f"{results_path}/metrics.flatbuf"
-    if not (os.path.exists(json_path) and os.path.exists(proto_path) and os.path.exists(flat_path)):
+    if not all(log_directories(results_path, fmt) for fmt in FORMATS):
         logger.error("Metrics files not found for performance measurement.")
         return
 
-    # Measure JSON deserialization time.
-    start_time = time.time()
-    with open(json_path, "r") as f_json:
-        json_data = json.load(f_json)
-    json_deser_time = time.time() - start_time
-    json_size = os.path.getsize(json_path)
-    logger.info("JSON deserialization took %.4f seconds, size: %d bytes.", json_deser_time, json_size)
-
-    # Measure Protobuf deserialization time.
-    start_time = time.time()
-    proto_data = ProtoMetricsRequest()  # Create an empty MetricsRequest object for deserialization.
-    with open(proto_path, "rb") as f_proto:
-        proto_data.ParseFromString(f_proto.read())
-    proto_deser_time = time.time() - start_time
-    proto_size = os.path.getsize(proto_path)
-    logger.info("Protobuf deserialization took %.4f seconds, size: %d bytes.", proto_deser_time, proto_size)
-
-    # Measure FlatBuffers deserialization time.
-    start_time = time.time()
-    with open(f"{results_path}/metrics.flatbuf", "rb") as f_flat:
-        flat_data = FlatMetricsRequest.GetRootAsMetricsRequest(f_flat.read(), 0)
-    flat_deser_time = time.time() - start_time
-    flat_size = os.path.getsize(proto_path)
-    logger.info("FlatBuffers deserialization took %.4f seconds, size: %d bytes.", flat_deser_time, flat_size)
+    counts = recent_record_counts(results_path, sample_bytes())
+    deser_times = {}
+    sizes = {}
+    for fmt, name in DECODE_TIME_KEYS.items():
+        records = list(iter_recent_records(results_path, fmt, counts))
+        decode = READERS[fmt][0]
+        deser_times[name], _ = timed(lambda: decode_each(decode, records))
+        sizes[fmt] = stored_size(results_path, fmt)
+        logger.info("%s deserialization of %d batches (%d bytes) took %.4f seconds, stored size: %d bytes.", fmt,
+                    len(records), sum(len(record) for record in records), deser_times[name], sizes[fmt])
+    del records
 
     deserialize_times = {
-        "json_deser_time": json_deser_time,
-        "proto_deser_time": proto_deser_time,
-        "flat_deser_time": flat_deser_time
+        **deser_times,
+        "sizes": sizes,
+        "sample_batches": sum(counts)
     }
 
-    with open(f"{results_path}/deserialize_times.json", "w") as f_deserialize_times:
-        json.dump(deserialize_times, f_deserialize_times)
+    save_json(f"{results_path}/deserialize_times.json", deserialize_times)
+
+    logger.info("Processed %d sampled batches in performance measurement.", sum(counts))
+
+
+def serve_benchmark_jobs(connection: Connection) -> None:
+    """Entry point of the benchmark process started by `BenchmarkWorker`: run one benchmark per job received.
+
+    The process lowers its priority (BENCHMARK_NICE), so that the handlers of the server get the CPU first. The
+    duration of every benchmark is sent back (None if it failed); the process exits when the connection is closed.
+
+    Args:
+        connection: The end of the pipe shared with the server process.
+
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole process group; the server stops this one.
+    try:
+        os.nice(int(os.getenv("BENCHMARK_NICE", "10")))
+    except OSError as e:
+        logger.warning("Could not lower the priority of the benchmark process: %s", e)
+    while True:
+        try:
+            connection.recv()
+        except EOFError:  # The server closed the pipe.
+            return
+        start = time.perf_counter()
+        try:
+            measure_deserialize_performance()
+            connection.send(time.perf_counter() - start)
+        except Exception as e:  # A failed measurement must not stop the process.
+            logger.error("Deserialization benchmark failed: %s", e)
+            connection.send(None)
+
+
+class BenchmarkWorker:
+    """Run deserialization benchmarks in a separate process, off the request path.
+
+    The benchmark reads the stored files and decodes them: in the server process it would hold the GIL while handlers
+    wait for it. It runs instead in a process of its own (started with "spawn", so that it does not inherit the gRPC
+    threads), at a lower priority; a thread of the server hands it one job at a time and records its duration.
+
+    Jobs are passed through a bounded queue. Every job re-reads the current result files, so when the queue is full a
+    new job is simply dropped: the job already waiting will measure the same (or newer) data. This coalesces bursts of
+    requests into a single measurement instead of letting the backlog grow without bound.
+
+    """
+
+    def __init__(self, queue_size: int = 1, stats: Optional[StatsRegistry] = None) -> None:
+        """Initialize the worker.
+
+        Args:
+            queue_size: Maximum number of pending benchmark jobs.
+            stats: The registry the duration of every benchmark is recorded in (stage "benchmark").
+
+        """
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.stats = stats if stats is not None else StatsRegistry()
+        self._stopping = threading.Event()
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._connection = None
+        self._thread = threading.Thread(target=self._run, name="benchmark-worker", daemon=True)
+        self.dropped_jobs = 0
+
+    def start(self) -> None:
+        """Start the benchmark process and the thread that feeds it."""
+        self._connection, child_connection = self._context.Pipe()
+        # A daemon, so that it never outlives the server (the benchmark starts no processes of its own).
+        self._process = self._context.Process(target=serve_benchmark_jobs, args=(child_connection,),
+                                              name="benchmark", daemon=True)
+        self._process.start()
+        child_connection.close()
+        self._thread.start()
+        logger.info("Benchmark worker started (pid %d, queue size: %d).", self._process.pid, self._queue.maxsize)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the worker without running the pending jobs.
+
+        A benchmark in progress is interrupted: its results file is only replaced once it is complete, so the previous
+        results are kept.
+
+        Args:
+            timeout: Maximum number of seconds to wait for the thread and the process to finish.
+
+        """
+        self._stopping.set()
+        try:
+            self._queue.put_nowait(None)  # Wakes the thread up if it is waiting for a job.
+        except queue.Full:  # A job is pending: the thread checks `_stopping` before running it.
+            pass
+        if self._process is not None:
+            self._process.terminate()  # Also ends a wait for the reply of the running job (EOFError).
+            self._process.join(timeout)
+        self._thread.join(timeout)
+        logger.info("Benchmark worker stopped (%d jobs coalesced).", self.dropped_jobs)
+
+    def submit(self) -> bool:
+        """Schedule a benchmark without blocking the caller.
+
+        Returns:
+            True if the job was queued, False if it was coalesced with a pending job.
+
+        """
+        try:
+            self._queue.put_nowait(True)
+            return True
+        except queue.Full:
+            self.dropped_jobs += 1
+            logger.debug("Benchmark queue is full, job coalesced with a pending one.")
+            return False
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None or self._stopping.is_set():
+                return
+            try:
+                self._connection.send(job)
+                duration = self._connection.recv()
+            except (EOFError, OSError):
+                if not self._stopping.is_set():
+                    logger.error("Benchmark process exited unexpectedly; no further benchmarks will run.")
+                return
+            if duration is not None:
+                self.stats.observe("stage_duration_seconds", duration, (("stage", "benchmark"),))
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measure the deserialization of the most recent stored batches.")
+    parser.add_argument("--read-modes", action="store_true",
+                        help="Also compare copying and mmap reads, full scans and single-column means (saved to "
+                             "RESULTS_PATH/read_modes.json).")
+    return parser.parse_args(argv)
+
 
-    logger.info("Processed %d metrics in performance measurement.", len(metrics))
+if __name__ == "__main__":
+    # On-demand benchmark of the data currently stored in RESULTS_PATH: `python deserialize_perfomance.py`.
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(module)s - %(levelname)s - %(message)s")
+    args = parse_args()
+    measure_deserialize_performance()
+    if args.read_modes:
+        save_read_modes()
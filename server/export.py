@@ -0,0 +1,93 @@
+import logging
+import argparse
+from typing import Iterator, Optional
+
+from codec import Row, NdjsonWriter, iter_json_objects
+from storage import iter_query_rows, get_results_path
+
+logger = logging.getLogger(__name__)
+
+LAYOUTS = ("ndjson", "array")
+MAX_TIMESTAMP_NS = 2 ** 63 - 1
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+
+def iter_block_rows(block: dict) -> Iterator[Row]:
+    """Turn a block of `storage.iter_query_rows` into rows (schema v2: epoch-nanosecond timestamps)."""
+    server_ids = block["server_ids"]
+    for i, cpu, memory, disk, timestamp in zip(block["server_index"].tolist(), block["cpu_usage"].tolist(),
+                                               block["memory_usage"].tolist(), block["disk_usage"].tolist(),
+                                               block["timestamp_ns"].tolist()):
+        yield server_ids[i], cpu, memory, disk, timestamp
+
+
+def export_json(
+        results_path: str,
+        output: str,
+        layout: str = "ndjson",
+        server_ids: Optional[list[str]] = None,
+        start_ns: int = 0,
+        end_ns: int = MAX_TIMESTAMP_NS
+) -> tuple[int, int]:
+    """Export the stored metrics as JSON, one stored block at a time.
+
+    Both layouts are written with bounded memory, whatever the size of the store: the rows are read block by block from
+    the columnar log (see `storage.iter_query_rows`) and written through a buffered file.
+    * "ndjson": one object per line (see `codec.NdjsonWriter`), readable incrementally and in parallel
+      (`codec.iter_ndjson`, `codec.iter_ndjson_parallel`);
+    * "array": a single JSON array, as `json.dumps` writes a list of dicts. Only a full parse (`json.load`) reads it.
+
+    Args:
+        results_path: The results directory.
+        output: Path of the JSON file.
+        layout: One of LAYOUTS.
+        server_ids: The servers to export, or None for all of them.
+        start_ns: Start of the time range (inclusive), in Unix epoch nanoseconds.
+        end_ns: End of the time range (exclusive).
+
+    Returns:
+        The number of exported rows and the size of the file in bytes.
+
+    Raises:
+        ValueError: If the layout is unknown.
+
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout: {layout}")
+    blocks = iter_query_rows(results_path, server_ids, start_ns, end_ns)
+    with open(output, "wb", buffering=WRITE_BUFFER_BYTES) as f_output:
+        if layout == "ndjson":
+            writer = NdjsonWriter(f_output)
+            for block in blocks:
+                writer.write_rows(iter_block_rows(block))
+            rows_count = writer.rows_count
+        else:
+            escaped = {}
+            rows_count = 0
+            f_output.write(b"[")
+            for block in blocks:
+                for text in iter_json_objects(iter_block_rows(block), 2, escaped):
+                    f_output.write(b", " + text.encode("utf-8") if rows_count else text.encode("utf-8"))
+                    rows_count += 1
+            f_output.write(b"]")
+        size = f_output.tell()
+    logger.info("Exported %d metrics to %s (%s, %d bytes).", rows_count, output, layout, size)
+    return rows_count, size
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export the stored metrics as JSON with bounded memory.")
+    parser.add_argument("--output", required=True, help="Path of the JSON file.")
+    parser.add_argument("--layout", choices=LAYOUTS, default="ndjson",
+                        help="One object per line (ndjson, the default) or a single JSON array.")
+    parser.add_argument("--servers", default=None, help="Comma-separated server IDs (default: all).")
+    parser.add_argument("--start-ns", type=int, default=0, help="Start of the time range (epoch nanoseconds).")
+    parser.add_argument("--end-ns", type=int, default=MAX_TIMESTAMP_NS, help="End of the time range (exclusive).")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(module)s - %(levelname)s - %(message)s")
+    args = parse_args()
+    export_json(get_results_path(), args.output, args.layout, args.servers.split(",") if args.servers else None,
+                args.start_ns, args.end_ns)
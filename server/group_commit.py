@@ -0,0 +1,130 @@
+import time
+import logging
+import threading
+from typing import Iterator
+from concurrent.futures import Future
+
+from storage import MetricsStore
+from profiling import active_sample, NO_SAMPLE
+from metrics_pb2 import MetricsRequest
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCommitWriter:
+    """Single writer thread that coalesces the batches of concurrent requests into one write per format.
+
+    Request handlers encode their batch in their own thread and hand the records to the writer, which owns the segment
+    logs. The writer collects batches until `max_batch_bytes` are pending or the oldest pending batch has waited
+    `max_delay_ms`, then appends all of them with one write per format (and at most one fsync per format, according to
+    the FSYNC_POLICY of the store). Every handler is released only after the group containing its batch is written, so
+    a reply is never sent before the data is stored.
+
+    Exposes the same `save_metrics` and `query_metrics` methods as MetricsStore, so it can be used in its place.
+
+    """
+
+    def __init__(self, store: MetricsStore, max_batch_bytes: int = 1024 * 1024, max_delay_ms: float = 2.0) -> None:
+        """Initialize the writer and start its thread.
+
+        Args:
+            store: The storage the batches are written to. It must not be written to directly while the writer runs.
+            max_batch_bytes: Pending size (summed over all formats) that triggers an immediate write.
+            max_delay_ms: Maximum time a batch waits for other batches before it is written.
+
+        """
+        self.store = store
+        self.max_batch_bytes = max_batch_bytes
+        self.max_delay = max_delay_ms / 1000
+        self._cond = threading.Condition()
+        # List of (records, metrics count, future, profiled sample or None) tuples in arrival order.
+        self._pending = []
+        self._pending_bytes = 0
+        self._first_pending_time = 0.0
+        self._closing = False
+        self.batches_count = 0
+        self.writes_count = 0
+        self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+        self._thread.start()
+        logger.info("Group commit writer started (max batch: %d bytes, max delay: %.1f ms).", max_batch_bytes,
+                    max_delay_ms)
+
+    def save_metrics(self, metrics: list, base_timestamp_ns: int = 0) -> None:
+        """Store a batch of metrics, blocking until it has been written by the writer thread.
+
+        Args:
+            metrics: List of schema v2 ServerMetrics objects to save.
+            base_timestamp_ns: The base the `timestamp_ns` values are relative to (0 if they are absolute).
+
+        Raises:
+            RuntimeError: If the writer is closed.
+            Exception: If encoding or writing the batch fails.
+
+        """
+        if not metrics:
+            logger.warning("No metrics to save.")
+            return
+        records = self.store.encode_records(metrics, base_timestamp_ns)  # Encoding happens in the caller's thread, off the writer thread.
+        future = Future()
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("Group commit writer is closed.")
+            if not self._pending:
+                self._first_pending_time = time.monotonic()
+            self._pending.append((records, len(metrics), future, active_sample()))
+            self._pending_bytes += sum(len(record) for record in records.values())
+            self._cond.notify()
+        with self.store.stats.timer("commit_wait"):  # Until the group is written, including the wait for other batches.
+            future.result()  # Re-raises the exception of a failed write.
+
+    def query_metrics(self, *args, **kwargs) -> Iterator[MetricsRequest]:
+        """Query the stored rows (see `MetricsStore.query_metrics`).
+
+        Reads go straight to the files, not through the writer thread.
+
+        """
+        return self.store.query_metrics(*args, **kwargs)
+
+    def close(self) -> None:
+        """Write the pending batches, stop the writer thread and close the store."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+        self.store.close()
+        logger.info("Group commit writer stopped: %d batches written in %d group writes.", self.batches_count,
+                    self.writes_count)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if not self._pending:  # Closing and nothing left to write.
+                    return
+                # Wait for more batches until the size or the latency threshold is reached.
+                while self._pending_bytes < self.max_batch_bytes and not self._closing:
+                    remaining = self._first_pending_time + self.max_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                group = self._pending
+                self._pending = []
+                self._pending_bytes = 0
+
+            # The write of a profiled batch is profiled here, in the writer thread, and merged into its sample (at
+            # most one batch is profiled at a time; the batches written with it are part of the same write).
+            samples = [sample for _, _, _, sample in group if sample is not None]
+            try:
+                with samples[0].profile_thread() if samples else NO_SAMPLE:
+                    self.store.write_records([records for records, _, _, _ in group])
+            except Exception as e:
+                for _, _, future, _ in group:
+                    future.set_exception(e)
+                continue
+            self.batches_count += len(group)
+            self.writes_count += 1
+            logger.info("Saved %d metrics from %d requests to %s in one group write.",
+                        sum(count for _, count, _, _ in group), len(group), self.store.results_path)
+            for _, _, future, _ in group:
+                future.set_result(None)
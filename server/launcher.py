@@ -0,0 +1,93 @@
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+MIN_UPTIME_S = 5.0  # A worker that exits sooner than this is restarted with an increasing delay.
+MAX_RESTART_DELAY_S = 30.0
+
+
+class WorkerSupervisor:
+    """Run N worker processes, restart the ones that exit, and stop all of them on SIGINT or SIGTERM.
+
+    Every worker is started with its index (0 to N - 1), which it uses as its storage shard. Workers are started with
+    the "spawn" method, so they do not inherit gRPC state (threads, sockets) from the supervisor. A worker that keeps
+    crashing right after starting is restarted with an exponential delay (1 s, 2 s, 4 s, ... up to 30 s) instead of in
+    a tight loop.
+
+    """
+
+    def __init__(self, count: int, target: Callable[[int], None], stop_timeout: float = 10.0) -> None:
+        """Initialize the supervisor.
+
+        Args:
+            count: Number of worker processes.
+            target: Module-level function run by every worker with its index.
+            stop_timeout: Time given to the workers to exit after SIGTERM before they are killed.
+
+        """
+        self.count = count
+        self.target = target
+        self.stop_timeout = stop_timeout
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = {}  # Index -> (process, start time).
+        self._restart_delays = {index: 0.0 for index in range(count)}
+        self._restart_at = {}  # Index -> monotonic time at which a crashed worker is restarted.
+        self._stopping = threading.Event()
+        self.restarts_count = 0
+
+    def run(self) -> None:
+        """Start the workers and supervise them until SIGINT or SIGTERM, then stop them."""
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: self._stopping.set())
+        for index in range(self.count):
+            self._start(index)
+        logger.info("Supervising %d worker processes.", self.count)
+        try:
+            while not self._stopping.wait(0.5):
+                self._check_workers()
+        finally:
+            self._stop_all()
+
+    def _start(self, index: int) -> None:
+        process = self._context.Process(target=self.target, args=(index,), name=f"server-worker-{index}")
+        process.start()
+        self._workers[index] = (process, time.monotonic())
+        logger.info("Started worker %d (pid %d).", index, process.pid)
+
+    def _check_workers(self) -> None:
+        now = time.monotonic()
+        for index, (process, started) in list(self._workers.items()):
+            if process.is_alive():
+                if now - started >= MIN_UPTIME_S:
+                    self._restart_delays[index] = 0.0  # Healthy again: the next crash is restarted at once.
+                continue
+            if index not in self._restart_at:
+                if now - started < MIN_UPTIME_S:
+                    self._restart_delays[index] = min(max(self._restart_delays[index] * 2, 1.0), MAX_RESTART_DELAY_S)
+                logger.error("Worker %d (pid %d) exited with code %s, restarting in %.0f s.", index, process.pid,
+                             process.exitcode, self._restart_delays[index])
+                self._restart_at[index] = now + self._restart_delays[index]
+            if now >= self._restart_at[index]:
+                del self._restart_at[index]
+                self.restarts_count += 1
+                self._start(index)
+
+    def _stop_all(self) -> None:
+        logger.info("Stopping %d worker processes.", self.count)
+        processes = [process for process, _ in self._workers.values()]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()  # SIGTERM: every worker stops its server and closes its storage shard.
+        deadline = time.monotonic() + self.stop_timeout
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning("Worker %s did not stop in time, killing it.", process.name)
+                process.kill()
+                process.join()
+        logger.info("All workers stopped (%d restarts).", self.restarts_count)
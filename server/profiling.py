@@ -0,0 +1,301 @@
+import os
+import time
+import pstats
+import random
+import cProfile
+import logging
+import argparse
+import itertools
+import threading
+import contextlib
+import tracemalloc
+from typing import Any, Iterator, Optional
+
+from storage import get_results_path
+from metrics_pb2 import ProfilingSettings, ProfilingStatus
+
+logger = logging.getLogger(__name__)
+
+PROFILES_DIR = "profiles"
+PROFILE_SUFFIX = ".prof"  # cProfile statistics (pstats format).
+ALLOCATIONS_SUFFIX = ".tracemalloc"  # tracemalloc snapshot (Snapshot.dump format).
+TRACEMALLOC_FRAMES = 16  # Frames kept per allocation traceback.
+
+NO_SAMPLE = contextlib.nullcontext()  # What `RequestProfiler.sample` returns for requests that are not profiled.
+
+_active = threading.local()  # The sample being profiled in the calling thread, if any (see `active_sample`).
+
+
+class ProfiledSample:
+    """Context manager that profiles the block of one sampled request, and writes the dumps when it exits."""
+
+    def __init__(self, profiler: "RequestProfiler", trace_allocations: bool) -> None:
+        self.profiler = profiler
+        self.trace_allocations = trace_allocations
+        self.profile = cProfile.Profile()
+        self.thread_profiles = []  # Profiles of the work done for this sample by other threads (see `profile_thread`).
+        self.stop_tracing = False
+        self.start = 0.0
+
+    def __enter__(self) -> "ProfiledSample":
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            # Tracing starts right before the block, so the snapshot taken after it only holds the allocations made
+            # during the block (by any thread) that are still alive.
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.stop_tracing = True
+        self.start = time.perf_counter()
+        self.profile.enable()  # Profiles the calling thread only (before Python 3.12).
+        _active.sample = self
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        _active.sample = None
+        self.profile.disable()
+        elapsed = time.perf_counter() - self.start
+        snapshot = None
+        peak = 0
+        if self.stop_tracing:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.profiler.finish(self.profile, self.thread_profiles, snapshot, elapsed, peak)
+
+    @contextlib.contextmanager
+    def profile_thread(self) -> Iterator[None]:
+        """Profile a block that another thread runs on behalf of this sample (e.g. the group commit writer).
+
+        The block must end before the sampled block does: its statistics are merged into the dump of the sample.
+
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Python 3.12+, where the profile of the sample already records every thread.
+            profile = None
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.thread_profiles.append(profile)
+
+
+def active_sample() -> Optional[ProfiledSample]:
+    """Return the sample being profiled in the calling thread, or None if its current batch is not profiled."""
+    return getattr(_active, "sample", None)
+
+
+class RequestProfiler:
+    """Opt-in profiler of a random sample of the saved batches.
+
+    A sampled batch is profiled with cProfile and, if allocation tracing is on, its allocations are traced with
+    tracemalloc. Each sample is written to the profiles directory as `<time>-<pid>-<n>.prof` (pstats) and
+    `<time>-<pid>-<n>.tracemalloc` (a snapshot); only the newest `max_dumps` samples are kept. Run this module to
+    merge and summarize them.
+
+    At most one batch is profiled at a time: a batch sampled while another one is being profiled is not profiled.
+    cProfile only sees the thread it is enabled in, so work handed to another thread is profiled by that thread with
+    `ProfiledSample.profile_thread` (the group commit writer does so for the write of a sampled batch).
+    With a sample rate of 0 (off), `sample` only compares a number, so the profiler can stay deployed.
+
+    The sample rate and allocation tracing can be changed at any time with `configure` (from another thread, e.g. the
+    ConfigureProfiling call).
+
+    """
+
+    def __init__(
+            self,
+            directory: Optional[str] = None,
+            sample_rate: float = 0.0,
+            trace_allocations: bool = False,
+            max_dumps: int = 100
+    ) -> None:
+        """Initialize the profiler.
+
+        Args:
+            directory: Where the dumps are written (RESULTS_PATH/profiles by default, created with the first dump).
+            sample_rate: Share of the batches that are profiled, between 0 (off) and 1.
+            trace_allocations: Also trace the allocations of the profiled batches.
+            max_dumps: Number of samples kept; older ones are deleted.
+
+        Raises:
+            ValueError: If the sample rate is not between 0 and 1.
+
+        """
+        self._directory = directory
+        self.sample_rate = 0.0
+        self.trace_allocations = False
+        self.max_dumps = max_dumps
+        self.samples_count = 0
+        self._busy = threading.Lock()
+        self._sequence = itertools.count(1)
+        self.configure(sample_rate, trace_allocations)
+
+    @property
+    def directory(self) -> str:
+        if self._directory is None:
+            self._directory = os.path.join(get_results_path(), PROFILES_DIR)
+        return self._directory
+
+    def configure(self, sample_rate: Optional[float] = None, trace_allocations: Optional[bool] = None) -> None:
+        """Change the sample rate and/or allocation tracing (None leaves a setting unchanged).
+
+        Raises:
+            ValueError: If the sample rate is not between 0 and 1.
+
+        """
+        if sample_rate is None and trace_allocations is None:
+            return
+        if sample_rate is not None:
+            if not 0 <= sample_rate <= 1:
+                raise ValueError(f"The sample rate must be between 0 and 1, not {sample_rate}.")
+            self.sample_rate = sample_rate
+        if trace_allocations is not None:
+            self.trace_allocations = trace_allocations
+        logger.info("Profiling %s (sample rate: %g, allocation tracing: %s).", "on" if self.sample_rate else "off",
+                    self.sample_rate, "on" if self.trace_allocations else "off")
+
+    def sample(self) -> Any:
+        """Return a context manager that profiles its block if this batch is sampled, and does nothing otherwise."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NO_SAMPLE
+        if not self._busy.acquire(blocking=False):  # Another batch is being profiled.
+            return NO_SAMPLE
+        return ProfiledSample(self, self.trace_allocations)
+
+    def finish(self, profile: cProfile.Profile, thread_profiles: list[cProfile.Profile],
+               snapshot: Optional[tracemalloc.Snapshot], elapsed: float, peak: int) -> None:
+        """Write the dumps of a sample and delete the oldest ones (called by ProfiledSample).
+
+        The profiles of the other threads that worked on the sample are merged into the one of the sampled block.
+
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(self._sequence):06d}"
+            stats = pstats.Stats(profile)
+            for thread_profile in thread_profiles:
+                stats.add(thread_profile)
+            stats.dump_stats(os.path.join(self.directory, name + PROFILE_SUFFIX))
+            if snapshot is not None:
+                snapshot.dump(os.path.join(self.directory, name + ALLOCATIONS_SUFFIX))
+            self.samples_count += 1
+            prune_dumps(self.directory, self.max_dumps)
+            logger.info("Profiled batch in %.1f ms (allocation peak: %.1f KiB), written to %s/%s.", elapsed * 1e3,
+                        peak / 1024, self.directory, name)
+        except Exception as e:  # A failed dump must not fail the request.
+            logger.error("Failed to write profile: %s", e)
+        finally:
+            self._busy.release()
+
+
+def prune_dumps(directory: str, max_dumps: int) -> None:
+    """Delete the oldest samples of a profiles directory, keeping the newest `max_dumps`."""
+    names = sorted({os.path.splitext(name)[0] for name in os.listdir(directory)
+                    if name.endswith((PROFILE_SUFFIX, ALLOCATIONS_SUFFIX))})
+    for name in names[:max(len(names) - max_dumps, 0)]:
+        for suffix in (PROFILE_SUFFIX, ALLOCATIONS_SUFFIX):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(directory, name + suffix))
+
+
+def apply_settings(profiler: RequestProfiler, settings: ProfilingSettings) -> ProfilingStatus:
+    """Apply the settings of a ConfigureProfiling call and return the resulting mode.
+
+    Raises:
+        ValueError: If the sample rate is not between 0 and 1.
+
+    """
+    profiler.configure(settings.sample_rate if settings.HasField("sample_rate") else None,
+                       settings.trace_allocations if settings.HasField("trace_allocations") else None)
+    return ProfilingStatus(sample_rate=profiler.sample_rate, trace_allocations=profiler.trace_allocations,
+                           samples_count=profiler.samples_count, directory=profiler.directory)
+
+
+def profiler_from_env() -> RequestProfiler:
+    """Create the profiler configured by PROFILE_SAMPLE_RATE, PROFILE_ALLOCATIONS and PROFILE_MAX_DUMPS."""
+    return RequestProfiler(
+        sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+        trace_allocations=os.getenv("PROFILE_ALLOCATIONS", "0") not in ("0", "false", "no"),
+        max_dumps=int(os.getenv("PROFILE_MAX_DUMPS", "100"))
+    )
+
+
+def summarize_profiles(directory: str, top: int = 20, sort: str = "cumulative") -> Optional[pstats.Stats]:
+    """Merge the cProfile dumps of a directory and log the top functions.
+
+    Args:
+        directory: The profiles directory.
+        top: Number of functions to show.
+        sort: pstats sort key ("cumulative", "tottime", "calls", ...).
+
+    Returns:
+        The merged statistics, or None if there are no dumps.
+
+    """
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(PROFILE_SUFFIX))
+    if not paths:
+        logger.info("No profiles in %s.", directory)
+        return None
+    stats = pstats.Stats(*paths)
+    stats.strip_dirs().sort_stats(sort)
+    logger.info("%d profiled batches, %.3f s in total. Top %d functions by %s:", len(paths), stats.total_tt, top, sort)
+    width = max(len(f"{filename}:{lineno}({function})") for filename, lineno, function in stats.fcn_list[:top])
+    for filename, lineno, function in stats.fcn_list[:top]:
+        _, calls, tottime, cumtime, _ = stats.stats[(filename, lineno, function)]
+        logger.info("%-*s %9d calls, tottime %.4f s, cumtime %.4f s", width, f"{filename}:{lineno}({function})",
+                    calls, tottime, cumtime)
+    return stats
+
+
+def summarize_allocations(directory: str, top: int = 20) -> list[tuple[str, int, int, int]]:
+    """Merge the tracemalloc snapshots of a directory and log the call sites that allocate the most.
+
+    Sizes are summed over the snapshots: they are the memory allocated by every call site during the profiled batches
+    and still alive at their end (the allocation peak of every batch is in the server log).
+
+    Args:
+        directory: The profiles directory.
+        top: Number of call sites to show.
+
+    Returns:
+        The top call sites as (file, line, size in bytes, number of blocks).
+
+    """
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.endswith(ALLOCATIONS_SUFFIX))
+    if not paths:
+        logger.info("No allocation snapshots in %s.", directory)
+        return []
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, "<frozen importlib._bootstrap*")]
+    sites = {}  # (file, line) -> [size, count]
+    for path in paths:
+        for statistic in tracemalloc.Snapshot.load(path).filter_traces(ignored).statistics("lineno"):
+            frame = statistic.traceback[0]
+            site = sites.setdefault((frame.filename, frame.lineno), [0, 0])
+            site[0] += statistic.size
+            site[1] += statistic.count
+    ranked = sorted(((filename, lineno, size, count) for (filename, lineno), (size, count) in sites.items()),
+                    key=lambda site: site[2], reverse=True)[:top]
+    logger.info("%d allocation snapshots. Top %d allocating call sites:", len(paths), top)
+    for filename, lineno, size, count in ranked:
+        logger.info("%s:%d: %.1f KiB in %d blocks", filename, lineno, size / 1024, count)
+    return ranked
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Merge and summarize the profiles written by the server.")
+    parser.add_argument("--dir", default=None, help="Profiles directory (default: RESULTS_PATH/profiles).")
+    parser.add_argument("--top", type=int, default=20, help="Number of functions and call sites to show.")
+    parser.add_argument("--sort", default="cumulative", help="Sort key of the functions (cumulative, tottime, ...).")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    # Summary of the samples written so far: `python profiling.py [--top N] [--sort tottime]`.
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(module)s - %(levelname)s - %(message)s")
+    args = parse_args()
+    profiles_dir = args.dir or os.path.join(get_results_path(), PROFILES_DIR)
+    summarize_profiles(profiles_dir, args.top, args.sort)
+    summarize_allocations(profiles_dir, args.top)
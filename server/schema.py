@@ -0,0 +1,61 @@
+from codec import iso_to_epoch_ns
+from metrics_pb2 import MetricsRequest
+
+# MetricsRequest schema versions accepted by the server, advertised through GetServerInfo:
+# * 1 — ISO 8601 timestamp strings (ServerMetrics.timestamp).
+# * 2 — int64 epoch-nanosecond timestamps (ServerMetrics.timestamp_ns), optionally relative to
+#   MetricsRequest.base_timestamp_ns.
+SUPPORTED_SCHEMA_VERSIONS = (1, 2)
+
+
+class SchemaVersionError(ValueError):
+    """Raised for a request with an unsupported schema version."""
+
+
+def detect_schema_version(request: MetricsRequest) -> int:
+    """Return the schema version of a request.
+
+    Clients that predate schema versions do not set `schema_version`; their requests are v1.
+
+    Args:
+        request: The received request.
+
+    Returns:
+        The schema version.
+
+    Raises:
+        SchemaVersionError: If the version is not supported.
+
+    """
+    version = request.schema_version or 1
+    if version not in SUPPORTED_SCHEMA_VERSIONS:
+        raise SchemaVersionError(f"Unsupported schema version: {version}")
+    return version
+
+
+def normalize_request(request: MetricsRequest) -> MetricsRequest:
+    """Convert a request of any supported version, in place, to v2.
+
+    v1 timestamps are parsed into absolute `timestamp_ns` values and the strings are cleared. v2 requests are left as
+    they are: delta-encoded timestamps keep their base, which the storage and the aggregator add while they read the
+    rows, so the rows are not walked an extra time here.
+
+    Args:
+        request: The received request.
+
+    Returns:
+        The same request, with `schema_version` 2 (`timestamp_ns` is relative to `base_timestamp_ns`, 0 if absolute).
+
+    Raises:
+        SchemaVersionError: If the version is not supported.
+        ValueError: If a v1 timestamp is not a valid ISO 8601 string.
+
+    """
+    version = detect_schema_version(request)
+    if version == 1:
+        for m in request.metrics:
+            m.timestamp_ns = iso_to_epoch_ns(m.timestamp)
+            m.ClearField("timestamp")
+        request.base_timestamp_ns = 0
+    request.schema_version = 2
+    return request
@@ -0,0 +1,517 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+from typing import Callable, Iterator, Union, Optional
+
+from compression import compress, decompress, CODECS
+logger = logging.getLogger(__name__)
+
+# Every record is stored as a fixed 8-byte header followed by the payload: the payload length and its CRC32, both as
+# little-endian unsigned 32-bit integers. The CRC lets the reader detect a torn (partially written) record at the end of
+# a segment after a crash.
+RECORD_HEADER = struct.Struct("<II")
+MANIFEST_NAME = "manifest.json"
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+def segment_name(segment_id: int) -> str:
+    """Return the file name of a segment (zero-padded, so names sort in creation order)."""
+    return f"{segment_id:08d}.seg"
+
+
+def read_manifest(directory: str) -> list[dict]:
+    """Read the list of segments of a log.
+
+    Args:
+        directory: The log directory.
+
+    Returns:
+        A list of segment descriptions ("id", "name", "created", "records", "bytes", "closed", "codec"), oldest first.
+        The "records" and "bytes" values of the active (not closed) segment are only updated on rotation and close.
+        Segments written before codecs were introduced have no "codec" (they are uncompressed).
+
+    """
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, "r") as f_manifest:
+        return json.load(f_manifest)["segments"]
+
+
+def scan_segment(path: str) -> tuple[int, int]:
+    """Count the valid records of a segment file.
+
+    Args:
+        path: Path to the segment file.
+
+    Returns:
+        A tuple (number of valid records, size in bytes of the valid prefix of the file).
+
+    """
+    records = 0
+    with open(path, "rb") as f_segment:
+        data = f_segment.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end > len(data) or zlib.crc32(data[offset + RECORD_HEADER.size:end]) != crc:
+            break
+        records += 1
+        offset = end
+    return records, offset
+
+
+def iter_frames(
+        data: Union[bytes, memoryview],
+        verify: bool = True,
+        name: str = "segment"
+) -> Iterator[Union[bytes, memoryview]]:
+    """Iterate over the records of one segment's contents.
+
+    Args:
+        data: The contents of the segment file (bytes, or a memoryview of a memory-mapped file).
+        verify: Whether to check the CRC32 of every record (this reads every byte of the record).
+        name: The segment name used in warnings.
+
+    Yields:
+        Record payloads, as slices of `data` (zero-copy if `data` is a memoryview).
+
+    """
+    for _, record in iter_frame_positions(data, verify, name):
+        yield record
+
+
+def iter_frame_positions(
+        data: Union[bytes, memoryview],
+        verify: bool = True,
+        name: str = "segment"
+) -> Iterator[tuple[int, Union[bytes, memoryview]]]:
+    """Like `iter_frames`, but also yield the position of every payload in the segment file.
+
+    Yields:
+        (offset of the payload, payload) tuples. The payload can later be read back directly from that offset, which
+        is how the sparse index locates records (see sparse_index.py).
+
+    """
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        record = data[start:start + length]
+        if len(record) < length or (verify and zlib.crc32(record) != crc):
+            logger.warning("Incomplete record at offset %d of %s.", offset, name)
+            return
+        yield start, record
+        offset = start + length
+
+
+def iter_records(directory: str) -> Iterator[bytes]:
+    """Iterate over all records of a log in append order.
+
+    Safe to call while the log is being written: a record that is not completely written yet ends the iteration of its
+    segment.
+
+    Args:
+        directory: The log directory.
+
+    Yields:
+        Record payloads (decompressed).
+
+    """
+    for segment in read_manifest(directory):
+        with open(os.path.join(directory, segment["name"]), "rb") as f_segment:
+            data = f_segment.read()
+        codec = segment.get("codec", "none")
+        for record in iter_frames(data, name=f"{directory}/{segment['name']}"):
+            yield decompress(codec, record)
+
+
+def record_positions(path: str) -> list[tuple[int, int, int]]:
+    """Locate the records of a segment file, reading only their headers.
+
+    Args:
+        path: Path to the segment file.
+
+    Returns:
+        (offset of the payload, length, CRC32) tuples, in file order. A record cut off by the end of the file ends the
+        list; the CRC is only checked when the payload is read.
+
+    """
+    positions = []
+    size = os.path.getsize(path)
+    with open(path, "rb") as f_segment:
+        offset = 0
+        while offset + RECORD_HEADER.size <= size:
+            length, crc = RECORD_HEADER.unpack(os.pread(f_segment.fileno(), RECORD_HEADER.size, offset))
+            start = offset + RECORD_HEADER.size
+            if start + length > size:
+                break
+            positions.append((start, length, crc))
+            offset = start + length
+    return positions
+
+
+def tail_positions(
+        directory: str,
+        max_records: Optional[int] = None,
+        max_bytes: Optional[int] = None
+) -> list[tuple[dict, list[tuple[int, int, int]]]]:
+    """Locate the most recent records of a log, within a number of records and a number of (stored) bytes.
+
+    Segments are visited from the newest one and only until the bounds are reached, so the cost depends on the size of
+    the tail, not of the log. At least one record is selected if the log has any, even if it exceeds `max_bytes`.
+
+    Args:
+        directory: The log directory.
+        max_records: Maximum number of records (None for no limit).
+        max_bytes: Maximum total stored length of the records (None for no limit).
+
+    Returns:
+        (segment description, positions of its selected records; see `record_positions`) tuples, oldest first.
+
+    """
+    selected = []
+    records = size = 0
+    for segment in reversed(read_manifest(directory)):
+        path = os.path.join(directory, segment["name"])
+        if not os.path.exists(path):
+            continue
+        positions = []
+        full = False
+        for position in reversed(record_positions(path)):
+            full = (max_records is not None and records >= max_records) or (
+                max_bytes is not None and records > 0 and size + position[1] > max_bytes)
+            if full:
+                break
+            positions.append(position)
+            records += 1
+            size += position[1]
+        if positions:
+            selected.append((segment, positions[::-1]))
+        if full:
+            break
+    return selected[::-1]
+
+
+def iter_tail_records(directory: str, max_records: int) -> Iterator[bytes]:
+    """Iterate over the last `max_records` records of a log, in append order (see `tail_positions`).
+
+    Yields:
+        Record payloads (decompressed). A record whose CRC does not match is skipped.
+
+    """
+    for segment, positions in tail_positions(directory, max_records=max_records):
+        path = os.path.join(directory, segment["name"])
+        codec = segment.get("codec", "none")
+        with open(path, "rb") as f_segment:
+            for offset, length, crc in positions:
+                record = os.pread(f_segment.fileno(), length, offset)
+                if zlib.crc32(record) != crc:
+                    logger.warning("Corrupt record at offset %d of %s.", offset - RECORD_HEADER.size, path)
+                    continue
+                yield decompress(codec, record)
+
+
+def iter_tail_mapped_records(directory: str, max_records: int) -> Iterator[Union[memoryview, bytes]]:
+    """Like `iter_tail_records`, but return the records as zero-copy views of the memory-mapped segments.
+
+    Records are not checked against their CRC (see `MappedLog`). A view is only valid until the records of the next
+    segment are requested (its segment is unmapped then, unless views of it are still referenced).
+
+    Yields:
+        Record payloads as memoryviews (bytes for compressed segments).
+
+    """
+    for segment, positions in tail_positions(directory, max_records=max_records):
+        path = os.path.join(directory, segment["name"])
+        with open(path, "rb") as f_segment:
+            mapped = mmap.mmap(f_segment.fileno(), 0, access=mmap.ACCESS_READ)  # Not empty: it holds records.
+        codec = segment.get("codec", "none")
+        view = memoryview(mapped)
+        for offset, length, _ in positions:
+            yield decompress(codec, view[offset:offset + length])
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:  # Records are still referenced; the mapping is released once they are collected.
+            pass
+
+
+class MappedLog:
+    """Read-only memory maps of all segments of a log.
+
+    Records of uncompressed segments are returned as memoryviews into the mapped files, so reading a record copies
+    nothing: pages are loaded from the page cache only when the bytes are actually accessed. Records of compressed
+    segments are decompressed into new bytes objects.
+
+    Usage:
+        with MappedLog(directory) as log:
+            for record in log.records():
+                ...
+
+    """
+
+    def __init__(self, directory: str, verify: bool = False) -> None:
+        """Initialize the reader.
+
+        Args:
+            directory: The log directory.
+            verify: Whether to check the CRC32 of every record. Off by default, because it reads every byte.
+
+        """
+        self.directory = directory
+        self.verify = verify
+        self._maps = []
+
+    def __enter__(self) -> "MappedLog":
+        for segment in read_manifest(self.directory):
+            path = os.path.join(self.directory, segment["name"])
+            if os.path.getsize(path) == 0:  # Empty files cannot be mapped.
+                continue
+            with open(path, "rb") as f_segment:
+                # The mapping stays valid after the file is closed.
+                self._maps.append((segment["name"], segment.get("codec", "none"),
+                                   mmap.mmap(f_segment.fileno(), 0, access=mmap.ACCESS_READ)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        for _, _, mapped in self._maps:
+            try:
+                mapped.close()
+            except BufferError:  # Records are still referenced; the mapping is released once they are collected.
+                pass
+        self._maps = []
+
+    def records(self) -> Iterator[Union[memoryview, bytes]]:
+        """Iterate over all records of the log in append order.
+
+        Yields:
+            Record payloads as memoryviews into the mapped segments (bytes for compressed segments).
+
+        """
+        for name, codec, mapped in self._maps:
+            for record in iter_frames(memoryview(mapped), self.verify, f"{self.directory}/{name}"):
+                yield decompress(codec, record)
+
+
+def log_size(directory: str) -> int:
+    """Return the total size in bytes of all segment files of a log."""
+    return sum(os.path.getsize(os.path.join(directory, segment["name"])) for segment in read_manifest(directory))
+
+
+class SegmentLog:
+    """Append-only log of length-prefixed records stored in rolling segment files.
+
+    Records are appended to the active segment, so the cost of a write depends only on the size of the record. The
+    active segment is closed and a new one is started when it would exceed `max_segment_bytes` or when it is older than
+    `max_segment_age` seconds. The list of segments is kept in manifest.json, which is replaced atomically whenever a
+    segment is opened or closed.
+
+    Durability is controlled by `fsync_policy`:
+    * "always" — fsync after every append.
+    * "interval" — fsync on an append if at least `fsync_interval_ms` passed since the previous fsync.
+    * "never" — leave flushing to the OS (data survives a process crash, but not a power loss).
+    Segments are always fsynced on rotation and close unless the policy is "never".
+
+    Records can be compressed with `codec` (see compression.py). The codec is stored per segment in the manifest, so
+    changing it only affects new segments: a recovered active segment written with another codec is rotated.
+
+    `on_segment_closed` is called with the directory and the description of every segment once it is closed (and
+    before the manifest says so), e.g. to build a read-only index of the now immutable file. `on_records_appended` is
+    called after every write with the directory, the description of the active segment, the (offset, length) positions
+    of the new payloads and the payloads themselves (as stored, i.e. compressed), e.g. to index the active segment as it
+    grows.
+
+    All methods are thread-safe.
+
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            max_segment_bytes: int = 64 * 1024 * 1024,
+            max_segment_age: float = 3600.0,
+            fsync_policy: str = "interval",
+            fsync_interval_ms: int = 1000,
+            codec: str = "none",
+            codec_level: Optional[int] = None,
+            on_segment_closed: Optional[Callable[[str, dict], None]] = None,
+            on_records_appended: Optional[Callable[[str, dict, list[tuple[int, int]], list[bytes]], None]] = None
+    ) -> None:
+        """Open the log, creating it or recovering the active segment after a restart.
+
+        Args:
+            directory: The log directory.
+            max_segment_bytes: Size threshold for segment rotation.
+            max_segment_age: Age threshold (in seconds) for segment rotation.
+            fsync_policy: One of "always", "interval" or "never".
+            fsync_interval_ms: Minimum time between two fsyncs with the "interval" policy.
+            codec: At-rest compression of the records: "none", "zlib", "bz2" or "lzma".
+            codec_level: Compression level, or None for the default level of the codec.
+            on_segment_closed: Called after a segment is closed. Exceptions are logged, not raised.
+            on_records_appended: Called after records are written, with the log lock held. Exceptions are logged, not
+                raised.
+
+        Raises:
+            ValueError: If the fsync policy or the codec is unknown.
+            OSError: If the directory or the segment files cannot be created.
+
+        """
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.codec = codec
+        self.codec_level = codec_level
+        self.on_segment_closed = on_segment_closed
+        self.on_records_appended = on_records_appended
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        self._file = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._segments = read_manifest(directory)
+        if self._segments and not self._segments[-1]["closed"]:
+            self._recover_active_segment()
+            if self._segments[-1].get("codec", "none") != codec:
+                self._rotate()
+        else:
+            self._open_segment(self._segments[-1]["id"] + 1 if self._segments else 1)
+
+    @property
+    def total_bytes(self) -> int:
+        """Total size of all segments, including the active one."""
+        with self._lock:
+            return sum(segment["bytes"] for segment in self._segments)
+
+    def append(self, record: bytes) -> None:
+        """Append a record to the log.
+
+        Args:
+            record: The record payload (at most 4 GiB).
+
+        """
+        self.append_many([record])
+
+    def encode(self, record: bytes) -> bytes:
+        """Compress a record with the codec of the log, so that it can be appended with `encoded=True`.
+
+        Lets callers compress in their own thread instead of in the thread that appends.
+
+        """
+        return compress(self.codec, record, self.codec_level)
+
+    def append_many(self, records: list[bytes], encoded: bool = False) -> None:
+        """Append several records to the log with a single write (and at most one fsync).
+
+        The records always end up in the same segment, even if together they exceed `max_segment_bytes`.
+
+        Args:
+            records: The record payloads (at most 4 GiB each).
+            encoded: Whether the records were already compressed with `encode`.
+
+        """
+        if not records:
+            return
+        if not encoded:
+            records = [self.encode(record) for record in records]
+        data = b"".join(RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record for record in records)
+        with self._lock:
+            active = self._segments[-1]
+            if active["bytes"] and (active["bytes"] + len(data) > self.max_segment_bytes
+                                    or time.time() - active["created"] >= self.max_segment_age):
+                self._rotate()
+                active = self._segments[-1]
+            self._file.write(data)
+            offset = active["bytes"]
+            active["records"] += len(records)
+            active["bytes"] += len(data)
+            if self.on_records_appended is not None:
+                positions = []
+                for record in records:
+                    positions.append((offset + RECORD_HEADER.size, len(record)))
+                    offset += RECORD_HEADER.size + len(record)
+                try:
+                    self.on_records_appended(self.directory, active, positions, records)
+                except Exception as e:
+                    logger.error("Post-append hook failed for %s/%s: %s", self.directory, active["name"], e)
+            if self.fsync_policy == "always" or (
+                    self.fsync_policy == "interval" and time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+
+    def sync(self) -> None:
+        """Force the active segment to disk, regardless of the fsync policy."""
+        with self._lock:
+            self._sync()
+
+    def close(self) -> None:
+        """Sync and close the active segment. The log can be reopened later and will start a new segment."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._close_segment()
+            self._write_manifest()
+
+    def _sync(self) -> None:
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def _rotate(self) -> None:
+        self._close_segment()
+        self._open_segment(self._segments[-1]["id"] + 1)
+
+    def _open_segment(self, segment_id: int) -> None:
+        name = segment_name(segment_id)
+        # Unbuffered binary mode: each append is a single write() call straight to the OS.
+        self._file = open(os.path.join(self.directory, name), "ab", buffering=0)
+        self._segments.append({"id": segment_id, "name": name, "created": time.time(), "records": 0, "bytes": 0,
+                               "closed": False, "codec": self.codec})
+        self._write_manifest()
+        logger.info("Opened segment %s/%s.", self.directory, name)
+
+    def _close_segment(self) -> None:
+        if self.fsync_policy != "never":
+            self._sync()
+        self._file.close()
+        self._file = None
+        self._segments[-1]["closed"] = True
+        if self.on_segment_closed is not None:
+            try:
+                self.on_segment_closed(self.directory, self._segments[-1])
+            except Exception as e:
+                logger.error("Post-close hook failed for %s/%s: %s", self.directory, self._segments[-1]["name"], e)
+
+    def _recover_active_segment(self) -> None:
+        # The manifest counters of the active segment are stale after a restart: recount them and cut off a torn tail.
+        active = self._segments[-1]
+        path = os.path.join(self.directory, active["name"])
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        records, valid_bytes = scan_segment(path)
+        if valid_bytes < os.path.getsize(path):
+            logger.warning("Truncating %d bytes of incomplete records from %s.", os.path.getsize(path) - valid_bytes,
+                           path)
+            os.truncate(path, valid_bytes)
+        active["records"] = records
+        active["bytes"] = valid_bytes
+        self._file = open(path, "ab", buffering=0)
+        self._write_manifest()
+        logger.info("Recovered segment %s (%d records, %d bytes).", path, records, valid_bytes)
+
+    def _write_manifest(self) -> None:
+        # Write to a temporary file and rename it, so readers never see a partially written manifest.
+        manifest_path = os.path.join(self.directory, MANIFEST_NAME)
+        with open(f"{manifest_path}.tmp", "w") as f_manifest:
+            json.dump({"segments": self._segments}, f_manifest)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
@@ -1,13 +1,25 @@
+import os
+import asyncio
 import logging
 import signal
+from typing import Iterator, Optional, Union
 from concurrent import futures  # For creating a thread pool used by the gRPC server.
 
 import grpc
 
-from metrics_pb2 import MetricsResponse, MetricsRequest
+from metrics_pb2 import MetricsResponse, MetricsRequest, ServerInfo, ServerInfoRequest, AggregatesQuery, \
+    AggregatesResponse, MetricsQuery, StatsRequest, StatsResponse, ProfilingSettings, ProfilingStatus
 from metrics_pb2_grpc import MetricsServiceServicer, add_MetricsServiceServicer_to_server
-from storage import save_metrics
-from deserialize_perfomance import measure_deserialize_performance
+from storage import MetricsStore, query_parameters
+from group_commit import GroupCommitWriter
+from schema import normalize_request, SchemaVersionError, SUPPORTED_SCHEMA_VERSIONS
+from aggregation import AGGREGATION_DISABLED, MetricsAggregator, answer_query, aggregator_from_env
+from deserialize_perfomance import measure_deserialize_performance, BenchmarkWorker
+from stats import StatsRegistry, StatsInterceptor, start_http_server
+from profiling import RequestProfiler, apply_settings, profiler_from_env
+from shm_server import ShmIngestServer
+from aio_server import serve_aio
+from launcher import WorkerSupervisor
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,16 +31,63 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Several processes may listen on the same port: the kernel spreads new connections between them (SO_REUSEPORT).
+# Long-lived client channels (see client/collector.py) send keepalive pings, also while idle: they are accepted every
+# 10 seconds instead of the default 5 minutes, beyond which the connection is closed ("too many pings").
+SERVER_OPTIONS = [
+    ("grpc.so_reuseport", 1),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.min_ping_interval_without_data_ms", 10_000)
+]
+# Compression of the messages sent by the server, selected by GRPC_COMPRESSION. Compressed requests are always accepted,
+# whatever the setting.
+GRPC_COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate
+}
+
 
 # Define the MetricsService class, inheriting from MetricsServiceServicer.
 # This class implements the methods defined in the MetricsService service in metrics.proto.
 class MetricsService(MetricsServiceServicer):
     """Implementation of the MetricsService gRPC service.
 
-    This class defines the behavior of the SendMetrics RPC method as specified in metrics.proto.
+    This class defines the behavior of the SendMetrics, SendMetricsStream, GetServerInfo, QueryMetrics,
+    QueryAggregates and GetStats RPC methods as specified in metrics.proto. Requests of every supported schema version
+    are accepted and converted to v2 before they are saved. Saved metrics are also counted by the aggregator, which
+    answers QueryAggregates.
 
     """
 
+    def __init__(
+            self,
+            store: Union[MetricsStore, GroupCommitWriter],
+            benchmark_mode: str = "background",
+            benchmark_worker: Optional[BenchmarkWorker] = None,
+            aggregator: Optional[MetricsAggregator] = None,
+            stats: Optional[StatsRegistry] = None,
+            profiler: Optional[RequestProfiler] = None
+    ) -> None:
+        """Initialize the service.
+
+        Args:
+            store: The storage that received metrics are appended to (directly or through the group commit writer).
+            benchmark_mode: How SendMetrics runs the deserialization benchmark: "inline" (before replying),
+                "background" (handed to `benchmark_worker` after the reply is ready) or "off".
+            benchmark_worker: The worker used in the "background" mode.
+            aggregator: The rolling aggregates updated with the saved metrics (None to disable QueryAggregates).
+            stats: The registry of the stage timings, returned by GetStats.
+            profiler: The profiler of a sample of the saved batches (off by default), configured by ConfigureProfiling.
+
+        """
+        self.store = store
+        self.benchmark_mode = benchmark_mode
+        self.benchmark_worker = benchmark_worker
+        self.aggregator = aggregator
+        self.stats = stats if stats is not None else StatsRegistry()
+        self.profiler = profiler if profiler is not None else RequestProfiler()
+
     def SendMetrics(
             self,
             request: MetricsRequest,
@@ -36,6 +95,9 @@ class MetricsService(MetricsServiceServicer):
     ) -> MetricsResponse:
         """Process incoming metrics and save them, measuring deserialization performance.
 
+        The reply is sent once the metrics are persisted. Unless the benchmark mode is "inline", the deserialization
+        benchmark does not delay the reply.
+
         Args:
             request: A Protobuf MetricsRequest object containing an array of metrics.
             context: The gRPC context for managing the RPC call.
@@ -46,10 +108,20 @@ class MetricsService(MetricsServiceServicer):
         """
         logger.info("Received %d metrics.", len(request.metrics))
         try:
-            save_metrics(request.metrics)
-            measure_deserialize_performance(request.metrics)
+            self.save(request)
+            if self.benchmark_mode == "inline":
+                with self.stats.timer("benchmark"):
+                    measure_deserialize_performance()
+            elif self.benchmark_mode == "background":
+                self.benchmark_worker.submit()
             logger.info("Metrics processed successfully.")
-            return MetricsResponse(message="Data received and processed.")
+            return MetricsResponse(message="Data received and processed.", metrics_count=len(request.metrics),
+                                   chunks_count=1)
+        except SchemaVersionError as e:
+            logger.error("Rejected metrics: %s", e)
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return MetricsResponse(message="Error processing data.")
         except Exception as e:
             logger.error("Failed to process metrics: %s", e)
             context.set_code(
@@ -58,35 +130,280 @@ class MetricsService(MetricsServiceServicer):
                 str(e))  # Provide error details for the client (a string containing the exception description).
             return MetricsResponse(message="Error processing data.")
 
+    def SendMetricsStream(
+            self,
+            request_iterator: Iterator[MetricsRequest],
+            context: grpc.ServicerContext
+    ) -> MetricsResponse:
+        """Process a client stream of metric chunks, saving each chunk as soon as it arrives.
+
+        Only one chunk is held in memory at a time, so the total number of metrics per call is not limited by memory
+        or by the gRPC message size limit. Deserialization performance is not measured here, because it would re-read
+        the whole (possibly very large) result files.
+
+        Args:
+            request_iterator: An iterator over Protobuf MetricsRequest chunks sent by the client.
+            context: The gRPC context for managing the RPC call.
+
+        Returns:
+            A Protobuf response object with a summary of the stream or an error message.
+
+        """
+        logger.info("Metrics stream opened.")
+        metrics_count = 0
+        chunks_count = 0
+        try:
+            for request in request_iterator:  # Blocks until the next chunk arrives; ends when the client closes the stream.
+                self.save(request)
+                metrics_count += len(request.metrics)
+                chunks_count += 1
+            logger.info("Metrics stream processed successfully: %d metrics in %d chunks.", metrics_count,
+                        chunks_count)
+            return MetricsResponse(message="Data received and processed.", metrics_count=metrics_count,
+                                   chunks_count=chunks_count)
+        except SchemaVersionError as e:
+            logger.error("Rejected metrics stream: %s", e)
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return MetricsResponse(message="Error processing data.")
+        except Exception as e:
+            logger.error("Failed to process metrics stream: %s", e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(str(e))
+            return MetricsResponse(message="Error processing data.")
+
+    def save(self, request: MetricsRequest) -> None:
+        """Convert a request to schema v2, save its metrics and count them in the aggregates."""
+        with self.profiler.sample():
+            with self.stats.timer("normalize"):
+                request = normalize_request(request)
+            self.store.save_metrics(request.metrics, request.base_timestamp_ns)
+            if self.aggregator is not None:
+                with self.stats.timer("aggregate"):  # Only persisted metrics are counted.
+                    self.aggregator.update(request.metrics, request.base_timestamp_ns)
+
+    def GetServerInfo(self, request: ServerInfoRequest, context: grpc.ServicerContext) -> ServerInfo:
+        """Advertise the schema versions accepted by SendMetrics and SendMetricsStream."""
+        return ServerInfo(schema_versions=SUPPORTED_SCHEMA_VERSIONS)
+
+    def QueryMetrics(self, request: MetricsQuery, context: grpc.ServicerContext) -> Iterator[MetricsRequest]:
+        """Stream the stored rows of some servers in a time range, in chunks of bounded size.
+
+        Only the stored blocks that may hold matching rows are read (see sparse_index.py), and chunks are produced
+        while the client consumes them, so memory does not depend on the size of the result.
+
+        Args:
+            request: The servers, time range, chunk size and row limit.
+            context: The gRPC context for managing the RPC call.
+
+        Yields:
+            Schema v2 MetricsRequest chunks with absolute timestamps.
 
-def serve() -> None:
+        """
+        try:
+            parameters = query_parameters(request)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        rows_count = 0
+        try:
+            for chunk in self.store.query_metrics(**parameters):
+                rows_count += len(chunk.metrics)
+                yield chunk
+        except Exception as e:
+            logger.error("Metrics query failed: %s", e)
+            context.abort(grpc.StatusCode.INTERNAL, str(e))
+        logger.info("Metrics query returned %d rows.", rows_count)
+
+    def QueryAggregates(self, request: AggregatesQuery, context: grpc.ServicerContext) -> AggregatesResponse:
+        """Return the rolling aggregates of the recently received metrics (see aggregation.py).
+
+        Args:
+            request: The servers, metrics, window and range to return.
+            context: The gRPC context for managing the RPC call.
+
+        Returns:
+            The aggregates, or an empty response with INVALID_ARGUMENT for an invalid query (FAILED_PRECONDITION if
+            aggregation is disabled, by AGGREGATION=off or by SERVER_WORKERS > 1).
+
+        """
+        if self.aggregator is None:
+            context.set_code(grpc.StatusCode.FAILED_PRECONDITION)
+            context.set_details(AGGREGATION_DISABLED)
+            return AggregatesResponse()
+        try:
+            return answer_query(self.aggregator, request)
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return AggregatesResponse()
+
+    def GetStats(self, request: StatsRequest, context: grpc.ServicerContext) -> StatsResponse:
+        """Return the stage timings, request sizes and call counters of this server process (see stats.py)."""
+        return self.stats.to_proto()
+
+    def ConfigureProfiling(self, request: ProfilingSettings, context: grpc.ServicerContext) -> ProfilingStatus:
+        """Change the profiling mode of this server process (see profiling.py) and return it."""
+        try:
+            return apply_settings(self.profiler, request)
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return ProfilingStatus()
+
+
+def shard_socket_path(path: str, shard: Optional[int]) -> str:
+    """Return the Unix socket path of a worker: worker 0 (or the only process) uses `path`, worker N `path.N`."""
+    return f"{path}.{shard}" if path and shard else path
+
+
+def serve(shard: Optional[int] = None) -> None:
     """Start and run the gRPC server to handle incoming metrics requests.
 
     Sets up a gRPC server on port 50051 with a thread pool, registers the MetricsService,
     and listens for incoming connections until interrupted (e.g., via SIGINT or SIGTERM).
+    BENCHMARK_MODE selects how the deserialization benchmark is run ("background" by default, in a separate process,
+    "inline" or "off"), and BENCHMARK_QUEUE_SIZE bounds the number of pending background benchmarks. WRITE_MODE
+    selects whether concurrent requests are written through the group commit writer ("group", the default) or each on
+    its own ("direct").
+    SERVER_MODE selects the sync server with a thread pool ("sync", the default) or the asyncio server ("aio"), which
+    caps concurrent writes at MAX_IN_FLIGHT and rejects requests with RESOURCE_EXHAUSTED once MAX_QUEUE_DEPTH requests
+    are waiting (see aio_server.py). AGGREGATION turns the in-memory rolling aggregates on ("on", the default) or off
+    (they are always off with several workers); they are configured with AGGREGATION_PANE_S, AGGREGATION_RETENTION_S,
+    AGGREGATION_IDLE_S and AGGREGATION_MAX_SERVERS (see aggregation.py). Every call is timed by a StatsInterceptor, and
+    the time spent in every processing stage is recorded (see stats.py): the statistics are returned by GetStats and,
+    if STATS_HTTP_PORT is set, served in the Prometheus text format at http://STATS_HTTP_HOST:STATS_HTTP_PORT/metrics
+    (worker N of several uses STATS_HTTP_PORT + N). PROFILE_SAMPLE_RATE turns on the profiling of a sample of the saved
+    batches (see profiling.py), which the ConfigureProfiling call can also do at runtime.
+
+    Clients on the same host can skip the TCP stack: if SERVER_SOCKET is set, the gRPC server also listens on that Unix
+    socket, and if SHM_SOCKET is set, batches are also received through shared-memory ring buffers announced on that
+    Unix socket (see shm_server.py). Worker N of several appends ".N" to both paths.
+
+    Args:
+        shard: The index of the worker process when several are running (see `main`). The worker writes to its own
+            storage shard, and only worker 0 runs the deserialization benchmark.
 
     """
+    server_mode = os.getenv("SERVER_MODE", "sync")
+    if server_mode not in ("sync", "aio"):
+        raise ValueError(f"Unknown SERVER_MODE: {server_mode}")
+    compression_name = os.getenv("GRPC_COMPRESSION", "none")
+    if compression_name not in GRPC_COMPRESSION:
+        raise ValueError(f"Unknown GRPC_COMPRESSION: {compression_name} "
+                         f"(expected one of: {', '.join(GRPC_COMPRESSION)})")
+    compression = GRPC_COMPRESSION[compression_name]
+    benchmark_mode = os.getenv("BENCHMARK_MODE", "background")
+    if benchmark_mode not in ("background", "inline", "off"):
+        raise ValueError(f"Unknown BENCHMARK_MODE: {benchmark_mode}")
+    if shard:
+        benchmark_mode = "off"  # The benchmark reads every shard: one worker running it is enough.
+    unix_socket = shard_socket_path(os.getenv("SERVER_SOCKET", ""), shard)
+    shm_socket = shard_socket_path(os.getenv("SHM_SOCKET", ""), shard)
+    stats = StatsRegistry()
+    profiler = profiler_from_env()
+    stats_port = int(os.getenv("STATS_HTTP_PORT", "0"))
+    stats_server = None
+    if stats_port > 0:
+        stats_server = start_http_server(stats, os.getenv("STATS_HTTP_HOST", "127.0.0.1"), stats_port + (shard or 0))
+    benchmark_worker = None
+    if benchmark_mode == "background":
+        benchmark_worker = BenchmarkWorker(int(os.getenv("BENCHMARK_QUEUE_SIZE", "1")), stats)
+        benchmark_worker.start()
+    write_mode = os.getenv("WRITE_MODE", "group")
+    if write_mode not in ("group", "direct"):
+        raise ValueError(f"Unknown WRITE_MODE: {write_mode}")
+    aggregator = aggregator_from_env()
+    if shard is not None and aggregator is not None:
+        # Every worker only sees the calls it accepted: until aggregates are merged across workers, a query would
+        # silently return a fraction of the data depending on the worker that answers it.
+        logger.warning("Aggregation is disabled with SERVER_WORKERS > 1.")
+        aggregator = None
+    store = MetricsStore(shard=shard, stats=stats)
+    if write_mode == "group":
+        store = GroupCommitWriter(
+            store,
+            max_batch_bytes=int(os.getenv("GROUP_COMMIT_MAX_BYTES", str(1024 * 1024))),
+            max_delay_ms=float(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", "2"))
+        )
+
+    if server_mode == "aio":
+        logger.info("Starting asyncio gRPC server on port 50051.")
+        try:
+            asyncio.run(serve_aio(store, benchmark_mode, benchmark_worker,
+                                  max_in_flight=int(os.getenv("MAX_IN_FLIGHT", "32")),
+                                  max_queue_depth=int(os.getenv("MAX_QUEUE_DEPTH", "256")), options=SERVER_OPTIONS,
+                                  compression=compression, aggregator=aggregator, stats=stats,
+                                  profiler=profiler, unix_socket=unix_socket, shm_socket=shm_socket))
+        finally:
+            if benchmark_worker is not None:
+                benchmark_worker.stop(timeout=5)
+            store.close()
+            if stats_server is not None:
+                stats_server.shutdown()
+                stats_server.server_close()
+        return
+
     logger.info("Starting gRPC server on port 50051.")
     server = grpc.server(futures.ThreadPoolExecutor(
-        10))  # Create a gRPC server with a thread pool (maximum 10 threads for parallel request handling). If None, the server runs in single-threaded mode.
+        10), interceptors=[StatsInterceptor(stats)], options=SERVER_OPTIONS, compression=compression)  # Create a gRPC server with a thread pool (maximum 10 threads for parallel request handling). If None, the server runs in single-threaded mode.
     logger.info("Server initialized: %s", server)
 
-    add_MetricsServiceServicer_to_server(MetricsService(),
-                                         server)  # Register the MetricsService implementation on the server.
+    service = MetricsService(store, benchmark_mode, benchmark_worker, aggregator, stats, profiler)
+    add_MetricsServiceServicer_to_server(service, server)  # Register the MetricsService implementation on the server.
 
     server.add_insecure_port(
         "[::]:50051")  # Bind the server to port 50051 using an insecure connection (no TLS/SSL). This is convenient for local development but not secure for production. "[::]" means the server listens on all available interfaces.
     # server.add_secure_port("[::]:50051", grpc.ssl_server_credentials([...]))  # Secure connection (TLS/SSL).
     # server.add_insecure_port("[::]:50052")  # Any other available port.
     # server.add_insecure_port("127.0.0.1:50051")  # Local connections only.
-    # server.add_insecure_port("unix:/tmp/grpc.sock")  # Unix sockets (alternative to TCP connections).
+    if unix_socket:
+        server.add_insecure_port(f"unix:{unix_socket}")  # Unix socket for local clients (SERVER_SOCKET).
+        logger.info("Also listening on unix:%s.", unix_socket)
 
     server.start()  # Start the server to accept requests.
+    shm_server = None
+    if shm_socket:
+        shm_server = ShmIngestServer(shm_socket, service.save, stats)
+        shm_server.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop(
+        5))  # `docker compose down` sends SIGTERM: stop accepting requests, give in-flight ones 5 seconds to finish, and let wait_for_termination return so that the storage is closed cleanly.
     logger.info("Server started. Press Ctrl+C to stop.")
 
-    server.wait_for_termination()  # Block program execution, waiting for the gRPC server to terminate (ensures the server keeps running until interrupted, e.g., with Ctrl+C). Without this, the server might exit immediately after starting.
-    # server.wait_for_termination(timeout=60)  # If the server does not stop, execution will continue after 60 seconds of waiting. Useful for periodic server status checks or scenarios where the server should not run indefinitely.
+    try:
+        server.wait_for_termination()  # Block program execution, waiting for the gRPC server to terminate (ensures the server keeps running until interrupted, e.g., with Ctrl+C). Without this, the server might exit immediately after starting.
+        # server.wait_for_termination(timeout=60)  # If the server does not stop, execution will continue after 60 seconds of waiting. Useful for periodic server status checks or scenarios where the server should not run indefinitely.
+    finally:
+        if shm_server is not None:
+            shm_server.stop()  # Before the store is closed: the batch being saved is finished.
+        if benchmark_worker is not None:
+            benchmark_worker.stop(timeout=5)
+        store.close()
+        if stats_server is not None:
+            stats_server.shutdown()
+            stats_server.server_close()
+
+
+def serve_worker(shard: int) -> None:
+    """Entry point of a worker process started by `main`."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole process group; the supervisor stops the workers with SIGTERM.
+    logger.info("Worker %d started (pid %d).", shard, os.getpid())
+    serve(shard)
+
+
+def main() -> None:
+    """Run the server in this process, or, if SERVER_WORKERS is greater than 1, in that many supervised processes.
+
+    Protobuf parsing and encoding are CPU-bound and serialized by the GIL, so a single process uses at most one core.
+    With SERVER_WORKERS=N, N processes listen on port 50051 (SO_REUSEPORT), each writing to its own storage shard, and
+    a crashed worker is restarted by the supervisor.
+
+    """
+    workers = int(os.getenv("SERVER_WORKERS", "1"))
+    if workers > 1:
+        WorkerSupervisor(workers, serve_worker).run()
+    else:
+        serve()
 
 
 if __name__ == "__main__":
-    serve()
+    main()
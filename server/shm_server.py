@@ -0,0 +1,187 @@
+import os
+import time
+import socket
+import logging
+import threading
+import contextlib
+from multiprocessing import shared_memory
+from typing import Callable, Optional, Union
+
+from codec import decode_flatbuffers_columnar
+from shm_ring import HELLO, BATCH, ACK, MAGIC, ACK_OK, ACK_INVALID, ACK_FAILED, ACK_STATUSES, recv_exactly, \
+    attach_ring
+from metrics_pb2 import MetricsRequest
+from stats import StatsRegistry, PARSE_LABELS
+
+logger = logging.getLogger(__name__)
+
+SHM_METHOD = "SendMetricsShm"  # Method label of the shared-memory batches in the statistics.
+SHM_LABELS = (("method", SHM_METHOD),)
+
+
+def batch_to_request(batch: Union[bytes, memoryview]) -> MetricsRequest:
+    """Read a MetricsBatch buffer in place into a schema v2 MetricsRequest with absolute timestamps.
+
+    Raises:
+        ValueError: If the buffer is not a valid MetricsBatch.
+
+    """
+    try:
+        columns = decode_flatbuffers_columnar(batch)
+        server_ids = columns["server_ids"]
+        request = MetricsRequest(schema_version=2)
+        add = request.metrics.add
+        for i, cpu, memory, disk, timestamp in zip(columns["server_index"].tolist(), columns["cpu_usage"].tolist(),
+                                                   columns["memory_usage"].tolist(), columns["disk_usage"].tolist(),
+                                                   columns["timestamp_ns"].tolist()):
+            add(server_id=server_ids[i], cpu_usage=cpu, memory_usage=memory, disk_usage=disk, timestamp_ns=timestamp)
+    except Exception as e:  # Truncated buffers, out-of-range offsets or server indices, ...
+        raise ValueError(f"Invalid MetricsBatch: {e!r}") from None
+    return request
+
+
+class ShmIngestServer:
+    """Receive batches from clients on the same host through shared-memory rings (see shm_ring.py).
+
+    Clients connect to a Unix socket, the control channel, and announce the batches they write into their ring. Every
+    connection is served by its own thread: the batches of a connection are read in place, saved with `save` one after
+    the other, and acknowledged in order. A batch is acknowledged once it is saved, so a client never has more
+    unsaved batches in flight than its ring holds.
+
+    Every batch is recorded in `stats` like a SendMetrics call (method "SendMetricsShm"): parse time, size, rows and
+    duration.
+
+    """
+
+    def __init__(
+            self,
+            path: str,
+            save: Callable[[MetricsRequest], None],
+            stats: Optional[StatsRegistry] = None
+    ) -> None:
+        """Initialize the server.
+
+        Args:
+            path: Path of the Unix socket (a stale socket file is replaced).
+            save: Saves one request (the `save` method of the gRPC service).
+            stats: The registry the batches are recorded in (a private one by default).
+
+        """
+        self.path = path
+        self.save = save
+        self.stats = stats if stats is not None else StatsRegistry()
+        self._sock = None
+        self._connections = set()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Listen on the socket and accept connections in a background thread.
+
+        Raises:
+            OSError: If the socket cannot be created.
+
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen()
+        thread = threading.Thread(target=self._accept, name="shm-accept", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        logger.info("Shared-memory transport listening on %s.", self.path)
+
+    def stop(self, timeout: Optional[float] = 5.0) -> None:
+        """Stop accepting connections, close the open ones, and wait for their current batch to be saved."""
+        if self._sock is None:
+            return
+        with contextlib.suppress(OSError):
+            self._sock.shutdown(socket.SHUT_RDWR)  # Wakes up the accepting thread.
+        self._sock.close()
+        with self._lock:
+            for connection in self._connections:
+                with contextlib.suppress(OSError):
+                    connection.shutdown(socket.SHUT_RDWR)  # The serving thread sees the end of the stream.
+        with self._lock:
+            threads = list(self._threads)  # Connection threads remove themselves when they end.
+        for thread in threads:
+            thread.join(timeout)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+        self._sock = None
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                connection, _ = self._sock.accept()
+            except OSError:  # The socket was closed by `stop`.
+                return
+            thread = threading.Thread(target=self._serve, args=(connection,), name="shm-connection", daemon=True)
+            with self._lock:
+                self._connections.add(connection)
+                self._threads.append(thread)
+            thread.start()
+
+    def _serve(self, connection: socket.socket) -> None:
+        """Serve the batches of one client until it disconnects."""
+        ring = None
+        batches_count = 0
+        try:
+            magic, capacity, name_length = HELLO.unpack(recv_exactly(connection, HELLO.size))
+            if magic != MAGIC:
+                logger.error("Rejected shared-memory connection: unknown protocol %r.", magic)
+                return
+            ring = attach_ring(recv_exactly(connection, name_length).decode("utf-8"))
+            logger.info("Shared-memory client connected (%.1f MiB ring %s).", capacity / 2 ** 20, ring.name)
+            while True:
+                try:
+                    frame = recv_exactly(connection, BATCH.size)
+                except ConnectionError:  # The client is done.
+                    break
+                sequence, offset, size = BATCH.unpack(frame)
+                metrics_count, status = self.process(ring, offset, size)
+                connection.sendall(ACK.pack(sequence, metrics_count, status))
+                batches_count += 1
+        except (OSError, ValueError) as e:
+            logger.error("Shared-memory connection failed: %s", e)
+        finally:
+            with self._lock:
+                self._connections.discard(connection)
+                self._threads.remove(threading.current_thread())
+            connection.close()
+            if ring is not None:
+                ring.close()
+            self.stats.release_thread()  # The thread ends with the connection: its values are kept, not its shard.
+            logger.info("Shared-memory client disconnected after %d batches.", batches_count)
+
+    def process(self, ring: shared_memory.SharedMemory, offset: int, size: int) -> tuple[int, int]:
+        """Read one batch from a ring and save it.
+
+        As for gRPC calls, the parse time is recorded as the "parse" stage, and the call duration starts after it.
+
+        Returns:
+            The number of saved metrics and the acknowledgement status.
+
+        """
+        start = time.perf_counter()
+        try:
+            if offset + size > ring.size:
+                raise ValueError(f"{size} bytes at offset {offset} are outside the ring.")
+            request = batch_to_request(ring.buf[offset:offset + size])  # No view of the ring outlives this call.
+        except ValueError as e:
+            logger.error("Rejected shared-memory batch: %s", e)
+            self.stats.record_call(SHM_METHOD, time.perf_counter() - start, ACK_STATUSES[ACK_INVALID])
+            return 0, ACK_INVALID
+        parsed = time.perf_counter()
+        self.stats.observe("stage_duration_seconds", parsed - start, PARSE_LABELS)
+        self.stats.observe("request_bytes", size, SHM_LABELS)
+        self.stats.observe("request_rows", len(request.metrics), SHM_LABELS)
+        status = ACK_OK
+        try:
+            self.save(request)
+        except Exception as e:
+            logger.error("Failed to process shared-memory batch: %s", e)
+            status = ACK_FAILED
+        self.stats.record_call(SHM_METHOD, time.perf_counter() - parsed, ACK_STATUSES[status])
+        return (len(request.metrics), status) if status == ACK_OK else (0, status)
@@ -0,0 +1,241 @@
+import os
+import mmap
+import struct
+import logging
+from typing import Iterable, NamedTuple, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Sparse index of one closed segment, stored next to it as NNNNNNNN.idx. A "block" is one record of the segment (one
+# saved batch). The file holds, in this order (all little-endian):
+# * a header: magic, format version, number of blocks, number of servers, min and max timestamp of the segment;
+# * the block table: offset and length of the record in the segment file, number of rows, min and max timestamp;
+# * the server table, sorted by server ID: position and length of the ID in the name blob, and the slice of the
+#   postings array that lists the blocks containing the server;
+# * the postings: block numbers (ascending for every server);
+# * the name blob: the UTF-8 server IDs.
+# Every table is read in place from a memory map, so opening an index costs O(1) whatever the size of the segment.
+INDEX_MAGIC = b"MIDX"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sIIIqq")
+BLOCK_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4"), ("rows", "<u4"), ("min_ts", "<i8"), ("max_ts", "<i8")])
+SERVER_DTYPE = np.dtype([("name_offset", "<u4"), ("name_length", "<u4"), ("postings_start", "<u4"),
+                         ("postings_count", "<u4")])
+POSTING_DTYPE = np.dtype("<u4")
+
+# Block journal of the active segment, NNNNNNNN.blk: the same block summaries, appended as records are written, so that
+# queries do not have to scan the segment that is still growing. Every entry is a fixed header (offset and length of the
+# record, number of rows, min and max timestamp, length of the names) followed by the server IDs of the block, UTF-8,
+# separated by newlines. The journal is not fsynced: it is rebuilt from the segment when the log is reopened, and it is
+# replaced by the index once the segment is closed.
+JOURNAL_ENTRY = struct.Struct("<QIIqqI")
+
+
+class BlockSummary(NamedTuple):
+    """What the index keeps about one block (record) of a segment."""
+    offset: int  # Position of the record payload in the segment file.
+    length: int  # Stored (possibly compressed) length of the payload.
+    rows: int
+    min_ts: int
+    max_ts: int
+    server_ids: Iterable[str]  # Distinct server IDs of the block.
+
+
+def index_path(directory: str, segment_name: str) -> str:
+    """Return the path of the index of a segment (00000001.seg -> 00000001.idx)."""
+    return os.path.join(directory, os.path.splitext(segment_name)[0] + ".idx")
+
+
+def journal_path(directory: str, segment_name: str) -> str:
+    """Return the path of the block journal of a segment (00000001.seg -> 00000001.blk)."""
+    return os.path.join(directory, os.path.splitext(segment_name)[0] + ".blk")
+
+
+def encode_journal_entries(blocks: Iterable[BlockSummary]) -> bytes:
+    """Encode block summaries as block journal entries."""
+    entries = []
+    for block in blocks:
+        names = "\n".join(block.server_ids).encode("utf-8")
+        entries.append(JOURNAL_ENTRY.pack(block.offset, block.length, block.rows, block.min_ts, block.max_ts,
+                                          len(names)) + names)
+    return b"".join(entries)
+
+
+def append_block_journal(path: str, blocks: list[BlockSummary]) -> None:
+    """Append block summaries to a block journal, with a single write."""
+    with open(path, "ab", buffering=0) as f_journal:
+        f_journal.write(encode_journal_entries(blocks))
+
+
+def write_block_journal(path: str, blocks: list[BlockSummary]) -> None:
+    """Write a block journal from scratch, replacing any previous one atomically."""
+    with open(f"{path}.tmp", "wb") as f_journal:
+        f_journal.write(encode_journal_entries(blocks))
+    os.replace(f"{path}.tmp", path)
+
+
+def read_block_journal(path: str) -> list[BlockSummary]:
+    """Read a block journal.
+
+    Returns:
+        The block summaries, in file order. An entry cut off by the end of the file (being written) ends the list.
+
+    """
+    with open(path, "rb") as f_journal:
+        data = f_journal.read()
+    blocks = []
+    offset = 0
+    while offset + JOURNAL_ENTRY.size <= len(data):
+        block_offset, length, rows, min_ts, max_ts, names_length = JOURNAL_ENTRY.unpack_from(data, offset)
+        start = offset + JOURNAL_ENTRY.size
+        if start + names_length > len(data):
+            break
+        names = data[start:start + names_length].decode("utf-8")
+        blocks.append(BlockSummary(block_offset, length, rows, min_ts, max_ts, names.split("\n") if names else ()))
+        offset = start + names_length
+    return blocks
+
+
+def find_journal_blocks(
+        blocks: list[BlockSummary],
+        server_ids: Optional[Iterable[str]],
+        start_ns: int,
+        end_ns: int
+) -> list[tuple[int, int]]:
+    """Return the journaled blocks that may contain rows of the given servers in [start_ns, end_ns).
+
+    The journal of the active segment is small (one entry per record), so it is searched linearly.
+
+    Returns:
+        (offset, length) of the records of the matching blocks, in file order.
+
+    """
+    wanted = set(server_ids) if server_ids is not None else None
+    return [(block.offset, block.length) for block in blocks
+            if block.min_ts < end_ns and block.max_ts >= start_ns
+            and (wanted is None or not wanted.isdisjoint(block.server_ids))]
+
+
+def write_segment_index(path: str, blocks: list[BlockSummary]) -> None:
+    """Write the index of a segment, replacing any previous one atomically.
+
+    Args:
+        path: The index file (see `index_path`).
+        blocks: The summaries of the records of the segment, in file order.
+
+    """
+    postings = {}  # Server ID -> block numbers, ascending.
+    for number, block in enumerate(blocks):
+        for server_id in block.server_ids:
+            postings.setdefault(server_id, []).append(number)
+    server_ids = sorted(postings)
+
+    block_table = np.array([(b.offset, b.length, b.rows, b.min_ts, b.max_ts) for b in blocks], dtype=BLOCK_DTYPE)
+    server_table = np.zeros(len(server_ids), dtype=SERVER_DTYPE)
+    names = bytearray()
+    postings_start = 0
+    for i, server_id in enumerate(server_ids):
+        name = server_id.encode("utf-8")
+        server_table[i] = (len(names), len(name), postings_start, len(postings[server_id]))
+        names += name
+        postings_start += len(postings[server_id])
+    posting_array = np.array([number for server_id in server_ids for number in postings[server_id]],
+                             dtype=POSTING_DTYPE)
+    min_ts = int(block_table["min_ts"].min()) if blocks else 0
+    max_ts = int(block_table["max_ts"].max()) if blocks else 0
+
+    with open(f"{path}.tmp", "wb") as f_index:
+        f_index.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(blocks), len(server_ids), min_ts, max_ts))
+        f_index.write(block_table.tobytes())
+        f_index.write(server_table.tobytes())
+        f_index.write(posting_array.tobytes())
+        f_index.write(bytes(names))
+    os.replace(f"{path}.tmp", path)
+
+
+class SegmentIndex:
+    """Read-only view of a segment index, memory-mapped.
+
+    Usage:
+        with SegmentIndex(path) as index:
+            blocks = index.find_blocks(["srv1"], start_ns, end_ns)
+
+    """
+
+    def __init__(self, path: str) -> None:
+        """Map an index file.
+
+        Raises:
+            ValueError: If the file is not an index of a supported version.
+            OSError: If the file cannot be read.
+
+        """
+        with open(path, "rb") as f_index:
+            self._map = mmap.mmap(f_index.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, blocks_count, servers_count, self.min_ts, self.max_ts = INDEX_HEADER.unpack_from(self._map)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self._map.close()
+            raise ValueError(f"Not a segment index: {path}")
+        offset = INDEX_HEADER.size
+        self.blocks = np.frombuffer(self._map, BLOCK_DTYPE, blocks_count, offset)
+        offset += self.blocks.nbytes
+        self._servers = np.frombuffer(self._map, SERVER_DTYPE, servers_count, offset)
+        offset += self._servers.nbytes
+        self._postings = np.frombuffer(self._map, POSTING_DTYPE, int(self._servers["postings_count"].sum()), offset)
+        self._names_offset = offset + self._postings.nbytes
+
+    def __enter__(self) -> "SegmentIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.blocks = self._servers = self._postings = None  # Release the views before unmapping.
+        try:
+            self._map.close()
+        except BufferError:  # A caller still holds a view; the mapping is released once it is collected.
+            pass
+
+    def _server_id(self, i: int) -> str:
+        start = self._names_offset + int(self._servers["name_offset"][i])
+        return self._map[start:start + int(self._servers["name_length"][i])].decode("utf-8")
+
+    def postings(self, server_id: str) -> np.ndarray:
+        """Return the numbers of the blocks that contain a server (binary search over the sorted server table)."""
+        low, high = 0, len(self._servers)
+        while low < high:
+            middle = (low + high) // 2
+            if self._server_id(middle) < server_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(self._servers) or self._server_id(low) != server_id:
+            return np.empty(0, dtype=POSTING_DTYPE)
+        start = int(self._servers["postings_start"][low])
+        return self._postings[start:start + int(self._servers["postings_count"][low])]
+
+    def find_blocks(self, server_ids: Optional[Iterable[str]], start_ns: int, end_ns: int) -> list[tuple[int, int]]:
+        """Return the blocks that may contain rows of the given servers in [start_ns, end_ns).
+
+        Args:
+            server_ids: The servers, or None for all of them.
+            start_ns: Start of the time range (inclusive).
+            end_ns: End of the time range (exclusive).
+
+        Returns:
+            (offset, length) of the records of the matching blocks, in file order.
+
+        """
+        if not len(self.blocks) or self.max_ts < start_ns or self.min_ts >= end_ns:
+            return []
+        if server_ids is None:
+            candidates = np.arange(len(self.blocks))
+        else:
+            candidates = np.unique(np.concatenate([self.postings(server_id) for server_id in server_ids]
+                                                  or [np.empty(0, dtype=POSTING_DTYPE)]))
+        blocks = self.blocks[candidates]
+        blocks = blocks[(blocks["min_ts"] < end_ns) & (blocks["max_ts"] >= start_ns)]
+        return [(int(offset), int(length)) for offset, length in zip(blocks["offset"], blocks["length"])]
@@ -0,0 +1,406 @@
+import time
+import bisect
+import asyncio
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional
+
+import grpc
+
+from metrics_pb2 import MetricsRequest, StatsResponse, CounterValue, HistogramValue
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets; values above the last bound are counted in one more bucket (+Inf).
+LATENCY_BUCKETS_S = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                     10.0)
+# Rows and bytes: powers of sqrt(2) rounded to integers, 1 to 2**30 (about 1e9). Estimated quantiles are interpolated
+# within a bucket, so their error is bounded by its width: about 41% of the value beyond the first few buckets, instead
+# of 300% with powers of 4.
+SIZE_BUCKETS = tuple(sorted({float(round(2 ** (i / 2))) for i in range(61)}))
+
+# Histograms: name -> (bucket bounds, description).
+HISTOGRAMS = {
+    "stage_duration_seconds": (LATENCY_BUCKETS_S, "Time spent in each processing stage, per request or batch."),
+    "rpc_duration_seconds": (LATENCY_BUCKETS_S, "Time from the start of a call to its last response message."),
+    "request_bytes": (SIZE_BUCKETS, "Size of every received request message (every chunk of a stream)."),
+    "request_rows": (SIZE_BUCKETS, "Metrics in every received MetricsRequest message (every chunk of a stream)."),
+}
+# Counters: name -> description.
+COUNTERS = {
+    "rpc_total": "Finished calls, by method and status code.",
+}
+PROMETHEUS_PREFIX = "metrics_server_"
+
+Labels = tuple[tuple[str, str], ...]
+
+PARSE_LABELS = (("stage", "parse"),)
+
+
+class Histogram:
+    """Counts of values in fixed buckets, with their number and sum (the Prometheus histogram model)."""
+
+    __slots__ = ("bounds", "bucket_counts", "count", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.bucket_counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.bounds, value)] += 1  # The first bucket whose bound is >= value.
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: "Histogram") -> None:
+        """Add the values of another histogram with the same bounds (which may be updated concurrently)."""
+        bucket_counts = list(other.bucket_counts)
+        for i, count in enumerate(bucket_counts):
+            self.bucket_counts[i] += count
+        self.count += sum(bucket_counts)  # Not `other.count`, which may lag behind the buckets by one value.
+        self.sum += other.sum
+
+
+class StageTimer:
+    """Context manager that records the time spent in its block as one value of a stage."""
+
+    __slots__ = ("registry", "labels", "start")
+
+    def __init__(self, registry: "StatsRegistry", stage: str) -> None:
+        self.registry = registry
+        self.labels = (("stage", stage),)
+        self.start = 0.0
+
+    def __enter__(self) -> "StageTimer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.registry.observe("stage_duration_seconds", time.perf_counter() - self.start, self.labels)
+
+
+class StatsRegistry:
+    """Counters and histograms of the server, cheap enough to be updated on every request.
+
+    Every thread records into its own shard (a dict of counters and a dict of histograms), so recording takes no lock
+    and threads never contend; the lock is only taken when a thread records for the first time, when it releases its
+    shard, and when a snapshot gathers the shards. A snapshot merges the shards while they may be updated, so it can
+    miss the values being recorded at that moment, but it never counts a value twice. Short-lived threads (e.g. one per
+    connection) call `release_thread` before they end, which folds their shard into the one of finished threads.
+
+    Values are identified by a name (a key of HISTOGRAMS or COUNTERS) and labels, e.g. ("stage", "json").
+
+    """
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self._local = threading.local()
+        self._retired = ({}, {})  # The values of the threads that released their shard.
+        self._shards = [self._retired]  # (counters, histograms) of every thread that recorded something.
+        self._lock = threading.Lock()
+
+    def _shard(self) -> tuple[dict, dict]:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def release_thread(self) -> None:
+        """Fold the shard of the calling thread into the values of finished threads, so that it can be dropped.
+
+        The thread may record again afterwards: it then gets a new shard.
+
+        """
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            return
+        del self._local.shard
+        counters, histograms = shard
+        retired_counters, retired_histograms = self._retired
+        with self._lock:
+            self._shards = [other for other in self._shards if other is not shard]
+            for key, value in counters.items():
+                retired_counters[key] = retired_counters.get(key, 0) + value
+            for key, histogram in histograms.items():
+                retired = retired_histograms.get(key)
+                if retired is None:
+                    retired = retired_histograms[key] = Histogram(histogram.bounds)
+                retired.merge(histogram)
+
+    def increment(self, name: str, labels: Labels = (), value: int = 1) -> None:
+        """Add `value` to a counter."""
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        """Record one value of a histogram."""
+        histograms = self._shard()[1]
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(HISTOGRAMS[name][0])
+        histogram.observe(value)
+
+    def timer(self, stage: str) -> StageTimer:
+        """Return a context manager that records the time spent in its block as one value of `stage`."""
+        return StageTimer(self, stage)
+
+    def record_call(self, method: str, seconds: float, code: str) -> None:
+        """Record a finished call: its duration, and one more call of the method with this status code."""
+        self.observe("rpc_duration_seconds", seconds, (("method", method),))
+        self.increment("rpc_total", (("method", method), ("code", code)))
+
+    def snapshot(self) -> tuple[dict[tuple[str, Labels], int], dict[tuple[str, Labels], Histogram]]:
+        """Return the counters and histograms of all threads, merged and sorted by name and labels."""
+        counters = {}
+        histograms = {}
+        with self._lock:  # Held while merging, so that no shard is released (and counted twice) meanwhile.
+            for shard_counters, shard_histograms in self._shards:
+                for key, value in list(shard_counters.items()):  # A copy: the owner thread may add keys meanwhile.
+                    counters[key] = counters.get(key, 0) + value
+                for key, histogram in list(shard_histograms.items()):
+                    merged = histograms.get(key)
+                    if merged is None:
+                        merged = histograms[key] = Histogram(histogram.bounds)
+                    merged.merge(histogram)
+        return dict(sorted(counters.items())), dict(sorted(histograms.items()))
+
+    def to_proto(self) -> StatsResponse:
+        """Return a snapshot as the response of the GetStats call."""
+        counters, histograms = self.snapshot()
+        return StatsResponse(
+            uptime_s=time.time() - self.started,
+            counters=[CounterValue(name=name, labels=dict(labels), value=value)
+                      for (name, labels), value in counters.items()],
+            histograms=[HistogramValue(name=name, labels=dict(labels), bounds=histogram.bounds,
+                                       bucket_counts=histogram.bucket_counts, count=histogram.count,
+                                       sum=histogram.sum)
+                        for (name, labels), histogram in histograms.items()]
+        )
+
+    def to_prometheus(self) -> str:
+        """Return a snapshot in the Prometheus text exposition format (version 0.0.4)."""
+        counters, histograms = self.snapshot()
+        lines = [f"# HELP {PROMETHEUS_PREFIX}uptime_seconds Time since the server process started.",
+                 f"# TYPE {PROMETHEUS_PREFIX}uptime_seconds gauge",
+                 f"{PROMETHEUS_PREFIX}uptime_seconds {time.time() - self.started:.3f}"]
+        for name, description in COUNTERS.items():
+            lines += [f"# HELP {PROMETHEUS_PREFIX}{name} {description}", f"# TYPE {PROMETHEUS_PREFIX}{name} counter"]
+            lines += [f"{PROMETHEUS_PREFIX}{name}{format_labels(labels)} {value}"
+                      for (counter_name, labels), value in counters.items() if counter_name == name]
+        for name, (_, description) in HISTOGRAMS.items():
+            lines += [f"# HELP {PROMETHEUS_PREFIX}{name} {description}",
+                      f"# TYPE {PROMETHEUS_PREFIX}{name} histogram"]
+            for (histogram_name, labels), histogram in histograms.items():
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + (float("inf"),), histogram.bucket_counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{PROMETHEUS_PREFIX}{name}_bucket{format_labels(labels + (('le', le),))} "
+                                 f"{cumulative}")
+                lines.append(f"{PROMETHEUS_PREFIX}{name}_sum{format_labels(labels)} {histogram.sum!r}")
+                lines.append(f"{PROMETHEUS_PREFIX}{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    """Format labels as a Prometheus label set, e.g. {stage="json"} (empty if there are none)."""
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def call_code(context: Any, error: Optional[BaseException]) -> str:
+    """Return the name of the status code a call ended with, from its context and the exception it raised, if any."""
+    code = context.code()
+    if code is None:  # Not set by the handler: OK, unless the handler failed or the call was cancelled.
+        if error is None:
+            code = grpc.StatusCode.OK
+        elif isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+            code = grpc.StatusCode.CANCELLED
+        else:
+            code = grpc.StatusCode.UNKNOWN
+    return code.name
+
+
+def timed_deserializer(registry: StatsRegistry, deserializer: Callable[[bytes], Any], labels: Labels):
+    """Wrap a request deserializer to record the parse time, and the size and number of rows of every message."""
+
+    def parse(data: bytes) -> Any:
+        start = time.perf_counter()
+        request = deserializer(data)
+        registry.observe("stage_duration_seconds", time.perf_counter() - start, PARSE_LABELS)
+        registry.observe("request_bytes", len(data), labels)
+        if isinstance(request, MetricsRequest):
+            registry.observe("request_rows", len(request.metrics), labels)
+        return request
+
+    return parse
+
+
+def timed_behavior(registry: StatsRegistry, behavior: Callable, method: str, streaming: bool) -> Callable:
+    """Wrap the handler of a sync server to record its duration and status code."""
+    if streaming:
+        def stream_wrapper(request: Any, context: grpc.ServicerContext) -> Any:
+            start = time.perf_counter()
+            error = None
+            try:
+                yield from behavior(request, context)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                registry.record_call(method, time.perf_counter() - start, call_code(context, error))
+
+        return stream_wrapper
+
+    def wrapper(request: Any, context: grpc.ServicerContext) -> Any:
+        start = time.perf_counter()
+        error = None
+        try:
+            return behavior(request, context)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            registry.record_call(method, time.perf_counter() - start, call_code(context, error))
+
+    return wrapper
+
+
+def timed_async_behavior(registry: StatsRegistry, behavior: Callable, method: str, streaming: bool) -> Callable:
+    """Wrap the handler of a grpc.aio server to record its duration and status code."""
+    if streaming:
+        async def stream_wrapper(request: Any, context: grpc.aio.ServicerContext) -> Any:
+            start = time.perf_counter()
+            error = None
+            try:
+                async for response in behavior(request, context):
+                    yield response
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                registry.record_call(method, time.perf_counter() - start, call_code(context, error))
+
+        return stream_wrapper
+
+    async def wrapper(request: Any, context: grpc.aio.ServicerContext) -> Any:
+        start = time.perf_counter()
+        error = None
+        try:
+            return await behavior(request, context)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            registry.record_call(method, time.perf_counter() - start, call_code(context, error))
+
+    return wrapper
+
+
+def instrument_handler(
+        registry: StatsRegistry,
+        handler: grpc.RpcMethodHandler,
+        full_method: str,
+        asynchronous: bool = False
+) -> grpc.RpcMethodHandler:
+    """Return a copy of a method handler whose request parsing and calls are recorded in the registry.
+
+    Args:
+        registry: The registry.
+        handler: The handler of the method.
+        full_method: The full name of the method, e.g. "/MetricsService/SendMetrics".
+        asynchronous: Whether the handler belongs to a grpc.aio server.
+
+    Returns:
+        The instrumented handler.
+
+    """
+    method = full_method.rsplit("/", 1)[-1]
+    changes = {}
+    if handler.request_deserializer is not None:
+        changes["request_deserializer"] = timed_deserializer(registry, handler.request_deserializer,
+                                                             (("method", method),))
+    wrap = timed_async_behavior if asynchronous else timed_behavior
+    for kind in ("unary_unary", "unary_stream", "stream_unary", "stream_stream"):
+        behavior = getattr(handler, kind)
+        if behavior is not None:
+            changes[kind] = wrap(registry, behavior, method, streaming=kind.endswith("_stream"))
+    return handler._replace(**changes)  # Method handlers are named tuples.
+
+
+class StatsInterceptor(grpc.ServerInterceptor):
+    """Server interceptor that records the parse time, request sizes, duration and status code of every call."""
+
+    def __init__(self, registry: StatsRegistry) -> None:
+        self.registry = registry
+
+    def intercept_service(self, continuation: Callable, handler_call_details: grpc.HandlerCallDetails) -> Any:
+        handler = continuation(handler_call_details)
+        if handler is None:  # Unknown method.
+            return None
+        return instrument_handler(self.registry, handler, handler_call_details.method)
+
+
+class AsyncStatsInterceptor(grpc.aio.ServerInterceptor):
+    """The StatsInterceptor of a grpc.aio server."""
+
+    def __init__(self, registry: StatsRegistry) -> None:
+        self.registry = registry
+
+    async def intercept_service(self, continuation: Callable, handler_call_details: grpc.HandlerCallDetails) -> Any:
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        return instrument_handler(self.registry, handler, handler_call_details.method, asynchronous=True)
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    """Serve the statistics of the registry of the HTTP server at /metrics."""
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug("Stats endpoint: " + format, *args)  # Scrapes are too frequent for the INFO log.
+
+
+def start_http_server(registry: StatsRegistry, host: str, port: int) -> ThreadingHTTPServer:
+    """Serve the statistics in the Prometheus text format at http://host:port/metrics, from a background thread.
+
+    Args:
+        registry: The registry to serve.
+        host: Address to listen on ("127.0.0.1" for local scrapers only).
+        port: Port to listen on.
+
+    Returns:
+        The HTTP server; stop it with `shutdown()` and `server_close()`.
+
+    Raises:
+        OSError: If the address cannot be bound.
+
+    """
+    server = ThreadingHTTPServer((host, port), PrometheusHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="stats-http", daemon=True).start()
+    logger.info("Serving statistics at http://%s:%d/metrics.", host, port)
+    return server
@@ -1,27 +1,37 @@
 import os
-import json
 import logging
+from typing import Optional, Union, Iterator
 
-import flatbuffers
-from metrics_pb2 import MetricsRequest, ServerMetrics
-from flatbuffers_schema.MetricsRequest import MetricsRequestStart, MetricsRequestAddMetrics, MetricsRequestEnd, \
-    MetricsRequestStartMetricsVector
-from flatbuffers_schema.ServerMetrics import ServerMetricsStart, ServerMetricsAddServerId, ServerMetricsAddCpuUsage, \
-    ServerMetricsAddMemoryUsage, ServerMetricsAddDiskUsage, ServerMetricsAddTimestamp, ServerMetricsEnd
+import numpy as np
+from codec import decode_flatbuffers_columnar, collect_protobuf, encode_json_rows, encode_flatbuffers_rows, \
+    encode_flatbuffers_columnar
+from compression import parse_codec, decompress
+from segment_log import SegmentLog, MappedLog, MANIFEST_NAME, iter_records, iter_frame_positions, log_size, \
+    read_manifest, tail_positions, iter_tail_records, iter_tail_mapped_records
+from sparse_index import BlockSummary, SegmentIndex, index_path, write_segment_index, journal_path, \
+    append_block_journal, write_block_journal, read_block_journal, find_journal_blocks
+from metrics_pb2 import MetricsRequest, MetricsQuery
+from stats import StatsRegistry
 
 logger = logging.getLogger(__name__)
 
+INDEXED_FORMAT = "flatcol"  # The format whose segments are indexed and read by range queries.
+MAX_TIMESTAMP_NS = 2 ** 63 - 1
+DEFAULT_QUERY_CHUNK_SIZE = 1000
+MAX_QUERY_CHUNK_SIZE = 100_000  # Keeps every streamed message well under the 4 MB gRPC limit.
+SEGMENTS_DIR = "segments"
+FORMATS = ("json", "proto", "flatbuf", "flatcol")  # "flatcol" is the columnar FlatBuffers MetricsBatch.
 
-def save_metrics(metrics: list) -> None:
-    """Save metrics in JSON, Protobuf, and FlatBuffers formats to files.
 
-    Args:
-        metrics: List of ServerMetrics objects to save.
+def get_results_path() -> str:
+    """Return the results directory, creating it if needed.
+
+    Returns:
+        The value of the RESULTS_PATH environment variable.
 
     Raises:
         ValueError: If RESULTS_PATH environment variable is not set.
         OSError: If directory creation fails.
-        Exception: If saving to any format (JSON, Protobuf, FlatBuffers) fails.
 
     """
     results_path = os.getenv("RESULTS_PATH")
@@ -34,73 +44,509 @@ def save_metrics(metrics: list) -> None:
     except OSError as e:
         logger.error("Failed to create directory %s: %s", results_path, e)
         raise
+    return results_path
 
-    if not metrics:
-        logger.warning("No metrics to save.")
-        return
 
-    # JSON serialization
-    json_data = [
-        {"server_id": m.server_id, "cpu_usage": m.cpu_usage, "memory_usage": m.memory_usage, "disk_usage": m.disk_usage,
-         "timestamp": m.timestamp} for m in metrics]
-    try:
-        with open(f"{results_path}/metrics.json", "w") as f_json:
-            json.dump(json_data, f_json)
-        logger.info("Saved %d metrics to %s/metrics.json", len(json_data), results_path)
-    except Exception as e:
-        logger.error("Failed to save JSON: %s", e)
-        raise
+def segments_path(results_path: str, fmt: str, shard: Optional[int] = None) -> str:
+    """Return the directory of the segment log that stores one format ("json", "proto", "flatbuf" or "flatcol").
 
-    # Protobuf serialization
-    try:
-        request = MetricsRequest()
-        request.metrics.extend(metrics)
-        with open(f"{results_path}/metrics.proto.bin", "wb") as f_proto:
-            f_proto.write(
-                request.SerializeToString())  # Serialize to binary format (bytes). SerializeToString() converts the msg object into a byte sequence according to the Protobuf schema.
-        logger.info("Saved %d metrics to %s/metrics.proto.bin", len(metrics), results_path)
-    except Exception as e:
-        logger.error("Failed to save Protobuf: %s", e)
-        raise
+    Args:
+        results_path: The results directory.
+        fmt: The storage format.
+        shard: The shard written by one server worker process, or None for the single-process layout.
+
+    Returns:
+        RESULTS_PATH/segments/<fmt>, or RESULTS_PATH/segments/<fmt>/shard-<NN> for a shard.
+
+    """
+    if shard is None:
+        return f"{results_path}/{SEGMENTS_DIR}/{fmt}"
+    return f"{results_path}/{SEGMENTS_DIR}/{fmt}/shard-{shard:02d}"
+
+
+def log_directories(results_path: str, fmt: str) -> list[str]:
+    """Return every segment log that stores one format: the unsharded log and the shard logs, in that order.
+
+    Args:
+        results_path: The results directory.
+        fmt: The storage format.
+
+    Returns:
+        The directories that contain a manifest (empty if nothing was stored yet).
+
+    """
+    base = segments_path(results_path, fmt)
+    if not os.path.isdir(base):
+        return []
+    directories = [base] + [os.path.join(base, name) for name in sorted(os.listdir(base)) if name.startswith("shard-")]
+    return [directory for directory in directories if os.path.exists(os.path.join(directory, MANIFEST_NAME))]
+
+
+def iter_stored_records(results_path: str, fmt: str) -> Iterator[bytes]:
+    """Iterate over the records of one format in every log (see `log_directories`), reading the segment files."""
+    for directory in log_directories(results_path, fmt):
+        yield from iter_records(directory)
+
+
+def iter_mapped_records(results_path: str, fmt: str) -> Iterator[memoryview]:
+    """Iterate over the records of one format in every log as zero-copy views of the memory-mapped segments.
+
+    The views are only valid until the next record of another log is requested (the previous log is unmapped then).
+
+    """
+    for directory in log_directories(results_path, fmt):
+        with MappedLog(directory) as log:
+            yield from log.records()
+
+
+def recent_record_counts(results_path: str, max_bytes: int) -> list[int]:
+    """Choose a sample of the most recent batches: how many of the last records of every log to read.
+
+    Every saved batch is one record in the log of every format (in the same shard), so reading the same number of last
+    records of every format samples the same batches. The counts are chosen so that the JSON records, the largest
+    ones, take at most `max_bytes` as stored (possibly compressed), split evenly between the logs; at least one record
+    of every non-empty log is sampled.
+
+    Args:
+        results_path: The results directory.
+        max_bytes: The size of the sample.
+
+    Returns:
+        The number of records of every log, in the order of `log_directories`.
+
+    """
+    directories = log_directories(results_path, "json")
+    share = max_bytes // max(len(directories), 1)
+    return [sum(len(positions) for _, positions in tail_positions(directory, max_bytes=share))
+            for directory in directories]
+
+
+def iter_recent_records(results_path: str, fmt: str, counts: list[int]) -> Iterator[bytes]:
+    """Iterate over the last records of every log of one format (see `recent_record_counts`), in append order."""
+    for directory, count in zip(log_directories(results_path, fmt), counts):
+        if count:
+            yield from iter_tail_records(directory, count)
 
-    # FlatBuffers serialization
+
+def iter_recent_mapped_records(results_path: str, fmt: str, counts: list[int]) -> Iterator[Union[memoryview, bytes]]:
+    """Like `iter_recent_records`, as zero-copy views of the mapped segments (see `iter_tail_mapped_records`)."""
+    for directory, count in zip(log_directories(results_path, fmt), counts):
+        if count:
+            yield from iter_tail_mapped_records(directory, count)
+
+
+def stored_size(results_path: str, fmt: str) -> int:
+    """Return the total size in bytes of the segment files of one format, over every log."""
+    return sum(log_size(directory) for directory in log_directories(results_path, fmt))
+
+
+def encode_protobuf(metrics: list, base_timestamp_ns: int = 0) -> bytes:
+    """Encode ServerMetrics objects as a serialized schema v2 Protobuf MetricsRequest.
+
+    Timestamps keep the delta encoding chosen by the client (see `schema.normalize_request`): samples of a batch are
+    close in time, so each offset takes a few bytes instead of the 9 or 10 bytes of an absolute epoch-nanosecond varint,
+    and the messages are copied as they are, without a Python loop over the rows.
+
+    Args:
+        metrics: List of schema v2 ServerMetrics objects.
+        base_timestamp_ns: The base the `timestamp_ns` values are relative to (0 if they are absolute).
+
+    Returns:
+        The Protobuf-encoded bytes.
+
+    """
+    request = MetricsRequest(schema_version=2, base_timestamp_ns=base_timestamp_ns)
+    request.metrics.extend(metrics)
+    return request.SerializeToString()  # Serialize to binary format (bytes). SerializeToString() converts the msg object into a byte sequence according to the Protobuf schema.
+
+
+def summarize_block(offset: int, length: int, record: Union[bytes, memoryview]) -> BlockSummary:
+    """Summarize one columnar record for the sparse index.
+
+    Args:
+        offset: Position of the stored record in its segment file.
+        length: Stored (possibly compressed) length of the record.
+        record: The decompressed MetricsBatch buffer.
+
+    Returns:
+        The summary: the server IDs are the dictionary of the batch, which only holds the servers present in it.
+
+    """
+    columns = decode_flatbuffers_columnar(record, ("server_ids", "timestamp_ns"))
+    timestamps = columns["timestamp_ns"]
+    if not len(timestamps):
+        return BlockSummary(offset, length, 0, MAX_TIMESTAMP_NS, -MAX_TIMESTAMP_NS, ())
+    return BlockSummary(offset, length, len(timestamps), int(timestamps.min()), int(timestamps.max()),
+                        columns["server_ids"])
+
+
+def summarize_segment(directory: str, segment: dict) -> list[BlockSummary]:
+    """Summarize every record of a segment of a columnar log, in file order."""
+    with open(os.path.join(directory, segment["name"]), "rb") as f_segment:
+        data = f_segment.read()
+    codec = segment.get("codec", "none")
+    return [summarize_block(offset, len(record), decompress(codec, record))
+            for offset, record in iter_frame_positions(data, name=f"{directory}/{segment['name']}")]
+
+
+def index_segment(directory: str, segment: dict) -> None:
+    """Build the sparse index of a closed segment of a columnar log (see sparse_index.py), replacing its journal.
+
+    Used as the `on_segment_closed` hook of the log, and to index segments closed before indexing existed.
+
+    Args:
+        directory: The log directory.
+        segment: The description of the segment in the manifest.
+
+    """
+    blocks = summarize_segment(directory, segment)
+    write_segment_index(index_path(directory, segment["name"]), blocks)
     try:
-        builder = flatbuffers.Builder(
-            1024)  # Create a Builder object — a tool for constructing a FlatBuffers buffer. 1024 is the initial buffer size in bytes, which will grow if needed.
-        metric_offsets = []
-        for m in metrics:
-            # Create a string offset for server_id by writing the string into the buffer. CreateString returns the offset pointing to the beginning of the string in the buffer.
-            server_id = builder.CreateString(m.server_id)
-            timestamp = builder.CreateString(m.timestamp)
-            # Start building the ServerMetrics object in the buffer. ServerMetricsStart prepares a table for the ServerMetrics object, allocating space for field pointers.
-            ServerMetricsStart(builder)
-            # Add server_id to the ServerMetrics table using its offset.
-            ServerMetricsAddServerId(builder, server_id)
-            # Add cpu_usage as a float directly (without an offset, since it's a primitive type).
-            ServerMetricsAddCpuUsage(builder, m.cpu_usage)
-            ServerMetricsAddMemoryUsage(builder, m.memory_usage)
-            ServerMetricsAddDiskUsage(builder, m.disk_usage)
-            ServerMetricsAddTimestamp(builder, timestamp)
-            # Finalize the ServerMetrics object and get its offset in the buffer.
-            metric_offsets.append(ServerMetricsEnd(builder))
-
-        MetricsRequestStartMetricsVector(
-            builder,
-            len(metrics))  # Start creating the metrics vector (array) in MetricsRequest. Specify the number of elements (len(metrics)) to reserve space.
-        # Add offsets of ServerMetrics objects to the vector in reverse order. PrependUOffsetTRelative adds offsets at the beginning of the vector (FlatBuffers builds the buffer from the end).
-        for offset in reversed(metric_offsets):
-            builder.PrependUOffsetTRelative(offset)
-        metrics_array = builder.EndVector(len(metrics))  # Finalize the vector and get its offset.
-
-        MetricsRequestStart(builder)  # Start building the root MetricsRequest object.
-        MetricsRequestAddMetrics(builder, metrics_array)  # Add the metrics vector to MetricsRequest using its offset.
-        request = MetricsRequestEnd(builder)  # Finalize MetricsRequest and get its offset.
-        builder.Finish(request)  # Finalize the entire buffer, specifying that request is the root object.
-        flat_data = builder.Output()  # Retrieve the final byte string (FlatBuffers buffer) for transmission or storage.
-
-        with open(f"{results_path}/metrics.flatbuf", "wb") as f_flat:
-            f_flat.write(flat_data)
-        logger.info("Saved %d metrics to %s/metrics.flatbuf", len(metrics), results_path)
-    except Exception as e:
-        logger.error("Failed to save FlatBuffers: %s", e)
-        raise
+        os.remove(journal_path(directory, segment["name"]))
+    except FileNotFoundError:
+        pass
+    logger.info("Indexed segment %s/%s (%d blocks).", directory, segment["name"], len(blocks))
+
+
+def journal_blocks(directory: str, segment: dict, positions: list[tuple[int, int]], records: list[bytes]) -> None:
+    """Append the summaries of the records just written to the active segment of a columnar log to its block journal.
+
+    Used as the `on_records_appended` hook of the log (see sparse_index.py).
+
+    Args:
+        directory: The log directory.
+        segment: The description of the active segment in the manifest.
+        positions: (offset, length) of the new payloads in the segment file.
+        records: The payloads, as stored.
+
+    """
+    codec = segment.get("codec", "none")
+    append_block_journal(journal_path(directory, segment["name"]),
+                         [summarize_block(offset, length, decompress(codec, record))
+                          for (offset, length), record in zip(positions, records)])
+
+
+def journal_active_segment(directory: str) -> None:
+    """Rebuild the block journal of the active segment of a columnar log, which may be stale after a restart."""
+    segments = read_manifest(directory)
+    if segments and not segments[-1]["closed"]:
+        write_block_journal(journal_path(directory, segments[-1]["name"]), summarize_segment(directory, segments[-1]))
+
+
+def index_closed_segments(directory: str) -> None:
+    """Index the closed segments of a columnar log that have no index yet."""
+    for segment in read_manifest(directory):
+        if segment["closed"] and not os.path.exists(index_path(directory, segment["name"])):
+            index_segment(directory, segment)
+
+
+def iter_segment_blocks(
+        directory: str,
+        segment: dict,
+        server_ids: Optional[list[str]],
+        start_ns: int,
+        end_ns: int
+) -> Iterator[Union[bytes, memoryview]]:
+    """Iterate over the records of one columnar segment that may contain matching rows.
+
+    A closed, indexed segment is looked up in its index and only the matching records are read from the file. The
+    active segment is looked up in its block journal in the same way, and only the records written after the journal
+    entries that were read are scanned. A closed segment without an index (or an active one without a journal) is
+    scanned in full.
+
+    Yields:
+        Decompressed MetricsBatch buffers.
+
+    """
+    path = os.path.join(directory, segment["name"])
+    codec = segment.get("codec", "none")
+    indexed = index_path(directory, segment["name"])
+    if segment["closed"] and os.path.exists(indexed):
+        with SegmentIndex(indexed) as index:
+            positions = index.find_blocks(server_ids, start_ns, end_ns)
+        if not positions:
+            return
+        with open(path, "rb") as f_segment:
+            for offset, length in positions:
+                yield decompress(codec, os.pread(f_segment.fileno(), length, offset))
+        return
+    if not os.path.exists(path):
+        return
+    journal = journal_path(directory, segment["name"])
+    with open(path, "rb") as f_segment:
+        size = os.fstat(f_segment.fileno()).st_size
+        positions = []
+        covered = 0  # End of the last journaled record: the records after it are scanned.
+        if not segment["closed"] and os.path.exists(journal):
+            blocks = [block for block in read_block_journal(journal) if block.offset + block.length <= size]
+            positions = find_journal_blocks(blocks, server_ids, start_ns, end_ns)
+            covered = max((block.offset + block.length for block in blocks), default=0)
+        for offset, length in positions:
+            yield decompress(codec, os.pread(f_segment.fileno(), length, offset))
+        for _, record in iter_frame_positions(os.pread(f_segment.fileno(), size - covered, covered), name=path):
+            yield decompress(codec, record)
+
+
+def iter_query_rows(
+        results_path: str,
+        server_ids: Optional[list[str]],
+        start_ns: int,
+        end_ns: int
+) -> Iterator[dict[str, Union[list[str], np.ndarray]]]:
+    """Iterate over the stored rows of some servers in a time range, reading only the blocks that may match.
+
+    Every log of the columnar format (all shards) is searched. Rows come in storage order: block by block, in the order
+    the batches were written to each shard.
+
+    Args:
+        results_path: The results directory.
+        server_ids: The servers to return, or None for all of them.
+        start_ns: Start of the time range (inclusive), in Unix epoch nanoseconds.
+        end_ns: End of the time range (exclusive).
+
+    Yields:
+        The matching rows of one block: "server_ids" (the dictionary of the block) and the "server_index",
+        "cpu_usage", "memory_usage", "disk_usage" and "timestamp_ns" NumPy arrays (never empty).
+
+    """
+    wanted = set(server_ids) if server_ids is not None else None
+    for directory in log_directories(results_path, INDEXED_FORMAT):
+        for segment in read_manifest(directory):
+            for record in iter_segment_blocks(directory, segment, server_ids, start_ns, end_ns):
+                columns = decode_flatbuffers_columnar(record)
+                timestamps = columns["timestamp_ns"]
+                mask = (timestamps >= start_ns) & (timestamps < end_ns)
+                server_index = columns["server_index"]
+                if wanted is not None:
+                    codes = [i for i, server_id in enumerate(columns["server_ids"]) if server_id in wanted]
+                    mask &= np.isin(server_index, codes)
+                if not mask.any():
+                    continue
+                rows = {name: columns[name][mask] for name in ("cpu_usage", "memory_usage", "disk_usage")}
+                rows.update(server_ids=columns["server_ids"], server_index=server_index[mask],
+                            timestamp_ns=timestamps[mask])
+                yield rows
+
+
+def iter_query_chunks(
+        results_path: str,
+        server_ids: Optional[list[str]],
+        start_ns: int,
+        end_ns: int,
+        chunk_size: int,
+        limit: int = 0
+) -> Iterator[MetricsRequest]:
+    """Return the stored rows of some servers in a time range as schema v2 MetricsRequest chunks.
+
+    Args:
+        results_path: The results directory.
+        server_ids: The servers to return, or None for all of them.
+        start_ns: Start of the time range (inclusive), in Unix epoch nanoseconds.
+        end_ns: End of the time range (exclusive).
+        chunk_size: Maximum number of rows per chunk.
+        limit: Maximum number of rows in total (0 for no limit).
+
+    Yields:
+        Chunks of at most `chunk_size` rows, with absolute timestamps.
+
+    """
+    chunk = MetricsRequest(schema_version=2)
+    sent = 0
+    for rows in iter_query_rows(results_path, server_ids, start_ns, end_ns):
+        block_ids = rows["server_ids"]
+        for i, cpu, memory, disk, timestamp in zip(rows["server_index"].tolist(), rows["cpu_usage"].tolist(),
+                                                   rows["memory_usage"].tolist(), rows["disk_usage"].tolist(),
+                                                   rows["timestamp_ns"].tolist()):
+            chunk.metrics.add(server_id=block_ids[i], cpu_usage=cpu, memory_usage=memory, disk_usage=disk,
+                              timestamp_ns=timestamp)
+            sent += 1
+            if len(chunk.metrics) >= chunk_size or sent == limit:
+                yield chunk
+                if sent == limit:
+                    return
+                chunk = MetricsRequest(schema_version=2)
+    if chunk.metrics:
+        yield chunk
+
+
+def query_parameters(query: MetricsQuery) -> dict[str, Union[Optional[list[str]], int]]:
+    """Validate a QueryMetrics request and return the arguments of `MetricsStore.query_metrics`.
+
+    Raises:
+        ValueError: If the time range is empty or the chunk size is too large.
+
+    """
+    end_ns = query.end_timestamp_ns or MAX_TIMESTAMP_NS
+    if end_ns <= query.start_timestamp_ns:
+        raise ValueError("The end of the time range must be after its start.")
+    if query.chunk_size > MAX_QUERY_CHUNK_SIZE:
+        raise ValueError(f"The chunk size must be at most {MAX_QUERY_CHUNK_SIZE}.")
+    return {"server_ids": list(query.server_ids) or None, "start_ns": query.start_timestamp_ns, "end_ns": end_ns,
+            "chunk_size": query.chunk_size or DEFAULT_QUERY_CHUNK_SIZE, "limit": query.limit}
+
+
+class MetricsStore:
+    """Append-only storage of metrics in JSON, Protobuf, and FlatBuffers formats.
+
+    Every format has its own segment log under RESULTS_PATH/segments/ (json/, proto/, flatbuf/, flatcol/), and every
+    saved batch becomes one record in each of them: a JSON array, a serialized MetricsRequest, a FlatBuffers
+    MetricsRequest buffer and a columnar FlatBuffers MetricsBatch buffer. Saving a batch therefore costs O(batch) regardless of how much data is already stored, and the whole history
+    is kept. Records are always written with schema v2 timestamps (epoch nanoseconds), whatever version the client
+    sent: requests are converted with `schema.normalize_request` before they are saved.
+
+    The segment logs are configured with SEGMENT_MAX_BYTES, SEGMENT_MAX_AGE_S, FSYNC_POLICY and FSYNC_INTERVAL_MS.
+    Records are compressed at rest with SEGMENT_CODEC ("none", "zlib", "bz2" or "lzma", optionally with a level, e.g.
+    "zlib:1"), which can be overridden per format with SEGMENT_CODEC_<FORMAT> (e.g. SEGMENT_CODEC_JSON=lzma:9).
+
+    When several server processes run at once, each one opens the store with its own `shard`, so every process appends
+    to its own logs (segments/<fmt>/shard-<NN>/) and no locking between processes is needed.
+
+    Closed segments of the columnar log get a sparse index (NNNNNNNN.idx, see sparse_index.py), and the active one a
+    block journal (NNNNNNNN.blk) appended with every write, which `query_metrics` uses to read only the records that
+    may hold the requested servers and time range.
+
+    The time spent encoding every format and writing the logs is recorded in `stats` (stages "transcode", "json",
+    "flatbuf", "flatcol", "proto" and "write").
+
+    """
+
+    def __init__(
+            self,
+            results_path: Optional[str] = None,
+            shard: Optional[int] = None,
+            stats: Optional[StatsRegistry] = None
+    ) -> None:
+        """Open (or create) the segment logs.
+
+        Args:
+            results_path: Directory for the output files. Defaults to the RESULTS_PATH environment variable.
+            shard: The shard of the calling worker process, or None for the single-process layout.
+            stats: The registry the stage timings are recorded in (a private one by default).
+
+        Raises:
+            ValueError: If RESULTS_PATH environment variable is not set or FSYNC_POLICY is unknown.
+            OSError: If directory creation fails.
+
+        """
+        self.results_path = results_path or get_results_path()
+        self.shard = shard
+        self.stats = stats if stats is not None else StatsRegistry()
+        self.logs = {}
+        for fmt in FORMATS:
+            codec_spec = os.getenv(f"SEGMENT_CODEC_{fmt.upper()}", os.getenv("SEGMENT_CODEC", "none"))
+            codec, codec_level = parse_codec(codec_spec)
+            self.logs[fmt] = SegmentLog(
+                segments_path(self.results_path, fmt, shard),
+                max_segment_bytes=int(os.getenv("SEGMENT_MAX_BYTES", str(64 * 1024 * 1024))),
+                max_segment_age=float(os.getenv("SEGMENT_MAX_AGE_S", "3600")),
+                fsync_policy=os.getenv("FSYNC_POLICY", "interval"),
+                fsync_interval_ms=int(os.getenv("FSYNC_INTERVAL_MS", "1000")),
+                codec=codec,
+                codec_level=codec_level,
+                on_segment_closed=index_segment if fmt == INDEXED_FORMAT else None,
+                on_records_appended=journal_blocks if fmt == INDEXED_FORMAT else None
+            )
+        index_closed_segments(self.logs[INDEXED_FORMAT].directory)  # Segments closed before indexing existed.
+        journal_active_segment(self.logs[INDEXED_FORMAT].directory)
+
+    def encode_records(self, metrics: list, base_timestamp_ns: int = 0) -> dict[str, bytes]:
+        """Encode a batch of metrics into one record per format, compressed with the codec of the format's log.
+
+        The JSON, FlatBuffers and columnar FlatBuffers records are transcoded from the Protobuf messages, which are
+        read once (see `codec.collect_protobuf`); the Protobuf record is the messages themselves. Every format is timed
+        as a stage of its own, compression included.
+
+        Args:
+            metrics: List of schema v2 ServerMetrics objects.
+            base_timestamp_ns: The base the `timestamp_ns` values are relative to (0 if they are absolute).
+
+        Returns:
+            A dictionary mapping each format ("json", "proto", "flatbuf", "flatcol") to the encoded (and compressed)
+            batch.
+
+        Raises:
+            Exception: If encoding to any format (JSON, Protobuf, FlatBuffers, columnar FlatBuffers) fails.
+
+        """
+        records = {}
+        stats = self.stats
+
+        # JSON, FlatBuffers and columnar FlatBuffers serialization
+        try:
+            with stats.timer("transcode"):
+                rows, server_ids, columns = collect_protobuf(metrics, base_timestamp_ns)
+            with stats.timer("json"):
+                records["json"] = self.logs["json"].encode(encode_json_rows(rows).encode("utf-8"))
+            with stats.timer("flatbuf"):
+                records["flatbuf"] = self.logs["flatbuf"].encode(encode_flatbuffers_rows(rows, len(rows)))
+            with stats.timer("flatcol"):
+                records["flatcol"] = self.logs["flatcol"].encode(encode_flatbuffers_columnar(server_ids, *columns))
+        except Exception as e:
+            logger.error("Failed to save JSON and FlatBuffers: %s", e)
+            raise
+
+        # Protobuf serialization
+        try:
+            with stats.timer("proto"):
+                records["proto"] = self.logs["proto"].encode(encode_protobuf(metrics, base_timestamp_ns))
+        except Exception as e:
+            logger.error("Failed to save Protobuf: %s", e)
+            raise
+
+        return records
+
+    def write_records(self, batches: list[dict[str, bytes]]) -> None:
+        """Append encoded batches to the logs, using one write per format.
+
+        Args:
+            batches: Records returned by `encode_records`, in the order they should be stored.
+
+        Raises:
+            OSError: If writing to a log fails.
+
+        """
+        with self.stats.timer("write"):
+            for fmt in FORMATS:
+                try:
+                    self.logs[fmt].append_many([records[fmt] for records in batches], encoded=True)
+                except OSError as e:
+                    logger.error("Failed to write %s segment: %s", fmt, e)
+                    raise
+
+    def save_metrics(self, metrics: list, base_timestamp_ns: int = 0) -> None:
+        """Append a batch of metrics to the JSON, Protobuf, FlatBuffers, and columnar FlatBuffers logs.
+
+        Args:
+            metrics: List of schema v2 ServerMetrics objects to save.
+            base_timestamp_ns: The base the `timestamp_ns` values are relative to (0 if they are absolute).
+
+        Raises:
+            Exception: If saving to any format (JSON, Protobuf, FlatBuffers) fails.
+
+        """
+        if not metrics:
+            logger.warning("No metrics to save.")
+            return
+
+        self.write_records([self.encode_records(metrics, base_timestamp_ns)])
+        logger.info("Saved %d metrics to %s/%s", len(metrics), self.results_path, SEGMENTS_DIR)
+
+    def query_metrics(
+            self,
+            server_ids: Optional[list[str]],
+            start_ns: int,
+            end_ns: int,
+            chunk_size: int,
+            limit: int = 0
+    ) -> Iterator[MetricsRequest]:
+        """Return stored rows by server and time range, over every shard of the results directory.
+
+        See `iter_query_chunks`.
+
+        """
+        return iter_query_chunks(self.results_path, server_ids, start_ns, end_ns, chunk_size, limit)
+
+    def close(self) -> None:
+        """Sync and close all segment logs."""
+        for log in self.logs.values():
+            log.close()